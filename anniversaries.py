@@ -1,27 +1,164 @@
 import datetime
 from flask import Blueprint, render_template, request, redirect, url_for, jsonify
-from flask_sqlalchemy import SQLAlchemy
 from datetime import date
+from sqlalchemy.exc import IntegrityError
+from data_versions import bump_data_version, cached_by_data_version
+from tenants import tenant_extensions
+from serializers import parse_fields, serialize, api_response
+from recurrence import RECURRENCE_NONE, RECURRENCE_RULES, RECURRENCE_CHOICES, next_occurrence
 
 # 创建蓝图
 anniversary_bp = Blueprint('anniversary', __name__)
 
+# 新增纪念日时根据日期和重复规则计算下一次日期
+def _default_next_date(context):
+    params = context.get_current_parameters()
+    return next_occurrence(params['date'], params.get('recurrence') or RECURRENCE_NONE, date.today())
+
 # 定义纪念日模型
 def init_anniversary_model(db):
     class Anniversary(db.Model):
         id = db.Column(db.Integer, primary_key=True)
-        title = db.Column(db.String(100), nullable=False)
+        title = db.Column(db.String(100), nullable=False, index=True)
         date = db.Column(db.Date, nullable=False)
         icon = db.Column(db.String(50), nullable=False)
         icon_color = db.Column(db.String(20), default='')
         card_color = db.Column(db.String(20), nullable=False)
         is_future = db.Column(db.Boolean, default=False)
         sort_order = db.Column(db.Integer, default=0, nullable=False)  # 添加排序字段
+        recurrence = db.Column(db.String(20), default=RECURRENCE_NONE, server_default=RECURRENCE_NONE, nullable=False)  # 重复规则
+        next_date = db.Column(db.Date, index=True, default=_default_next_date)  # 预先计算的下一次日期，每天刷新一次
+
+        # 排序值唯一索引，批量排序时由数据库保证不重复
+        __table_args__ = (db.Index('ix_anniversary_sort_order', 'sort_order', unique=True),)
     
     return Anniversary
 
+# 记录本进程上次刷新下一次日期是哪一天（多租户时每个租户一份）
+def _next_date_refreshed_on():
+    return tenant_extensions().setdefault('next_date_refreshed_on', {'date': None})
+
+# 数据被整体替换（恢复备份、导入）后，让下一个请求重新刷新
+def invalidate_next_dates():
+    _next_date_refreshed_on()['date'] = None
+
+# 恋爱开始日期取自该标题的纪念日
+RELATIONSHIP_START_TITLE = '我们在一起啦'
+
+# 获取恋爱开始日期，按纪念日数据版本缓存；没有该纪念日时返回None
+def get_relationship_start_date(db, Anniversary):
+    def load():
+        return db.session.execute(
+            db.select(Anniversary.date).where(Anniversary.title == RELATIONSHIP_START_TITLE).limit(1)
+        ).scalar()
+
+    return cached_by_data_version(db, 'anniversary', 'relationship_start_date', load)
+
+# 刷新已经过去的重复纪念日的下一次日期，只在日期变化后执行
+def refresh_next_dates(db, Anniversary, today=None):
+    today = today or date.today()
+    stale = Anniversary.query.filter(
+        db.or_(Anniversary.next_date.is_(None),
+               db.and_(Anniversary.next_date < today, Anniversary.recurrence != RECURRENCE_NONE))
+    ).all()
+    for anniversary in stale:
+        anniversary.next_date = next_occurrence(anniversary.date, anniversary.recurrence, today)
+    if stale:
+        db.session.commit()
+    return len(stale)
+
+# 请求是否由管理页面的脚本发出（Accept: application/json），是则返回JSON，否则按表单提交重定向
+def _wants_json():
+    return request.accept_mimetypes.best == 'application/json'
+
+# 返回增删改的结果：脚本请求返回消息和变化的数据（如渲染好的表格行），表单提交重定向回管理页面
+def _mutation_response(message, message_type='success', **changes):
+    if _wants_json():
+        return jsonify({'success': message_type == 'success', 'message': message, **changes})
+    return redirect(url_for('anniversary.admin_anniversaries', message=message, message_type=message_type))
+
+# 渲染一行纪念日表格（与管理页面使用同一个模板）
+def _render_row(anniversary):
+    return render_template('_anniversary_row.html', anniversary=anniversary)
+
+# 生成"还有N天"/"过了N天"的显示文本，只用预先计算好的下一次日期做减法
+def format_days_text(anniversary, today):
+    if anniversary.recurrence != RECURRENCE_NONE and anniversary.next_date:
+        days_diff = (anniversary.next_date - today).days
+        return '就是今天' if days_diff == 0 else f"还有{days_diff}天"
+    if anniversary.is_future and anniversary.date >= today:
+        # 未来日期
+        return f"还有{(anniversary.date - today).days}天"
+    # 过去日期（包括已经过去的未来日期）
+    return f"过了{(today - anniversary.date).days}天"
+
+# 从表单读取重复规则
+def _get_recurrence(form):
+    recurrence = form.get('recurrence', RECURRENCE_NONE)
+    if recurrence not in RECURRENCE_RULES:
+        raise ValueError(f'不支持的重复规则: {recurrence}')
+    return recurrence
+
+# 批量写入排序值：一条 UPDATE ... CASE 语句完成
+# SQLite逐行检查唯一索引，直接交换两个排序值会冲突，因此先写入临时值 新值-偏移量，再把这些记录加回偏移量。
+# 偏移量使临时值小于所有现有排序值和新排序值（用户可以设置负数排序值），两步都不会与其他记录冲突
+def apply_sort_orders(db, Anniversary, order_map):
+    table = Anniversary.__table__
+    lowest = db.session.execute(db.select(db.func.min(table.c.sort_order))).scalar()
+    lowest = min([*order_map.values()] + ([lowest] if lowest is not None else []))
+    offset = max(order_map.values()) - lowest + 1
+    ids = list(order_map)
+    result = db.session.execute(
+        table.update()
+        .where(table.c.id.in_(ids))
+        .values(sort_order=db.case(order_map, value=table.c.id) - offset)
+    )
+    db.session.execute(
+        table.update()
+        .where(table.c.id.in_(ids))
+        .values(sort_order=table.c.sort_order + offset)
+    )
+    return result.rowcount
+
+# 把纪念日移动到目标纪念日的位置，只重新编号两者之间的区间
+# 返回区间内所有被修改的 {id: 新排序值}
+def move_sort_order(db, Anniversary, anniversary_id, target_id):
+    table = Anniversary.__table__
+    rows = db.session.execute(
+        db.select(table.c.id, table.c.sort_order).where(table.c.id.in_([anniversary_id, target_id]))
+    ).all()
+    current = {row.id: row.sort_order for row in rows}
+    if anniversary_id not in current or target_id not in current:
+        return None
+
+    old_order = current[anniversary_id]
+    new_order = current[target_id]
+    if old_order == new_order:
+        return {}
+
+    if old_order < new_order:
+        # 向下移动：区间 (old, new] 内的记录排序值减一
+        in_range, step = db.and_(table.c.sort_order > old_order, table.c.sort_order <= new_order), -1
+    else:
+        # 向上移动：区间 [new, old) 内的记录排序值加一
+        in_range, step = db.and_(table.c.sort_order >= new_order, table.c.sort_order < old_order), 1
+    order_map = {row.id: row.sort_order + step
+                 for row in db.session.execute(db.select(table.c.id, table.c.sort_order).where(in_range))}
+    order_map[anniversary_id] = new_order
+    apply_sort_orders(db, Anniversary, order_map)
+    return order_map
+
 # 注册路由函数到蓝图
 def register_anniversary_routes(bp, db, Anniversary):
+    # 日期变化后的第一个请求刷新重复纪念日的下一次日期
+    @bp.before_app_request
+    def refresh_upcoming_index():
+        today = date.today()
+        refreshed_on = _next_date_refreshed_on()
+        if refreshed_on['date'] != today:
+            refresh_next_dates(db, Anniversary, today)
+            refreshed_on['date'] = today
+
     # 后台管理页面
     @bp.route('/admin_anniversaries')
     def admin_anniversaries():
@@ -62,6 +199,7 @@ def register_anniversary_routes(bp, db, Anniversary):
         # 将排序信息传递给模板
         return render_template('admin_anniversaries.html', 
                             anniversaries=anniversaries, 
+                            recurrence_choices=RECURRENCE_CHOICES, 
                             message=message, 
                             message_type=message_type,
                             current_sort=sort_by,
@@ -77,6 +215,7 @@ def register_anniversary_routes(bp, db, Anniversary):
             icon_color = request.form.get('icon_color', '')
             card_color = request.form['card_color']
             is_future = 'is_future' in request.form
+            recurrence = _get_recurrence(request.form)
             
             # 转换日期字符串为date对象
             date_obj = datetime.datetime.strptime(date_str, '%Y-%m-%d').date()
@@ -92,31 +231,30 @@ def register_anniversary_routes(bp, db, Anniversary):
                 icon_color=icon_color,
                 card_color=card_color,
                 is_future=is_future,
+                recurrence=recurrence,
                 sort_order=max_sort_order + 1  # 设置默认排序值
             )
             
             # 添加到数据库
             db.session.add(new_anniversary)
+            bump_data_version(db, 'anniversary')
             db.session.commit()
             
-            return redirect(url_for('anniversary.admin_anniversaries', message='纪念日添加成功！', message_type='success'))
+            return _mutation_response('纪念日添加成功！', id=new_anniversary.id,
+                                      sort_order=new_anniversary.sort_order, html=_render_row(new_anniversary))
         except Exception as e:
-            return redirect(url_for('anniversary.admin_anniversaries', message=f'添加失败：{str(e)}', message_type='error'))
+            db.session.rollback()
+            return _mutation_response(f'添加失败：{str(e)}', 'error')
 
-    # 获取纪念日数据（用于编辑）
+    # 获取纪念日数据（用于编辑），支持 ?fields= 只返回部分字段
     @bp.route('/admin/get/<int:id>')
     def get_anniversary(id):
+        try:
+            fields = parse_fields('anniversary')
+        except ValueError as e:
+            return jsonify({'success': False, 'message': str(e)}), 400
         anniversary = Anniversary.query.get_or_404(id)
-        return jsonify({
-            'id': anniversary.id,
-            'title': anniversary.title,
-            'date': anniversary.date.strftime('%Y-%m-%d'),
-            'icon': anniversary.icon,
-            'icon_color': anniversary.icon_color,
-            'card_color': anniversary.card_color,
-            'is_future': anniversary.is_future,
-            'sort_order': anniversary.sort_order
-        })
+        return api_response(serialize(anniversary, 'anniversary', fields))
 
     # 编辑纪念日
     @bp.route('/admin/edit/<int:id>', methods=['POST'])
@@ -124,18 +262,9 @@ def register_anniversary_routes(bp, db, Anniversary):
         try:
             anniversary = Anniversary.query.get_or_404(id)
             
-            # 获取表单中的排序值
+            # 获取表单中的排序值（是否重复由唯一索引检查）
             new_sort_order = int(request.form['sort_order'])
             
-            # 检查排序值是否与其他记录重复
-            existing_anniversary = Anniversary.query.filter(
-                Anniversary.id != id,
-                Anniversary.sort_order == new_sort_order
-            ).first()
-            
-            if existing_anniversary:
-                return redirect(url_for('anniversary.admin_anniversaries', message='排序值已存在，请选择其他排序值', message_type='error'))
-            
             # 检查是否是默认的"我们在一起啦"纪念日，如果是则不允许修改标题
             if anniversary.title == '我们在一起啦':
                 # 标题保持不变，只更新其他字段
@@ -145,6 +274,7 @@ def register_anniversary_routes(bp, db, Anniversary):
                 anniversary.icon_color = request.form.get('icon_color', '')
                 anniversary.card_color = request.form['card_color']
                 anniversary.is_future = 'is_future' in request.form
+                anniversary.recurrence = _get_recurrence(request.form)
                 anniversary.sort_order = new_sort_order
             else:
                 # 更新所有字段
@@ -155,29 +285,41 @@ def register_anniversary_routes(bp, db, Anniversary):
                 anniversary.icon_color = request.form.get('icon_color', '')
                 anniversary.card_color = request.form['card_color']
                 anniversary.is_future = 'is_future' in request.form
+                anniversary.recurrence = _get_recurrence(request.form)
                 anniversary.sort_order = new_sort_order
             
+            # 重新计算下一次日期
+            anniversary.next_date = next_occurrence(anniversary.date, anniversary.recurrence, date.today())
+            bump_data_version(db, 'anniversary')
+            
             db.session.commit()
             
-            return redirect(url_for('anniversary.admin_anniversaries', message='纪念日更新成功！', message_type='success'))
+            return _mutation_response('纪念日更新成功！', id=anniversary.id,
+                                      sort_order=anniversary.sort_order, html=_render_row(anniversary))
+        except IntegrityError:
+            db.session.rollback()
+            return _mutation_response('排序值已存在，请选择其他排序值', 'error')
         except Exception as e:
-            return redirect(url_for('anniversary.admin_anniversaries', message=f'更新失败：{str(e)}', message_type='error'))
+            db.session.rollback()
+            return _mutation_response(f'更新失败：{str(e)}', 'error')
 
     # 删除纪念日
-    @bp.route('/admin/delete/<int:id>')
+    @bp.route('/admin/delete/<int:id>', methods=['GET', 'POST'])
     def delete_anniversary(id):
         try:
             anniversary = Anniversary.query.get_or_404(id)
             
             # 检查是否是默认的"我们在一起啦"纪念日，如果是则不允许删除
             if anniversary.title == '我们在一起啦':
-                return redirect(url_for('anniversary.admin_anniversaries', message='默认纪念日不可删除', message_type='error'))
+                return _mutation_response('默认纪念日不可删除', 'error')
             
             db.session.delete(anniversary)
+            bump_data_version(db, 'anniversary')
             db.session.commit()
-            return redirect(url_for('anniversary.admin_anniversaries', message='纪念日删除成功！', message_type='success'))
+            return _mutation_response('纪念日删除成功！', id=id)
         except Exception as e:
-            return redirect(url_for('anniversary.admin_anniversaries', message=f'删除失败：{str(e)}', message_type='error'))
+            db.session.rollback()
+            return _mutation_response(f'删除失败：{str(e)}', 'error')
 
     # 更新纪念日排序
     @bp.route('/admin/update_order', methods=['POST'])
@@ -191,16 +333,63 @@ def register_anniversary_routes(bp, db, Anniversary):
             if len(sort_orders) != len(set(sort_orders)):
                 return jsonify({'success': False, 'message': '排序值有重复，请重新排序'})
             
-            # 更新数据库中的排序值
-            for item in order_data:
-                anniversary = Anniversary.query.get_or_404(item['id'])
-                anniversary.sort_order = item['sort_order']
+            # 一条语句批量更新数据库中的排序值
+            order_map = {int(item['id']): int(item['sort_order']) for item in order_data}
+            if order_map:
+                updated = apply_sort_orders(db, Anniversary, order_map)
+                if updated != len(order_map):
+                    db.session.rollback()
+                    return jsonify({'success': False, 'message': '排序更新失败：纪念日不存在'})
                 
+            bump_data_version(db, 'anniversary')
             db.session.commit()
             return jsonify({'success': True, 'message': '排序更新成功！'})
+        except IntegrityError:
+            db.session.rollback()
+            return jsonify({'success': False, 'message': '排序值与其他纪念日重复，请重新排序'})
         except Exception as e:
+            db.session.rollback()
             return jsonify({'success': False, 'message': f'排序更新失败：{str(e)}'})
 
+    # 移动纪念日到目标位置（拖拽排序）
+    @bp.route('/admin/move_anniversary', methods=['POST'])
+    def move_anniversary():
+        try:
+            data = request.get_json()
+            changed = move_sort_order(db, Anniversary, int(data['id']), int(data['target_id']))
+            if changed is None:
+                return jsonify({'success': False, 'message': '纪念日不存在'})
+            
+            bump_data_version(db, 'anniversary')
+            db.session.commit()
+            return jsonify({
+                'success': True,
+                'message': '排序更新成功！',
+                'changed': [{'id': id, 'sort_order': order} for id, order in changed.items()]
+            })
+        except Exception as e:
+            db.session.rollback()
+            return jsonify({'success': False, 'message': f'排序更新失败：{str(e)}'})
+
+    # 获取即将到来的纪念日，直接按下一次日期索引查询
+    @bp.route('/api/anniversaries/upcoming')
+    def get_upcoming_anniversaries():
+        limit = min(request.args.get('limit', 10, type=int), 100)
+        today = date.today()
+        anniversaries = Anniversary.query.filter(Anniversary.next_date >= today) \
+            .order_by(Anniversary.next_date.asc()).limit(limit).all()
+        return jsonify([{
+            'id': anniversary.id,
+            'title': anniversary.title,
+            'date': anniversary.date.strftime('%Y-%m-%d'),
+            'next_date': anniversary.next_date.strftime('%Y-%m-%d'),
+            'days': (anniversary.next_date - today).days,
+            'recurrence': anniversary.recurrence,
+            'icon': anniversary.icon,
+            'icon_color': anniversary.icon_color,
+            'card_color': anniversary.card_color
+        } for anniversary in anniversaries])
+
     # 获取最大排序值
     @bp.route('/admin/get_max_sort_order')
     def get_max_sort_order():
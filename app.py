@@ -1,103 +1,197 @@
-# 修改文件开头的导入部分
 import datetime
-from flask import Flask, render_template, request, redirect, url_for, jsonify
-from flask_sqlalchemy import SQLAlchemy
-from datetime import date
 import os
-from werkzeug.utils import secure_filename
-from flask import Blueprint  # 添加这行导入
+from datetime import date
+from flask import Flask, render_template, current_app, jsonify
+from flask_sqlalchemy import SQLAlchemy
 
 # 导入纪念日管理模块
-from anniversaries import anniversary_bp, init_anniversary_model, register_anniversary_routes
+from anniversaries import anniversary_bp, init_anniversary_model, register_anniversary_routes, format_days_text, \
+    get_relationship_start_date
 # 导入基础信息管理模块
-from basic_info import basic_info_bp, init_basic_info_model, register_basic_info_routes
-# 导入附件管理模块
-from attachments import attachments_bp, init_attachment_model, register_attachment_routes
+from basic_info import basic_info_bp, init_basic_info_model, register_basic_info_routes, get_user_info
+# 导入附件管理模块（附件模型被多个模块使用，路由延迟加载）
+from attachments import init_attachment_model
 # 导入点滴瞬间模块
-from moments import moments_bp, init_moment_model, register_moment_routes
-
-# 导入备份模块
-from backup import backup_bp, register_backup_routes
-
-app = Flask(__name__)
-# 配置SQLite数据库
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///anniversaries.db'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+from moments import moments_bp, init_moment_model, register_moment_routes, get_on_this_day
+# 导入数据导出/导入模块
+from data_export import data_export_bp, register_data_export_routes
+# 导入日历订阅模块
+from calendar_feed import calendar_feed_bp, register_calendar_feed_routes
+# 导入数据版本模块
+from data_versions import init_data_version_model
+# 导入延迟加载蓝图
+from lazy_blueprints import LazyBlueprint
+# 导入性能指标模块
+from metrics import metrics_bp, init_metrics, register_metrics_routes
+# 导入慢查询日志
+from slow_queries import slow_queries_bp, init_slow_query_log, register_slow_query_routes
+# 导入后台任务模块
+from jobs import jobs_bp, init_job_model, init_job_queue, register_job_routes
+# 导入SQLite连接配置
+from sqlite_engine import init_sqlite_engine, WriteQueueTimeout
+# 导入数据库迁移
+from migrations import run_migrations
+# 导入静态资源指纹和预压缩
+from static_assets import init_static_assets
+# 导入多租户支持
+from tenants import TenantSession, init_tenants
+# 导入数据库维护
+from db_maintenance import db_maintenance_bp, init_db_maintenance, register_db_maintenance_routes
+# 导入上传准入控制
+from upload_limits import init_upload_limits
+# 导入旧附件打包存储（打包任务和感知哈希在任务执行时才导入）
+from pack_storage import init_pack_storage
 
 # 文件上传配置
 UPLOAD_FOLDER = 'static/uploads'
+UPLOAD_SUBFOLDERS = ('moments', 'basic_info')
 
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+# 创建数据库对象，在 create_app() 中绑定到应用（多租户时会话按当前租户选择数据库）
+db = SQLAlchemy(session_options={'class_': TenantSession})
 
-# 确保上传目录存在
-if not os.path.exists(UPLOAD_FOLDER):
-    os.makedirs(UPLOAD_FOLDER)
+# 初始化模型（模型定义不依赖应用实例）
+Anniversary = init_anniversary_model(db)
+UserInfo = init_basic_info_model(db)
+Attachment = init_attachment_model(db)
+Moment = init_moment_model(db)
+DataVersion = init_data_version_model(db)
+Job = init_job_model(db)
 
-# 确保点滴瞬间图片目录存在
-if not os.path.exists(os.path.join(UPLOAD_FOLDER, 'moments')):
-    os.makedirs(os.path.join(UPLOAD_FOLDER, 'moments'))
-    
-# 确保基础信息图片目录存在
-if not os.path.exists(os.path.join(UPLOAD_FOLDER, 'basic_info')):
-    os.makedirs(os.path.join(UPLOAD_FOLDER, 'basic_info'))
-
-# 初始化数据库
-# 确保这里使用正确的方式初始化数据库
-# 注意：这里需要确保先有db对象才能初始化模型
-# 因此，我们先创建db对象
-from flask_sqlalchemy import SQLAlchemy
+# 注册路由到蓝图，每个进程只注册一次，蓝图可以注册到多个应用
+# 视图中使用 current_app 读取配置，因此这里传入 current_app 代理
+anniversary_bp = register_anniversary_routes(anniversary_bp, db, Anniversary)
+basic_info_bp = register_basic_info_routes(basic_info_bp, current_app, db, UserInfo, Attachment)
+moments_bp = register_moment_routes(moments_bp, current_app, db, Moment, Attachment)
+data_export_bp = register_data_export_routes(data_export_bp, current_app, db, Anniversary, UserInfo, Attachment, Moment)
+calendar_feed_bp = register_calendar_feed_routes(calendar_feed_bp, db, Anniversary)
+metrics_bp = register_metrics_routes(metrics_bp)
+slow_queries_bp = register_slow_query_routes(slow_queries_bp)
+jobs_bp = register_job_routes(jobs_bp, db, Job)
+db_maintenance_bp = register_db_maintenance_routes(db_maintenance_bp, db, Job)
 
-# 创建数据库对象
-from flask_sqlalchemy import SQLAlchemy
 
-# 创建db对象
-# 确保这是在Flask应用创建之后，但在模型初始化之前
-# 在实际应用中，应该避免重复导入，这里只是为了确保代码的完整性
-from flask_sqlalchemy import SQLAlchemy
+# 备份模块只在后台使用，首次访问时才导入
+def _load_backup_routes(bp):
+    from backup import register_backup_routes
+    return register_backup_routes(bp, current_app, db)
 
-db = SQLAlchemy(app)
 
-# 初始化纪念日模型
-Anniversary = init_anniversary_model(db)
+# 附件管理路由只在后台使用，首次访问时才注册
+def _load_attachment_routes(bp):
+    from attachments import register_attachment_routes
+    return register_attachment_routes(bp, current_app, db, Attachment, UserInfo, Anniversary)
 
-# 注册纪念日相关路由到蓝图并注册蓝图到应用
-anniversary_bp = register_anniversary_routes(anniversary_bp, db, Anniversary)
-app.register_blueprint(anniversary_bp)
 
-# 初始化基础信息模型
-UserInfo = init_basic_info_model(db)
+# 批量导入点滴瞬间只在后台使用，首次访问时才导入（导入模块会加载进程池和Pillow）
+def _load_moment_import_routes(bp):
+    from moment_import import register_moment_import_routes
+    return register_moment_import_routes(bp)
 
-# 初始化附件模型
-Attachment = init_attachment_model(db)
 
-# 初始化点滴瞬间模型
-Moment = init_moment_model(db)
+# 静态导出的管理接口，首次访问时才导入
+def _load_static_export_routes(bp):
+    from static_export import register_static_export_routes
+    return register_static_export_routes(bp)
+
+
+# 延迟加载的后台蓝图：URL规则需要与模块中的路由保持一致
+LAZY_BLUEPRINTS = [
+    LazyBlueprint('backup', [
+        ('/admin/backup', 'backup', ['GET']),
+        ('/backup/backup', 'backup', ['GET']),
+        ('/admin/start_backup', 'start_backup', ['POST']),
+        ('/admin/backup_file/<int:job_id>', 'download_backup', ['GET']),
+        ('/admin/restore', 'restore', ['POST']),
+        ('/backup/restore', 'restore', ['POST']),
+        ('/admin_backup', 'admin_backup', ['GET']),
+    ], _load_backup_routes),
+    LazyBlueprint('attachments', [
+        ('/admin_attachments', 'admin_attachments', ['GET']),
+        ('/admin/upload_attachment', 'upload_attachment', ['POST']),
+        ('/admin/delete_attachment/<int:attachment_id>', 'delete_attachment', ['DELETE']),
+        ('/admin/update_attachment_reference/<int:attachment_id>', 'update_attachment_reference', ['POST']),
+        ('/admin/batch_delete_unreferenced', 'batch_delete_unreferenced', ['POST']),
+        ('/admin/scan_attachments', 'scan_attachments', ['POST']),
+        ('/admin/attachments/hash_images', 'hash_images', ['POST']),
+        ('/admin/attachments/similar', 'similar_attachments', ['GET']),
+        ('/admin/attachments/pack', 'pack_attachments', ['POST']),
+    ], _load_attachment_routes),
+    LazyBlueprint('moment_import', [
+        ('/admin/moments/import', 'start_import', ['POST']),
+    ], _load_moment_import_routes),
+    LazyBlueprint('static_export', [
+        ('/admin/static_export', 'start_static_export', ['POST']),
+    ], _load_static_export_routes),
+]
+
+
+# 后台任务：任务函数所在的模块在任务第一次执行时才导入
+def _scan_attachments_job(context):
+    from attachments import scan_attachment_references
+    return scan_attachment_references(current_app, db, Attachment, UserInfo, context)
+
+
+def _delete_unreferenced_attachments_job(context):
+    from attachments import delete_unreferenced_attachments
+    return delete_unreferenced_attachments(current_app, db, Attachment, context)
+
+
+def _hash_images_job(context):
+    from image_hash import backfill_image_hashes
+    return backfill_image_hashes(current_app, db, Attachment, context)
+
 
-# 注册基础信息相关路由到蓝图并注册蓝图到应用
-basic_info_bp = register_basic_info_routes(basic_info_bp, app, db, UserInfo, Attachment)
-app.register_blueprint(basic_info_bp)
+def _pack_attachments_job(context):
+    from pack_storage import pack_old_attachments
+    return pack_old_attachments(current_app, db, Attachment, context)
 
-# 注册附件相关路由到蓝图并注册蓝图到应用
-attachments_bp = register_attachment_routes(attachments_bp, app, db, Attachment, UserInfo, Anniversary)
-app.register_blueprint(attachments_bp)
 
-# 注册点滴瞬间相关路由到蓝图并注册蓝图到应用
-moments_bp = register_moment_routes(moments_bp, app, db, Moment, Attachment)
-app.register_blueprint(moments_bp)
+def _db_maintenance_job(context):
+    from db_maintenance import run_maintenance
+    return run_maintenance(current_app, db, full=bool(context.params.get('full')), context=context)
+
+
+def _backup_job(context):
+    from backup import run_backup_job
+    return run_backup_job(current_app, db, context)
+
+
+def _restore_job(context):
+    from backup import run_restore_job
+    return run_restore_job(current_app, db, context)
+
+
+def _import_moments_job(context):
+    from moment_import import run_import_job
+    return run_import_job(current_app, db, Moment, Attachment, context)
+
+
+def _static_export_job(context):
+    from static_export import run_static_export_job
+    return run_static_export_job(current_app, db, Moment, Attachment, context)
+
+
+JOB_HANDLERS = {
+    'scan_attachments': _scan_attachments_job,
+    'delete_unreferenced_attachments': _delete_unreferenced_attachments_job,
+    'hash_images': _hash_images_job,
+    'pack_attachments': _pack_attachments_job,
+    'db_maintenance': _db_maintenance_job,
+    'backup': _backup_job,
+    'restore': _restore_job,
+    'static_export': _static_export_job,
+    'import_moments': _import_moments_job,
+}
 
-# 注册备份相关路由到蓝图并注册蓝图到应用
-backup_bp = register_backup_routes(backup_bp, app, db)
-app.register_blueprint(backup_bp)
 
 # 更新首页路由，安全地获取UserInfo数据
-@app.route('/')
 def home():
-    # 从数据库中读取title为"我们在一起啦"的纪念日日期
-    relationship_start = Anniversary.query.filter_by(title='我们在一起啦').first()
+    # 读取title为"我们在一起啦"的纪念日日期（按数据版本缓存，数据未修改时不查询）
+    relationship_start_date = get_relationship_start_date(db, Anniversary)
     
-    if relationship_start:
+    if relationship_start_date:
         # 如果找到记录，使用该记录的日期
-        start_date = datetime.datetime.combine(relationship_start.date, datetime.time.min)
+        start_date = datetime.datetime.combine(relationship_start_date, datetime.time.min)
     else:
         # 如果没有找到记录，使用默认日期作为后备方案
         start_date = datetime.datetime(2020, 1, 30)
@@ -113,31 +207,19 @@ def home():
     # 计算开始日期的时间戳并转换为毫秒
     start_timestamp = int(start_date.timestamp() * 1000)
     
-    # 安全地获取用户信息
-    user_info = None
-    try:
-        user_info = UserInfo.query.first()
-    except Exception:
-        pass
-    
-    # 如果没有用户信息，使用默认值
-    if not user_info:
-        user_info = UserInfo()
+    # 获取用户信息（按数据版本缓存，没有记录时为默认值）
+    user_info = get_user_info(db, UserInfo)
     
     # 从数据库获取所有纪念日
     anniversaries = Anniversary.query.order_by(Anniversary.sort_order.asc()).all()
     
-    # 计算每个纪念日距离今天的天数
+    # 计算每个纪念日距离今天的天数（重复纪念日使用预先计算的下一次日期）
     today = date.today()
     for anniv in anniversaries:
-        if anniv.is_future:
-            # 未来日期
-            days_diff = (anniv.date - today).days
-            anniv.days_text = f"还有{days_diff}天"
-        else:
-            # 过去日期
-            days_diff = (today - anniv.date).days
-            anniv.days_text = f"过了{days_diff}天"
+        anniv.days_text = format_days_text(anniv, today)
+    
+    # 那年今日（按日期缓存）
+    on_this_day = get_on_this_day(db, Moment, today)
     
     return render_template('index.html',
                           love_days=love_days,
@@ -146,19 +228,123 @@ def home():
                           seconds=seconds,
                           start_timestamp=start_timestamp,
                           anniversaries=anniversaries,
+                          on_this_day=on_this_day,
                           user_info=user_info)  # 保留用户信息传递
                           
 # 后台管理主页
-@app.route('/admin')
 def admin():
     # 直接渲染admin页面，不再重定向
     return render_template('admin.html')
 
-if __name__ == '__main__':
-    # 创建数据库表
+
+# 等待写队列超时，返回503让客户端稍后重试
+def write_queue_timeout(e):
+    return jsonify({'success': False, 'message': str(e)}), 503, {'Retry-After': '5'}
+
+
+def create_app(config=None):
+    """
+    创建并配置Flask应用
+    配合 gunicorn --preload 使用时只在主进程中执行一次，工作进程通过fork共享
+    :param config: 覆盖默认配置的字典（可选）
+    :return: Flask应用实例
+    """
+    app = Flask(__name__)
+    # 配置SQLite数据库，可通过环境变量 LOVEBLOG_DATABASE_URI 指定其他数据库文件
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('LOVEBLOG_DATABASE_URI', 'sqlite:///anniversaries.db')
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+    # 多进程部署时各工作进程的性能指标快照目录，未设置时只统计当前进程
+    app.config['METRICS_DIR'] = os.environ.get('LOVEBLOG_METRICS_DIR')
+    # 慢查询日志：耗时超过多少毫秒的SQL语句连同查询计划写入日志（0表示不记录），以及日志文件路径
+    app.config['SLOW_QUERY_THRESHOLD_MS'] = float(os.environ.get('LOVEBLOG_SLOW_QUERY_THRESHOLD_MS', 100))
+    app.config['SLOW_QUERY_LOG'] = os.environ.get('LOVEBLOG_SLOW_QUERY_LOG') or os.path.join(app.instance_path, 'slow_queries.log')
+    # 每个进程执行后台任务的线程数，使用独立的任务进程（python jobs.py）时可设为0
+    app.config['JOB_WORKER_THREADS'] = int(os.environ.get('LOVEBLOG_JOB_WORKER_THREADS', 1))
+    # 感知哈希的汉明距离不超过该值的图片视为相似
+    app.config['IMAGE_SIMILAR_DISTANCE'] = int(os.environ.get('LOVEBLOG_IMAGE_SIMILAR_DISTANCE', 8))
+    # 上传超过多少天的附件由打包任务移入打包文件
+    app.config['PACK_AFTER_DAYS'] = int(os.environ.get('LOVEBLOG_PACK_AFTER_DAYS', 90))
+    # 批量导入点滴瞬间时处理图片的进程数，未设置时为CPU核数
+    app.config['IMPORT_WORKERS'] = int(os.environ.get('LOVEBLOG_IMPORT_WORKERS', 0)) or None
+    # 上传准入控制：同时处理的上传数、上传中的总字节数、排队数和排队等待时间（秒），各工作进程共用
+    app.config['UPLOAD_MAX_CONCURRENT'] = int(os.environ.get('LOVEBLOG_UPLOAD_MAX_CONCURRENT', 1))
+    app.config['UPLOAD_MAX_BYTES_IN_FLIGHT'] = int(os.environ.get('LOVEBLOG_UPLOAD_MAX_BYTES_IN_FLIGHT', 512 * 1024 * 1024))
+    app.config['UPLOAD_QUEUE_SIZE'] = int(os.environ.get('LOVEBLOG_UPLOAD_QUEUE_SIZE', 2))
+    app.config['UPLOAD_QUEUE_TIMEOUT'] = float(os.environ.get('LOVEBLOG_UPLOAD_QUEUE_TIMEOUT', 5))
+    app.config['UPLOAD_LOCK_DIR'] = os.environ.get('LOVEBLOG_UPLOAD_LOCK_DIR') or os.path.join(app.instance_path, 'upload_slots')
+    # 数据库维护：距上次维护超过多少小时（0表示不自动维护）、且空闲多少秒后自动执行
+    app.config['MAINTENANCE_INTERVAL_HOURS'] = float(os.environ.get('LOVEBLOG_MAINTENANCE_INTERVAL_HOURS', 24))
+    app.config['MAINTENANCE_QUIET_SECONDS'] = int(os.environ.get('LOVEBLOG_MAINTENANCE_QUIET_SECONDS', 300))
+    # 静态网站导出目录，设置后每次修改数据都会增量导出前台页面（python static_export.py）
+    app.config['STATIC_EXPORT_DIR'] = os.environ.get('LOVEBLOG_STATIC_EXPORT_DIR')
+    # 多租户：host（按域名）或 path（按路径前缀），未设置时为单租户
+    app.config['TENANT_MODE'] = os.environ.get('LOVEBLOG_TENANT_MODE')
+    app.config['TENANT_DOMAIN'] = os.environ.get('LOVEBLOG_TENANT_DOMAIN')
+    app.config['TENANTS_DIR'] = os.environ.get('LOVEBLOG_TENANTS_DIR') or os.path.join(app.instance_path, 'tenants')
+    if config:
+        app.config.update(config)
+
+    # 确保上传目录存在
+    for subfolder in UPLOAD_SUBFOLDERS:
+        os.makedirs(os.path.join(app.config['UPLOAD_FOLDER'], subfolder), exist_ok=True)
+
+    db.init_app(app)
+    # 设置SQLite连接参数（WAL等）并启用串行化写队列
+    init_sqlite_engine(app, db)
+    # 统计每个端点的请求耗时、SQL语句和响应大小
+    init_metrics(app, db)
+    # 启用慢查询日志
+    init_slow_query_log(app)
+    # 后台任务队列（工作线程在第一次提交任务或gunicorn工作进程启动时启动）
+    init_job_queue(app, db, Job, JOB_HANDLERS)
+    # 空闲时定期维护数据库（归还空闲页、ANALYZE、WAL检查点）
+    init_db_maintenance(app, db, Job)
+    # 静态资源使用构建好的指纹文件名和预压缩版本（python static_assets.py）
+    init_static_assets(app)
+    # 修改数据后增量导出静态网站（设置了 STATIC_EXPORT_DIR 时才导入导出模块）
+    if app.config.get('STATIC_EXPORT_DIR'):
+        from static_export import init_static_export
+        init_static_export(app)
+    # 多租户：请求开始时切换到对应租户的数据库（需在注册蓝图之前，先于其他请求钩子执行）
+    init_tenants(app, db)
+    # 已打包的附件从打包文件中读取
+    init_pack_storage(app, db, Attachment)
+    # 上传接口限制请求体大小和同时处理的上传数
+    init_upload_limits(app)
+
+    # 注册蓝图到应用
+    app.register_blueprint(anniversary_bp)
+    app.register_blueprint(basic_info_bp)
+    app.register_blueprint(moments_bp)
+    app.register_blueprint(data_export_bp)
+    app.register_blueprint(calendar_feed_bp)
+    app.register_blueprint(metrics_bp)
+    app.register_blueprint(slow_queries_bp)
+    app.register_blueprint(jobs_bp)
+    app.register_blueprint(db_maintenance_bp)
+    for lazy_blueprint in LAZY_BLUEPRINTS:
+        lazy_blueprint.init_app(app)
+
+    app.add_url_rule('/', 'home', home)
+    app.add_url_rule('/admin', 'admin', admin)
+    app.register_error_handler(WriteQueueTimeout, write_queue_timeout)
+
+    # 创建缺少的数据表，并执行未执行的数据库迁移
     with app.app_context():
         db.create_all()
-        
+        run_migrations(db)
+        # 关闭启动时打开的连接，fork出的工作进程不能共享SQLite连接
+        db.engine.dispose()
+
+    return app
+
+
+app = create_app()
+
+if __name__ == '__main__':
+    # 数据库表已在 create_app() 中创建
+    with app.app_context():
         # 检查是否已经存在"我们在一起啦"的纪念日
         relationship_anniversary = Anniversary.query.filter_by(title='我们在一起啦').first()
         
@@ -1,8 +1,10 @@
-from flask_sqlalchemy import SQLAlchemy
 import datetime
 import os
 from werkzeug.utils import secure_filename
 from flask import Blueprint, request, jsonify, render_template
+from jobs import enqueue_job
+from tenants import get_upload_folder, resolve_upload_path
+from serializers import parse_fields, serialize, api_response
 
 # 创建蓝图
 attachments_bp = Blueprint('attachments', __name__)
@@ -21,11 +23,20 @@ def init_attachment_model(db):
     class Attachment(db.Model):
         id = db.Column(db.Integer, primary_key=True)
         filename = db.Column(db.String(255), nullable=False)
-        filepath = db.Column(db.String(255), nullable=False)
+        filepath = db.Column(db.String(255), nullable=False, index=True)
         size = db.Column(db.Integer, nullable=False)  # 文件大小，以字节为单位
-        upload_date = db.Column(db.DateTime, default=datetime.datetime.now)
-        is_referenced = db.Column(db.Boolean, default=False)
+        upload_date = db.Column(db.DateTime, default=datetime.datetime.now, index=True)
+        is_referenced = db.Column(db.Boolean, default=False, index=True)
         referenced_count = db.Column(db.Integer, default=0)
+        # 图片的感知哈希（16位十六进制），用于查找相似图片；空字符串表示无法计算，NULL表示尚未计算
+        phash = db.Column(db.String(16), nullable=True)
+        # 已移入打包文件的附件：打包文件名、偏移和长度（原文件已删除），未打包时为NULL
+        pack_file = db.Column(db.String(64), nullable=True)
+        pack_offset = db.Column(db.Integer, nullable=True)
+        pack_length = db.Column(db.Integer, nullable=True)
+
+        # 删除的附件ID不再复用：各进程的相似图片索引按ID增量更新，复用的ID会沿用已删除图片的哈希
+        __table_args__ = {'sqlite_autoincrement': True}
     
     return Attachment
 
@@ -55,6 +66,127 @@ def format_size(size_bytes):
     else:
         return f"{size_bytes / (1024 * 1024 * 1024):.2f} GB"
 
+# 删除未引用的附件（后台任务）
+def delete_unreferenced_attachments(app, db, Attachment, context=None):
+    """
+    删除所有未引用的附件文件和记录
+    :param context: 后台任务上下文（可选），用于报告进度和检查取消
+    :return: 包含结果消息的字典
+    """
+    # 查找所有未引用的附件
+    unreferenced_attachments = Attachment.query.filter_by(is_referenced=False).all()
+    
+    if not unreferenced_attachments:
+        return {'message': '没有未引用的文件需要删除', 'deleted': 0}
+    
+    # 记录删除的文件数量
+    deleted_count = 0
+    total = len(unreferenced_attachments)
+    
+    # 删除每个未引用的附件
+    for index, attachment in enumerate(unreferenced_attachments):
+        if context:
+            context.check_cancelled()
+            context.report(index * 100 // total, f'正在删除 {index}/{total}')
+        
+        # 检查文件是否存在并删除
+        file_path = resolve_upload_path(app, attachment.filepath)
+        if os.path.exists(file_path):
+            os.remove(file_path)
+            deleted_count += 1
+        
+        # 从数据库中删除记录
+        db.session.delete(attachment)
+    
+    db.session.commit()
+    
+    return {'message': f'成功删除了{deleted_count}个未引用的文件', 'deleted': deleted_count}
+
+# 扫描附件引用状态（后台任务）
+def scan_attachment_references(app, db, Attachment, UserInfo=None, context=None):
+    """
+    扫描并更新附件的引用状态
+    同时检查static/uploads目录下的所有文件，更新或创建数据库记录
+    :param context: 后台任务上下文（可选），用于报告进度和检查取消
+    :return: 包含结果消息的字典
+    """
+    # 1. 首先扫描static/uploads目录下的所有文件，更新或创建数据库记录
+    uploads_dir = resolve_upload_path(app, '/static/uploads')
+    if os.path.exists(uploads_dir):
+        # 获取数据库中所有附件记录
+        db_attachments = {os.path.basename(a.filepath): a for a in Attachment.query.all()}
+        
+        # 遍历uploads目录下的所有文件
+        filenames = os.listdir(uploads_dir)
+        for index, filename in enumerate(filenames):
+            if context:
+                context.check_cancelled()
+                context.report(index * 50 // len(filenames), '正在扫描上传目录')
+            
+            file_path = os.path.join(uploads_dir, filename)
+            if os.path.isfile(file_path):
+                # 计算文件大小
+                file_size = os.path.getsize(file_path)
+                
+                # 构建数据库中的filepath
+                db_filepath = f"/static/uploads/{filename}"
+                
+                # 检查文件是否已在数据库中
+                if filename in db_attachments:
+                    # 更新现有记录
+                    attachment = db_attachments[filename]
+                    attachment.size = file_size
+                    # 保留现有的引用状态
+                else:
+                    # 创建新记录
+                    attachment = Attachment(
+                        filename=filename,
+                        filepath=db_filepath,
+                        size=file_size,
+                        upload_date=datetime.datetime.now(),
+                        is_referenced=False,
+                        referenced_count=0
+                    )
+                    db.session.add(attachment)
+        
+        # 2. 删除数据库中有记录但实际文件不存在的附件
+        for index, (filename, attachment) in enumerate(db_attachments.items()):
+            if context:
+                context.check_cancelled()
+                context.report(50 + index * 40 // len(db_attachments), '正在检查附件文件')
+            
+            file_path = resolve_upload_path(app, attachment.filepath)
+            # 已打包的附件没有单独的文件
+            if attachment.pack_file is None and not os.path.exists(file_path):
+                db.session.delete(attachment)
+    
+    # 之后的步骤不再检查取消，避免只更新了一部分引用状态
+    if context:
+        context.check_cancelled()
+        context.report(90, '正在更新引用状态')
+    
+    # 3. 重置所有附件的引用状态
+    Attachment.query.update({Attachment.is_referenced: False, Attachment.referenced_count: 0})
+    
+    # 4. 检查UserInfo模型中的引用（头像1、头像2、壁纸）
+    if UserInfo:
+        referenced_paths = []
+        for user_info in UserInfo.query.all():
+            for path in (user_info.avatar1, user_info.avatar2, user_info.banner):
+                if path and path.startswith('/static/uploads/'):
+                    referenced_paths.append(path)
+        
+        # 一次查询所有被引用的附件，同一文件被引用多次时引用计数相应增加
+        if referenced_paths:
+            attachments = Attachment.query.filter(Attachment.filepath.in_(list(set(referenced_paths)))).all()
+            for attachment in attachments:
+                attachment.is_referenced = True
+                attachment.referenced_count += referenced_paths.count(attachment.filepath)
+    
+    db.session.commit()
+    
+    return {'message': '附件状态检测完成，已更新数据库'}
+
 # 注册路由函数到蓝图
 def register_attachment_routes(bp, app, db, Attachment, UserInfo=None, Anniversary=None):
     """
@@ -67,12 +199,13 @@ def register_attachment_routes(bp, app, db, Attachment, UserInfo=None, Anniversa
     :param Anniversary: Anniversary模型类（可选）
     :return: 已注册路由的蓝图
     """
-    # 确保上传目录存在
-    if not os.path.exists(UPLOAD_FOLDER):
-        os.makedirs(UPLOAD_FOLDER)
-    
+    # 感知哈希依赖Pillow，附件管理路由由延迟加载的蓝图注册，第一次访问时才导入
+    from image_hash import compute_image_hash, find_similar_attachments, get_image_hash_index, \
+        is_image_path, DEFAULT_SIMILAR_DISTANCE
+
+    # 上传目录由 create_app() 统一创建
     # 添加文件大小格式化过滤器到模板
-    @app.template_filter('format_size')
+    @bp.app_template_filter('format_size')
     def format_size_filter(size_bytes):
         return format_size(size_bytes)
     
@@ -111,6 +244,10 @@ def register_attachment_routes(bp, app, db, Attachment, UserInfo=None, Anniversa
         """
         上传附件接口
         """
+        try:
+            fields = parse_fields('attachment')
+        except ValueError as e:
+            return jsonify({'success': False, 'message': str(e)}), 400
         try:
             # 检查是否有文件部分
             if 'file' not in request.files:
@@ -131,11 +268,15 @@ def register_attachment_routes(bp, app, db, Attachment, UserInfo=None, Anniversa
                 unique_filename = f"{timestamp}_{filename}"
                 
                 # 保存文件
-                filepath = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
+                filepath = os.path.join(get_upload_folder(app), unique_filename)
                 file.save(filepath)
                 
                 # 获取文件大小
                 file_size = os.path.getsize(filepath)
+                # 计算感知哈希，检查是否已经上传过相似的照片
+                image_hash = compute_image_hash(filepath)
+                similar = find_similar_attachments(db, Attachment, image_hash,
+                                                   app.config.get('IMAGE_SIMILAR_DISTANCE', DEFAULT_SIMILAR_DISTANCE))
                 
                 # 创建附件记录
                 attachment = Attachment(
@@ -144,21 +285,21 @@ def register_attachment_routes(bp, app, db, Attachment, UserInfo=None, Anniversa
                     size=file_size,
                     upload_date=datetime.datetime.now(),
                     is_referenced=False,
-                    referenced_count=0
+                    referenced_count=0,
+                    phash=image_hash
                 )
                 db.session.add(attachment)
                 db.session.commit()
                 
-                return jsonify({
+                message = '文件上传成功'
+                if similar:
+                    message += f'，你已经有 {len(similar)} 张相似的照片'
+                return api_response({
                     'success': True,
-                    'message': '文件上传成功',
-                    'attachment': {
-                        'id': attachment.id,
-                        'filename': attachment.filename,
-                        'filepath': attachment.filepath,
-                        'size': attachment.size,
-                        'upload_date': attachment.upload_date.isoformat()
-                    }
+                    'message': message,
+                    'attachment': serialize(attachment, 'attachment', fields),
+                    'similar': [dict(serialize(other, 'attachment', fields), distance=distance)
+                                for distance, other in similar]
                 })
             else:
                 return jsonify({'success': False, 'message': '不支持的文件类型'})
@@ -176,7 +317,7 @@ def register_attachment_routes(bp, app, db, Attachment, UserInfo=None, Anniversa
             attachment = Attachment.query.get_or_404(attachment_id)
             
             # 检查文件是否存在并删除
-            file_path = os.path.join(app.root_path, attachment.filepath.lstrip('/'))
+            file_path = resolve_upload_path(app, attachment.filepath)
             if os.path.exists(file_path):
                 os.remove(file_path)
             
@@ -215,122 +356,93 @@ def register_attachment_routes(bp, app, db, Attachment, UserInfo=None, Anniversa
         except Exception as e:
             return jsonify({'success': False, 'message': str(e)})
     
-    # 批量删除未引用的附件
+    # 批量删除未引用的附件（提交后台任务）
     @bp.route('/admin/batch_delete_unreferenced', methods=['POST'])
     def batch_delete_unreferenced():
         """
-        批量删除未引用的附件接口
+        批量删除未引用的附件接口，返回任务ID，通过 /admin/jobs/<任务ID> 查询进度
         """
         try:
-            # 查找所有未引用的附件
-            unreferenced_attachments = Attachment.query.filter_by(is_referenced=False).all()
-            
-            if not unreferenced_attachments:
-                return jsonify({'success': True, 'message': '没有未引用的文件需要删除'})
-            
-            # 记录删除的文件数量
-            deleted_count = 0
-            
-            # 删除每个未引用的附件
-            for attachment in unreferenced_attachments:
-                # 检查文件是否存在并删除
-                file_path = os.path.join(app.root_path, attachment.filepath.lstrip('/'))
-                if os.path.exists(file_path):
-                    os.remove(file_path)
-                    deleted_count += 1
-                
-                # 从数据库中删除记录
-                db.session.delete(attachment)
-            
-            db.session.commit()
-            
-            return jsonify({'success': True, 'message': f'成功删除了{deleted_count}个未引用的文件'})
+            job = enqueue_job('delete_unreferenced_attachments')
+            return jsonify({'success': True, 'message': '已开始删除未引用的文件', 'job_id': job.id})
         except Exception as e:
             return jsonify({'success': False, 'message': str(e)})
     
-    # 扫描附件引用状态
+    # 扫描附件引用状态（提交后台任务）
     @bp.route('/admin/scan_attachments', methods=['POST'])
     def scan_attachments():
         """
-        扫描并更新附件的引用状态
-        同时检查static/uploads目录下的所有文件，更新或创建数据库记录
+        扫描并更新附件的引用状态，返回任务ID，通过 /admin/jobs/<任务ID> 查询进度
         """
         try:
-            # 1. 首先扫描static/uploads目录下的所有文件，更新或创建数据库记录
-            uploads_dir = os.path.join(app.root_path, 'static', 'uploads')
-            if os.path.exists(uploads_dir):
-                # 获取数据库中所有附件记录
-                db_attachments = {os.path.basename(a.filepath): a for a in Attachment.query.all()}
-                
-                # 遍历uploads目录下的所有文件
-                for filename in os.listdir(uploads_dir):
-                    file_path = os.path.join(uploads_dir, filename)
-                    if os.path.isfile(file_path):
-                        # 计算文件大小
-                        file_size = os.path.getsize(file_path)
-                        
-                        # 构建数据库中的filepath
-                        db_filepath = f"/static/uploads/{filename}"
-                        
-                        # 检查文件是否已在数据库中
-                        if filename in db_attachments:
-                            # 更新现有记录
-                            attachment = db_attachments[filename]
-                            attachment.size = file_size
-                            # 保留现有的引用状态
-                        else:
-                            # 创建新记录
-                            attachment = Attachment(
-                                filename=filename,
-                                filepath=db_filepath,
-                                size=file_size,
-                                upload_date=datetime.datetime.now(),
-                                is_referenced=False,
-                                referenced_count=0
-                            )
-                            db.session.add(attachment)
-                
-                # 2. 删除数据库中有记录但实际文件不存在的附件
-                for filename, attachment in db_attachments.items():
-                    file_path = os.path.join(app.root_path, attachment.filepath.lstrip('/'))
-                    if not os.path.exists(file_path):
-                        db.session.delete(attachment)
-            
-            # 3. 重置所有附件的引用状态
-            Attachment.query.update({Attachment.is_referenced: False, Attachment.referenced_count: 0})
-            
-            # 4. 检查UserInfo模型中的引用
-            if UserInfo:
-                user_infos = UserInfo.query.all()
-                for user_info in user_infos:
-                    # 检查头像1引用
-                    if user_info.avatar1 and user_info.avatar1.startswith('/static/uploads/'):
-                        filename = user_info.avatar1.split('/')[-1]
-                        attachment = Attachment.query.filter_by(filepath=user_info.avatar1).first()
-                        if attachment:
-                            attachment.is_referenced = True
-                            attachment.referenced_count += 1
-                    
-                    # 检查头像2引用
-                    if user_info.avatar2 and user_info.avatar2.startswith('/static/uploads/'):
-                        filename = user_info.avatar2.split('/')[-1]
-                        attachment = Attachment.query.filter_by(filepath=user_info.avatar2).first()
-                        if attachment:
-                            attachment.is_referenced = True
-                            attachment.referenced_count += 1
-                    
-                    # 检查壁纸引用
-                    if user_info.banner and user_info.banner.startswith('/static/uploads/'):
-                        filename = user_info.banner.split('/')[-1]
-                        attachment = Attachment.query.filter_by(filepath=user_info.banner).first()
-                        if attachment:
-                            attachment.is_referenced = True
-                            attachment.referenced_count += 1
-            
-            db.session.commit()
-            
-            return jsonify({'success': True, 'message': '附件状态检测完成，已更新数据库'})
+            job = enqueue_job('scan_attachments')
+            return jsonify({'success': True, 'message': '已开始检测附件状态', 'job_id': job.id})
+        except Exception as e:
+            return jsonify({'success': False, 'message': str(e)})
+    
+    # 为已有的图片附件补算感知哈希（提交后台任务）
+    @bp.route('/admin/attachments/hash_images', methods=['POST'])
+    def hash_images():
+        """
+        计算还没有感知哈希的图片附件，返回任务ID，通过 /admin/jobs/<任务ID> 查询进度
+        """
+        try:
+            job = enqueue_job('hash_images')
+            return jsonify({'success': True, 'message': '已开始计算图片哈希', 'job_id': job.id})
+        except Exception as e:
+            return jsonify({'success': False, 'message': str(e)})
+    
+    # 把旧附件移入打包文件
+    @bp.route('/admin/attachments/pack', methods=['POST'])
+    def pack_attachments():
+        """
+        打包上传超过 PACK_AFTER_DAYS 天的附件，返回任务ID，通过 /admin/jobs/<任务ID> 查询进度
+        """
+        try:
+            job = enqueue_job('pack_attachments')
+            return jsonify({'success': True, 'message': '已开始打包旧附件', 'job_id': job.id})
         except Exception as e:
             return jsonify({'success': False, 'message': str(e)})
     
+    # 查找相似图片
+    @bp.route('/admin/attachments/similar')
+    def similar_attachments():
+        """
+        ?attachment_id=ID 返回与该附件相似的图片，不指定时返回所有相似图片分组
+        ?distance=N 汉明距离阈值，默认为配置 IMAGE_SIMILAR_DISTANCE
+        """
+        try:
+            fields = parse_fields('attachment')
+            distance = request.args.get('distance', app.config.get('IMAGE_SIMILAR_DISTANCE', DEFAULT_SIMILAR_DISTANCE),
+                                        type=int)
+        except ValueError as e:
+            return jsonify({'success': False, 'message': str(e)}), 400
+
+        attachment_id = request.args.get('attachment_id', type=int)
+        if attachment_id is not None:
+            attachment = Attachment.query.get_or_404(attachment_id)
+            similar = find_similar_attachments(db, Attachment, attachment.phash, distance, exclude_id=attachment.id)
+            return api_response({
+                'success': True,
+                'attachment': serialize(attachment, 'attachment', fields),
+                'similar': [dict(serialize(other, 'attachment', fields), distance=d) for d, other in similar]
+            })
+
+        index = get_image_hash_index(db, Attachment)
+        groups = index.groups(distance)
+        attachments = {}
+        if groups:
+            ids = [attachment_id for group in groups for attachment_id in group]
+            attachments = {a.id: a for a in Attachment.query.filter(Attachment.id.in_(ids))}
+        # 还没有计算哈希的图片数量，提示先执行补算任务
+        unhashed = sum(1 for (filepath,) in db.session.execute(
+            db.select(Attachment.filepath).where(Attachment.phash.is_(None))
+        ) if is_image_path(filepath))
+        return api_response({
+            'success': True,
+            'groups': [[serialize(attachments[i], 'attachment', fields) for i in group if i in attachments]
+                       for group in groups if sum(i in attachments for i in group) > 1],
+            'unhashed': unhashed
+        })
+    
     return bp
\ No newline at end of file
@@ -3,10 +3,17 @@ import shutil
 import json
 import datetime
 import zipfile
-from flask import Blueprint, send_file, request, redirect, url_for, current_app, render_template
-from flask_sqlalchemy import SQLAlchemy
+from flask import Blueprint, send_file, request, redirect, url_for, current_app, render_template, jsonify
 import tempfile
 import sqlite3
+from werkzeug.utils import secure_filename
+from anniversaries import invalidate_next_dates
+from migrations import run_migrations
+from data_versions import bump_data_version, DATA_VERSION_NAMES
+from jobs import enqueue_job, JOB_SUCCEEDED
+from pack_storage import get_pack_folder
+from tenants import (activate_tenant, create_tables, current_tenant, current_tenant_name, get_database_path,
+                     get_upload_folder)
 
 # 创建备份蓝图
 backup_bp = Blueprint('backup', __name__)
@@ -14,88 +21,269 @@ backup_bp = Blueprint('backup', __name__)
 # 初始化备份模块
 # 这里不需要创建模型，因为我们只需要操作现有的数据库
 
+# 后台任务生成的备份文件保留的数量
+BACKUP_KEEP_COUNT = 5
+
+# 使用SQLite在线备份接口复制数据库
+# WAL模式下直接复制数据库文件会丢失还在-wal文件中的数据，覆盖正在使用的数据库文件也会损坏数据库
+def copy_sqlite_database(source_path, target_path):
+    source = sqlite3.connect(source_path)
+    target = sqlite3.connect(target_path)
+    try:
+        source.backup(target)
+    finally:
+        target.close()
+        source.close()
+
+# 后台任务生成的备份文件和待恢复的上传文件所在目录（多租户时在租户目录中）
+def get_backup_folder(app):
+    tenant = current_tenant()
+    if tenant is not None:
+        folder = tenant.backup_folder
+    else:
+        folder = app.config.get('BACKUP_FOLDER') or os.path.join(app.instance_path, 'backups')
+    os.makedirs(folder, exist_ok=True)
+    return folder
+
+# 备份中不保存后台任务记录，恢复后不会重新执行备份时正在运行的任务
+def _clear_jobs(db_path):
+    connection = sqlite3.connect(db_path)
+    try:
+        if connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'job'").fetchone():
+            connection.execute('DELETE FROM job')
+            connection.commit()
+    finally:
+        connection.close()
+
+# 生成备份压缩包（数据库 + 附件文件 + 备份信息）
+def create_backup_archive(app, db, backup_filepath, context=None):
+    """
+    :param backup_filepath: 生成的zip文件路径
+    :param context: 后台任务上下文（可选），用于报告进度和检查取消
+    :return: 备份信息字典
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        timestamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+
+        # 创建zip文件
+        zipf = zipfile.ZipFile(backup_filepath, 'w', zipfile.ZIP_DEFLATED)
+        try:
+            # 1. 备份数据库
+            db_name = "anniversaries.db"
+
+            # 使用应用实际连接的数据库文件（默认为instance目录中的anniversaries.db）
+            db_path = get_database_path(db)
+
+            # 添加详细的调试日志
+            app.logger.info(f'数据库路径: {db_path}')
+            app.logger.info(f'数据库文件是否存在: {os.path.exists(db_path)}')
+
+            # 检查数据库文件是否存在
+            if not os.path.exists(db_path):
+                raise FileNotFoundError(f"数据库文件不存在: {db_path}")
+
+            if context:
+                context.report(0, '正在备份数据库')
+
+            # 复制数据库文件到临时目录
+            temp_db_path = os.path.join(temp_dir, f'db_backup_{timestamp}.sqlite')
+            copy_sqlite_database(db_path, temp_db_path)
+            _clear_jobs(temp_db_path)
+            app.logger.info(f'数据库文件已复制到临时目录: {temp_db_path}')
+
+            # 将数据库文件添加到zip文件
+            zipf.write(temp_db_path, f'database/{db_name}')
+            app.logger.info(f'数据库文件已添加到zip文件: database/{db_name}')
+
+            # 2. 备份附件文件
+            upload_folder = get_upload_folder(app)
+            if os.path.exists(upload_folder):
+                # 打包文件按顺序整体写入且不再压缩（其中多为已压缩的图片），其余文件逐个写入
+                pack_folder = get_pack_folder(app)
+                pack_paths = sorted(os.path.join(pack_folder, name) for name in os.listdir(pack_folder)) \
+                    if os.path.isdir(pack_folder) else []
+                for pack_path in pack_paths:
+                    if context:
+                        context.check_cancelled()
+                        context.report(10, f'正在备份打包文件 {os.path.basename(pack_path)}')
+                    zipf.write(pack_path, f'attachments/{os.path.relpath(pack_path, upload_folder)}',
+                               compress_type=zipfile.ZIP_STORED)
+                file_paths = [os.path.join(root, file) for root, dirs, files in os.walk(upload_folder)
+                              if os.path.abspath(root) != os.path.abspath(pack_folder) for file in files]
+                for index, file_path in enumerate(file_paths):
+                    if context:
+                        context.check_cancelled()
+                        context.report(10 + index * 85 // len(file_paths), f'正在备份附件 {index}/{len(file_paths)}')
+                    # 计算相对路径，以便在zip中保持目录结构
+                    rel_path = os.path.relpath(file_path, upload_folder)
+                    zipf.write(file_path, f'attachments/{rel_path}')
+
+            # 3. 添加备份信息文件
+            backup_info = {
+                'backup_time': datetime.datetime.now().isoformat(),
+                'app_name': 'Love Blog',
+                'backup_version': '1.0',
+                'database_path': db_path,
+                'upload_folder': upload_folder
+            }
+
+            # 将备份信息写入文件并添加到zip
+            info_file_path = os.path.join(temp_dir, 'backup_info.json')
+            with open(info_file_path, 'w', encoding='utf-8') as f:
+                json.dump(backup_info, f, ensure_ascii=False, indent=4)
+
+            zipf.write(info_file_path, 'backup_info.json')
+        finally:
+            # 确保zip文件正确关闭
+            zipf.close()
+
+    return backup_info
+
+# 从备份压缩包恢复数据库和附件文件
+def restore_backup_archive(app, db, backup_file_path, context=None):
+    """
+    :param backup_file_path: 备份zip文件路径
+    :param context: 后台任务上下文（可选），开始替换数据库之前可以取消
+    :raises ValueError: 备份文件中没有数据库
+    """
+    # 创建临时目录用于解压备份文件
+    with tempfile.TemporaryDirectory() as temp_dir:
+        if context:
+            context.report(0, '正在解压备份文件')
+
+        # 解压备份文件
+        extract_dir = os.path.join(temp_dir, 'extracted')
+        os.makedirs(extract_dir)
+
+        with zipfile.ZipFile(backup_file_path, 'r') as zipf:
+            zipf.extractall(extract_dir)
+
+        # 1. 恢复数据库
+        # 确定数据库文件路径 - 使用应用实际连接的数据库文件
+        db_name = "anniversaries.db"
+        db_path = get_database_path(db)
+        # 确保数据库所在目录存在
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+
+        db_filename = db_name
+
+        # 数据库备份文件路径
+        backup_db_path = os.path.join(extract_dir, 'database', db_filename)
+
+        if not os.path.exists(backup_db_path):
+            raise ValueError('备份文件中未找到数据库')
+
+        # 开始替换数据后不能再取消，否则数据库和附件会不一致
+        if context:
+            context.check_cancelled()
+            context.report(30, '正在恢复数据库')
+
+        # 关闭数据库连接
+        db.session.close()
+
+        # 将备份的数据库写入原数据库
+        copy_sqlite_database(backup_db_path, db_path)
+
+        # 2. 恢复附件文件
+        if context:
+            context.report(50, '正在恢复附件')
+        upload_folder = get_upload_folder(app)
+        backup_attachments_dir = os.path.join(extract_dir, 'attachments')
+
+        # 如果上传目录不存在，则创建
+        if not os.path.exists(upload_folder):
+            os.makedirs(upload_folder)
+        else:
+            # 清空现有附件目录
+            for root, dirs, files in os.walk(upload_folder):
+                for file in files:
+                    os.remove(os.path.join(root, file))
+
+        # 复制备份的附件文件
+        if os.path.exists(backup_attachments_dir):
+            for root, dirs, files in os.walk(backup_attachments_dir):
+                for dir in dirs:
+                    # 确保目标目录存在
+                    os.makedirs(os.path.join(upload_folder, dir), exist_ok=True)
+                for file in files:
+                    source_path = os.path.join(root, file)
+                    # 计算目标路径
+                    rel_path = os.path.relpath(source_path, backup_attachments_dir)
+                    target_path = os.path.join(upload_folder, rel_path)
+                    # 复制文件
+                    shutil.copy2(source_path, target_path)
+
+        # 重新打开数据库连接（新的应用上下文需要重新切换到当前租户）
+        tenant = current_tenant()
+        with app.app_context():
+            if tenant is not None:
+                activate_tenant(tenant)
+            create_tables(db)
+            # 旧版本备份的数据库需要升级表结构
+            run_migrations(db)
+            invalidate_next_dates()
+            # 数据已整体替换，更新所有数据版本让各进程的缓存失效
+            bump_data_version(db, *DATA_VERSION_NAMES)
+            db.session.commit()
+
+# 备份后台任务：备份文件保存在备份目录中，完成后通过 /admin/backup_file/<任务ID> 下载
+def run_backup_job(app, db, context):
+    backup_folder = get_backup_folder(app)
+    timestamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+    backup_filename = f'loveblog_backup_{timestamp}.zip'
+    backup_filepath = os.path.join(backup_folder, backup_filename)
+    try:
+        create_backup_archive(app, db, backup_filepath, context)
+    except BaseException:
+        if os.path.exists(backup_filepath):
+            os.remove(backup_filepath)
+        raise
+
+    # 只保留最近的几个备份文件
+    backups = sorted(name for name in os.listdir(backup_folder)
+                     if name.startswith('loveblog_backup_') and name.endswith('.zip'))
+    for name in backups[:-BACKUP_KEEP_COUNT]:
+        os.remove(os.path.join(backup_folder, name))
+
+    return {
+        'message': '备份完成',
+        'filename': backup_filename,
+        'size': os.path.getsize(backup_filepath)
+    }
+
+# 恢复后台任务：恢复上传后保存在备份目录中的文件，完成后删除该文件
+def run_restore_job(app, db, context):
+    backup_file_path = os.path.join(get_backup_folder(app), secure_filename(context.params['filename']))
+    try:
+        restore_backup_archive(app, db, backup_file_path, context)
+    finally:
+        if os.path.exists(backup_file_path):
+            os.remove(backup_file_path)
+    return {'message': '数据恢复成功'}
+
 def register_backup_routes(bp, app, db):
-    # 备份功能 - 简化和完善数据库路径处理
+    # 备份功能 - 直接在请求中生成并下载备份文件（数据较多时请使用后台备份）
     @bp.route('/admin/backup')
     @bp.route('/backup/backup')
     def backup():
         try:
             # 添加调试日志，记录请求已接收
             app.logger.info('接收到备份请求，开始备份过程...')
-            
+
             # 创建临时目录用于存储备份文件
             with tempfile.TemporaryDirectory() as temp_dir:
                 # 生成备份文件名，包含当前时间戳
                 timestamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
                 backup_filename = f'loveblog_backup_{timestamp}.zip'
                 backup_filepath = os.path.join(temp_dir, backup_filename)
-                
-                # 创建zip文件
-                zipf = zipfile.ZipFile(backup_filepath, 'w', zipfile.ZIP_DEFLATED)
-                try:
-                    # 1. 备份数据库
-                    db_name = "anniversaries.db"
-                    
-                    # 直接指定instance目录中的数据库文件
-                    current_dir = os.path.dirname(os.path.abspath(__file__))
-                    app.logger.info(f'当前文件目录: {current_dir}')
-                    
-                    instance_dir = os.path.join(current_dir, 'instance')
-                    db_path = os.path.join(instance_dir, db_name)
-                    
-                    # 添加详细的调试日志
-                    app.logger.info(f'构建的数据库路径: {db_path}')
-                    app.logger.info(f'当前工作目录: {os.getcwd()}')
-                    app.logger.info(f'instance目录是否存在: {os.path.exists(instance_dir)}')
-                    app.logger.info(f'数据库文件是否存在: {os.path.exists(db_path)}')
-                    
-                    # 检查数据库文件是否存在
-                    if not os.path.exists(db_path):
-                        raise FileNotFoundError(f"数据库文件不存在: {db_path}")
-                    
-                    # 复制数据库文件到临时目录
-                    temp_db_path = os.path.join(temp_dir, f'db_backup_{timestamp}.sqlite')
-                    shutil.copy2(db_path, temp_db_path)
-                    app.logger.info(f'数据库文件已复制到临时目录: {temp_db_path}')
-                    
-                    # 将数据库文件添加到zip文件
-                    zipf.write(temp_db_path, f'database/{db_name}')
-                    app.logger.info(f'数据库文件已添加到zip文件: database/{db_name}')
-                    
-                    # 2. 备份附件文件
-                    upload_folder = app.config['UPLOAD_FOLDER']
-                    if os.path.exists(upload_folder):
-                        for root, dirs, files in os.walk(upload_folder):
-                            for file in files:
-                                file_path = os.path.join(root, file)
-                                # 计算相对路径，以便在zip中保持目录结构
-                                rel_path = os.path.relpath(file_path, upload_folder)
-                                zipf.write(file_path, f'attachments/{rel_path}')
-                    
-                    # 3. 添加备份信息文件
-                    backup_info = {
-                        'backup_time': datetime.datetime.now().isoformat(),
-                        'app_name': 'Love Blog',
-                        'backup_version': '1.0',
-                        'database_path': db_path,
-                        'upload_folder': upload_folder
-                    }
-                    
-                    # 将备份信息写入文件并添加到zip
-                    info_file_path = os.path.join(temp_dir, 'backup_info.json')
-                    with open(info_file_path, 'w', encoding='utf-8') as f:
-                        json.dump(backup_info, f, ensure_ascii=False, indent=4)
-                    
-                    zipf.write(info_file_path, 'backup_info.json')
-                finally:
-                    # 确保zip文件正确关闭
-                    zipf.close()
-                
+
+                create_backup_archive(app, db, backup_filepath)
+
                 # 在Windows系统上，使用BytesIO避免文件锁定问题
                 from io import BytesIO
                 with open(backup_filepath, 'rb') as f:
                     backup_content = f.read()
-                    
+
                 # 发送生成的备份文件给用户下载
                 return send_file(
                     BytesIO(backup_content),
@@ -103,13 +291,36 @@ def register_backup_routes(bp, app, db):
                     download_name=backup_filename,
                     mimetype='application/zip'
                 )
-                
+
         except Exception as e:
             # 记录错误并返回错误消息
             app.logger.error(f'备份过程中发生错误: {str(e)}')
             return redirect(url_for('admin', message=f'备份失败: {str(e)}', message_type='error'))
-    
-    # 恢复功能
+
+    # 提交后台备份任务
+    @bp.route('/admin/start_backup', methods=['POST'])
+    def start_backup():
+        try:
+            job = enqueue_job('backup')
+            return jsonify({'success': True, 'message': '已开始备份', 'job_id': job.id})
+        except Exception as e:
+            return jsonify({'success': False, 'message': str(e)})
+
+    # 下载后台任务生成的备份文件
+    @bp.route('/admin/backup_file/<int:job_id>')
+    def download_backup(job_id):
+        job = current_app.extensions['job_queue'].Job.query.get_or_404(job_id)
+        if job.job_type != 'backup' or job.tenant != current_tenant_name() or job.status != JOB_SUCCEEDED:
+            return redirect(url_for('backup.admin_backup', message='备份尚未完成', message_type='danger'))
+
+        filename = secure_filename(json.loads(job.result)['filename'])
+        backup_filepath = os.path.join(get_backup_folder(app), filename)
+        if not os.path.exists(backup_filepath):
+            return redirect(url_for('backup.admin_backup', message='备份文件已被清理，请重新备份', message_type='danger'))
+
+        return send_file(backup_filepath, as_attachment=True, download_name=filename, mimetype='application/zip')
+
+    # 恢复功能 - 保存上传的备份文件后提交后台恢复任务
     @bp.route('/admin/restore', methods=['POST'])
     @bp.route('/backup/restore', methods=['POST'])
     def restore():
@@ -117,99 +328,40 @@ def register_backup_routes(bp, app, db):
             # 检查是否有文件部分
             if 'backup_file' not in request.files:
                 return redirect(url_for('admin', message='请选择备份文件', message_type='error'))
-            
+
             backup_file = request.files['backup_file']
-            
+
             # 如果用户没有选择文件，浏览器也会提交一个空的文件部分
             if backup_file.filename == '':
                 return redirect(url_for('admin', message='没有选择文件', message_type='error'))
-            
+
             # 检查文件类型是否为zip
             if not backup_file.filename.endswith('.zip'):
                 return redirect(url_for('admin', message='请选择有效的备份文件(.zip)', message_type='error'))
-            
-            # 创建临时目录用于解压备份文件
-            with tempfile.TemporaryDirectory() as temp_dir:
-                # 保存上传的备份文件
-                backup_file_path = os.path.join(temp_dir, 'temp_backup.zip')
-                backup_file.save(backup_file_path)
-                
-                # 解压备份文件
-                extract_dir = os.path.join(temp_dir, 'extracted')
-                os.makedirs(extract_dir)
-                
-                with zipfile.ZipFile(backup_file_path, 'r') as zipf:
-                    zipf.extractall(extract_dir)
-                
-                # 1. 恢复数据库
-                # 确定数据库文件路径 - 在Flask应用中，数据库通常位于instance目录
-                db_name = "anniversaries.db"
-                # 确保instance目录存在
-                instance_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance')
-                os.makedirs(instance_dir, exist_ok=True)
-                # 设置数据库路径为instance目录下的anniversaries.db
-                db_path = os.path.join(instance_dir, db_name)
-                
-                db_filename = db_name
-                
-                # 数据库备份文件路径
-                backup_db_path = os.path.join(extract_dir, 'database', db_filename)
-                
-                if not os.path.exists(backup_db_path):
-                    return redirect(url_for('admin', message='备份文件中未找到数据库', message_type='error'))
-                
-                # 关闭数据库连接
-                db.session.close()
-                
-                # 复制备份的数据库文件到原位置
-                shutil.copy2(backup_db_path, db_path)
-                
-                # 2. 恢复附件文件
-                upload_folder = app.config['UPLOAD_FOLDER']
-                backup_attachments_dir = os.path.join(extract_dir, 'attachments')
-                
-                # 如果上传目录不存在，则创建
-                if not os.path.exists(upload_folder):
-                    os.makedirs(upload_folder)
-                else:
-                    # 清空现有附件目录
-                    for root, dirs, files in os.walk(upload_folder):
-                        for file in files:
-                            os.remove(os.path.join(root, file))
-                
-                # 复制备份的附件文件
-                if os.path.exists(backup_attachments_dir):
-                    for root, dirs, files in os.walk(backup_attachments_dir):
-                        for dir in dirs:
-                            # 确保目标目录存在
-                            os.makedirs(os.path.join(upload_folder, dir), exist_ok=True)
-                        for file in files:
-                            source_path = os.path.join(root, file)
-                            # 计算目标路径
-                            rel_path = os.path.relpath(source_path, backup_attachments_dir)
-                            target_path = os.path.join(upload_folder, rel_path)
-                            # 复制文件
-                            shutil.copy2(source_path, target_path)
-                
-                # 重新打开数据库连接
-                with app.app_context():
-                    db.create_all()
-                
-                return redirect(url_for('admin', message='数据恢复成功', message_type='success'))
-                
+
+            # 保存上传的备份文件，由后台任务恢复
+            timestamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S_%f')
+            filename = f'restore_{timestamp}.zip'
+            backup_file.save(os.path.join(get_backup_folder(app), filename))
+
+            job = enqueue_job('restore', {'filename': filename})
+            return redirect(url_for('backup.admin_backup', message='已开始恢复数据，请等待恢复完成',
+                                    message_type='success', job_id=job.id))
+
         except Exception as e:
             # 记录错误并返回错误消息
             app.logger.error(f'恢复过程中发生错误: {str(e)}')
             return redirect(url_for('admin', message=f'恢复失败: {str(e)}', message_type='error'))
-    
+
     # 备份管理页面
     @bp.route('/admin_backup')
     def admin_backup():
         message = request.args.get('message')
         message_type = request.args.get('message_type', 'success')
-        
-        return render_template('admin_backup.html', 
-                              message=message, 
-                              message_type=message_type)
-    
-    return bp
\ No newline at end of file
+
+        return render_template('admin_backup.html',
+                              message=message,
+                              message_type=message_type,
+                              job_id=request.args.get('job_id', type=int))
+
+    return bp
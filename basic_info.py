@@ -1,9 +1,12 @@
 from flask import Blueprint, render_template, request, redirect, url_for, jsonify  # 添加Blueprint导入
-from flask_sqlalchemy import SQLAlchemy
 import datetime
 import os
 from werkzeug.utils import secure_filename
 from flask import Blueprint, request, jsonify
+from types import SimpleNamespace
+from data_versions import bump_data_version, cached_by_data_version
+from serializers import parse_fields, serialize, api_response
+from tenants import get_upload_folder
 
 # 创建蓝图
 basic_info_bp = Blueprint('basic_info', __name__)
@@ -24,6 +27,18 @@ def init_basic_info_model(db):
     
     return UserInfo
 
+# 用户信息中页面需要的字段
+USER_INFO_FIELDS = ('username1', 'username2', 'avatar1', 'avatar2', 'banner')
+
+# 获取用户信息（只有一条记录），按数据版本缓存，修改后其他进程在下一个请求中重新读取
+# 返回只包含 USER_INFO_FIELDS 的普通对象，不是模型实例
+def get_user_info(db, UserInfo):
+    def load():
+        user_info = UserInfo.query.first() or UserInfo()
+        return SimpleNamespace(**{field: getattr(user_info, field) for field in USER_INFO_FIELDS})
+
+    return cached_by_data_version(db, 'user_info', 'user_info', load)
+
 # 检查文件类型是否允许
 def allowed_file(filename):
     return '.' in filename and \
@@ -31,25 +46,22 @@ def allowed_file(filename):
 
 # 注册路由函数到蓝图
 def register_basic_info_routes(bp, app, db, UserInfo, Attachment):
-    # 确保上传目录存在
-    if not os.path.exists(UPLOAD_FOLDER):
-        os.makedirs(UPLOAD_FOLDER)
-        
-    # 获取基础信息
+    # 上传目录由 create_app() 统一创建
+    # 获取基础信息，支持 ?fields= 只返回部分字段
     @bp.route('/admin/get_basic_info')
     def get_basic_info():
-        user_info = UserInfo.query.first() or UserInfo()
-        return jsonify({
-            'username1': user_info.username1,
-            'username2': user_info.username2,
-            'avatar1': user_info.avatar1,
-            'avatar2': user_info.avatar2,
-            'banner': user_info.banner
-        })
+        try:
+            fields = parse_fields('user_info')
+        except ValueError as e:
+            return jsonify({'success': False, 'message': str(e)}), 400
+        return api_response(serialize(get_user_info(db, UserInfo), 'user_info', fields))
 
     # 更新基础信息
     @bp.route('/admin/update_basic_info', methods=['POST'])
     def update_basic_info():
+        # 感知哈希依赖Pillow，只在上传时导入
+        from image_hash import compute_image_hash
+
         try:
             # 获取现有的用户信息记录，如果没有则创建
             user_info = UserInfo.query.first()
@@ -71,7 +83,7 @@ def register_basic_info_routes(bp, app, db, UserInfo, Attachment):
                     unique_filename = f"avatar1_{timestamp}_{original_filename}"
                     
                     # 保存文件
-                    filepath = os.path.join(UPLOAD_FOLDER, unique_filename)
+                    filepath = os.path.join(get_upload_folder(app), 'basic_info', unique_filename)
                     file.save(filepath)
                     
                     # 获取文件大小
@@ -84,7 +96,8 @@ def register_basic_info_routes(bp, app, db, UserInfo, Attachment):
                         size=file_size,
                         upload_date=datetime.datetime.now(),
                         is_referenced=True,  # 标记为已引用
-                        referenced_count=1
+                        referenced_count=1,
+                        phash=compute_image_hash(filepath)
                     )
                     db.session.add(attachment)
                     db.session.flush()  # 确保attachment.id已生成
@@ -100,7 +113,7 @@ def register_basic_info_routes(bp, app, db, UserInfo, Attachment):
                     timestamp = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
                     unique_filename = f"avatar2_{timestamp}_{original_filename}"
                     
-                    filepath = os.path.join(UPLOAD_FOLDER, unique_filename)
+                    filepath = os.path.join(get_upload_folder(app), 'basic_info', unique_filename)
                     file.save(filepath)
                     
                     file_size = os.path.getsize(filepath)
@@ -112,7 +125,8 @@ def register_basic_info_routes(bp, app, db, UserInfo, Attachment):
                         size=file_size,
                         upload_date=datetime.datetime.now(),
                         is_referenced=True,  # 标记为已引用
-                        referenced_count=1
+                        referenced_count=1,
+                        phash=compute_image_hash(filepath)
                     )
                     db.session.add(attachment)
                     db.session.flush()
@@ -128,7 +142,7 @@ def register_basic_info_routes(bp, app, db, UserInfo, Attachment):
                     timestamp = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
                     unique_filename = f"banner_{timestamp}_{original_filename}"
                     
-                    filepath = os.path.join(UPLOAD_FOLDER, unique_filename)
+                    filepath = os.path.join(get_upload_folder(app), 'basic_info', unique_filename)
                     file.save(filepath)
                     
                     file_size = os.path.getsize(filepath)
@@ -140,7 +154,8 @@ def register_basic_info_routes(bp, app, db, UserInfo, Attachment):
                         size=file_size,
                         upload_date=datetime.datetime.now(),
                         is_referenced=True,  # 标记为已引用
-                        referenced_count=1
+                        referenced_count=1,
+                        phash=compute_image_hash(filepath)
                     )
                     db.session.add(attachment)
                     db.session.flush()
@@ -149,6 +164,7 @@ def register_basic_info_routes(bp, app, db, UserInfo, Attachment):
                     user_info.banner = f"/static/uploads/basic_info/{unique_filename}"
             
             # 提交更改到数据库
+            bump_data_version(db, 'user_info')
             db.session.commit()
             
             return jsonify({'success': True, 'message': '基础信息更新成功！'})
@@ -0,0 +1,2 @@
+# 性能测试
+# 在项目根目录运行，例如: python -m benchmarks.bench_startup
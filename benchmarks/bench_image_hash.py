@@ -0,0 +1,68 @@
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+# 相似图片索引查询性能测试
+# 生成随机哈希（其中一部分是在已有哈希上翻转少量位得到的"相似图片"），
+# 测试建立索引的耗时和单次查询的耗时
+# 用法: python -m benchmarks.bench_image_hash --images 100000 --distance 8
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='相似图片索引查询性能测试')
+    parser.add_argument('--images', type=int, default=100000)
+    parser.add_argument('--distance', type=int, default=8)
+    parser.add_argument('--queries', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    sys.path.insert(0, ROOT_DIR)
+    from image_hash import ImageHashIndex, HASH_BITS
+
+    rng = random.Random(args.seed)
+    hashes = []
+    for _ in range(args.images):
+        if hashes and rng.random() < 0.2:
+            # 与已有图片相似：翻转0~6位
+            image_hash = rng.choice(hashes)
+            for bit in rng.sample(range(HASH_BITS), rng.randint(0, 6)):
+                image_hash ^= 1 << bit
+        else:
+            image_hash = rng.getrandbits(HASH_BITS)
+        hashes.append(image_hash)
+
+    started = time.perf_counter()
+    index = ImageHashIndex()
+    for item_id, image_hash in enumerate(hashes, 1):
+        index.add(item_id, image_hash)
+    build_seconds = time.perf_counter() - started
+
+    queries = [rng.choice(hashes) for _ in range(args.queries)]
+    timings = []
+    found = 0
+    for image_hash in queries:
+        started = time.perf_counter()
+        found += len(index.search(image_hash, args.distance))
+        timings.append(time.perf_counter() - started)
+
+    # 与逐个比较对比（只测少量查询）
+    started = time.perf_counter()
+    for image_hash in queries[:20]:
+        [item_id for item_id, other in enumerate(hashes, 1) if (other ^ image_hash).bit_count() <= args.distance]
+    linear_ms = (time.perf_counter() - started) / 20 * 1000
+
+    timings.sort()
+    print(f'图片数 {args.images}，距离阈值 {args.distance}，建立索引 {build_seconds:.2f} 秒')
+    print(f'查询 median {statistics.median(timings) * 1000:.3f} ms  '
+          f'p99 {timings[int(len(timings) * 0.99) - 1] * 1000:.3f} ms  '
+          f'平均结果数 {found / len(queries):.1f}')
+    print(f'逐个比较 {linear_ms:.3f} ms/次')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+import argparse
+import datetime
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# 大数据量下的路由性能测试
+# 用 benchmarks.dataset 生成指定数量的点滴瞬间、图片、附件和纪念日（包括图片文件），
+# 通过Flask测试客户端重复请求各个路由，记录耗时和峰值内存（tracemalloc），结果可写入JSON文件，
+# 用 --compare 与之前的结果对比
+# 用法: python -m benchmarks.bench_routes --moments 5000 --json results.json
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# (名称, 请求方法, URL)，backup 的结果用作 restore 的上传文件
+BENCHMARKS = [
+    ('home', 'GET', '/'),
+    ('moments_list', 'GET', '/moments'),
+    ('moments_api', 'GET', '/api/moments'),
+    ('admin_attachments', 'GET', '/admin_attachments'),
+    ('scan_attachments', 'POST', '/admin/scan_attachments'),
+    ('backup', 'GET', '/admin/backup'),
+    ('restore', 'POST', '/admin/restore'),
+]
+
+
+def _prepare_site(site_dir):
+    """
+    创建临时的应用根目录：模板和静态资源链接到项目目录，上传目录是独立的空目录
+    扫描附件等功能按应用根目录查找文件，不会读写项目中的上传文件
+    """
+    os.makedirs(os.path.join(site_dir, 'static', 'uploads'))
+    os.symlink(os.path.join(ROOT_DIR, 'templates'), os.path.join(site_dir, 'templates'))
+    for name in os.listdir(os.path.join(ROOT_DIR, 'static')):
+        if name != 'uploads':
+            os.symlink(os.path.join(ROOT_DIR, 'static', name), os.path.join(site_dir, 'static', name))
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# 通过后台任务执行的路由：请求只提交任务，测试时在当前线程中执行完任务再计时结束
+JOB_BENCHMARKS = ('scan_attachments', 'restore')
+
+
+class RouteBenchmark:
+    def __init__(self, app):
+        self.app = app
+        self.client = app.test_client()
+        self.backup_content = None
+
+    def request(self, name, method, url):
+        kwargs = {}
+        if name == 'restore':
+            kwargs['data'] = {'backup_file': (io.BytesIO(self.backup_content), 'loveblog_backup.zip')}
+        response = self.client.open(url, method=method, **kwargs)
+        body = response.get_data()
+        # 备份和恢复失败时会重定向并带上错误消息
+        if response.status_code >= 400 or (response.status_code == 302 and 'error' in response.location):
+            raise RuntimeError(f'{name} 请求失败: {response.status_code} {response.location or ""}')
+        if name == 'backup':
+            self.backup_content = body
+        if name in JOB_BENCHMARKS:
+            job_queue = self.app.extensions['job_queue']
+            job_queue.run_pending()
+            with self.app.app_context():
+                job = job_queue.Job.query.order_by(job_queue.Job.id.desc()).first()
+                if job.status != 'succeeded':
+                    raise RuntimeError(f'{name} 任务失败: {job.message}')
+        return body
+
+    def run(self, name, method, url, runs):
+        # 预热一次，不计入结果
+        self.request(name, method, url)
+
+        timings = []
+        for _ in range(runs):
+            started = time.perf_counter()
+            self.request(name, method, url)
+            timings.append(time.perf_counter() - started)
+
+        # 单独测一次峰值内存，tracemalloc 本身会拖慢执行，不与耗时一起测
+        tracemalloc.start()
+        try:
+            self.request(name, method, url)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        return {
+            'runs': runs,
+            'median_ms': round(statistics.median(timings) * 1000, 3),
+            'min_ms': round(min(timings) * 1000, 3),
+            'max_ms': round(max(timings) * 1000, 3),
+            'peak_memory_kb': round(peak / 1024, 1),
+        }
+
+
+def print_results(results, previous=None):
+    for name, result in results.items():
+        line = (f"{name:<20} median {result['median_ms']:>10.3f} ms  (min {result['min_ms']:.3f}, "
+                f"max {result['max_ms']:.3f})  峰值内存 {result['peak_memory_kb']:>10.1f} KB")
+        if previous and name in previous:
+            old = previous[name]
+            if old['median_ms']:
+                line += f"  耗时 x{result['median_ms'] / old['median_ms']:.2f}"
+            if old['peak_memory_kb']:
+                line += f"  内存 x{result['peak_memory_kb'] / old['peak_memory_kb']:.2f}"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='大数据量下的路由性能测试')
+    parser.add_argument('--moments', type=int, default=2000)
+    parser.add_argument('--images-per-moment', type=int, default=3)
+    parser.add_argument('--extra-attachments', type=int, default=500)
+    parser.add_argument('--anniversaries', type=int, default=50)
+    parser.add_argument('--image-bytes', type=int, default=4096, help='生成的每个图片文件的大小')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--only', nargs='*', help='只运行指定的测试')
+    parser.add_argument('--json', dest='json_path', help='将结果写入JSON文件')
+    parser.add_argument('--compare', help='与之前写入的JSON结果对比')
+    args = parser.parse_args()
+    json_path = os.path.abspath(args.json_path) if args.json_path else None
+    previous = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            previous = json.load(f)['results']
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        site_dir = os.path.join(temp_dir, 'site')
+        _prepare_site(site_dir)
+        os.environ['LOVEBLOG_DATABASE_URI'] = 'sqlite:///' + os.path.join(temp_dir, 'bench.db')
+        os.chdir(temp_dir)
+        sys.path.insert(0, ROOT_DIR)
+
+        from app import create_app, db, Anniversary, UserInfo, Attachment, Moment
+        from benchmarks.dataset import seed_dataset
+
+        app = create_app({'TESTING': True, 'UPLOAD_FOLDER': os.path.join(site_dir, 'static', 'uploads'),
+                          'BACKUP_FOLDER': os.path.join(temp_dir, 'backups'), 'JOB_WORKER_THREADS': 0})
+        # 在第一次渲染模板之前切换应用根目录
+        app.root_path = site_dir
+
+        started = time.perf_counter()
+        with app.app_context():
+            counts = seed_dataset(db, Anniversary, UserInfo, Attachment, Moment,
+                                  anniversaries=args.anniversaries, moments=args.moments,
+                                  images_per_moment=args.images_per_moment,
+                                  extra_attachments=args.extra_attachments,
+                                  files_root=site_dir, image_bytes=args.image_bytes)
+        seed_seconds = time.perf_counter() - started
+        print('测试数据: ' + '，'.join(f'{name} {count}' for name, count in counts.items())
+              + f'（生成耗时 {seed_seconds:.2f} 秒）')
+
+        benchmark = RouteBenchmark(app)
+        results = {}
+        for name, method, url in BENCHMARKS:
+            # restore 需要 backup 生成的备份文件
+            if args.only and name not in args.only and not (name == 'backup' and 'restore' in args.only):
+                continue
+            results[name] = benchmark.run(name, method, url, args.runs)
+
+        with app.app_context():
+            db.engine.dispose()
+
+    print_results(results, previous)
+
+    if json_path:
+        output = {
+            'time': datetime.datetime.now().isoformat(timespec='seconds'),
+            'revision': _git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'parameters': {
+                'moments': args.moments,
+                'images_per_moment': args.images_per_moment,
+                'extra_attachments': args.extra_attachments,
+                'anniversaries': args.anniversaries,
+                'image_bytes': args.image_bytes,
+                'runs': args.runs,
+            },
+            'dataset': counts,
+            'seed_seconds': round(seed_seconds, 3),
+            'results': results,
+        }
+        with open(json_path, 'w', encoding='utf-8') as f:
+            json.dump(output, f, ensure_ascii=False, indent=4)
+
+
+if __name__ == '__main__':
+    main()
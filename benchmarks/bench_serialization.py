@@ -0,0 +1,83 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+# 点滴瞬间API序列化性能对比
+# 旧实现：查询模型实例，eval 解析图片路径，手写字典后 jsonify
+# 新实现：只查询需要的列，serializers.serialize_rows 转换，orjson/MessagePack 编码
+# 用法: python -m benchmarks.bench_serialization --moments 10000
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _best_of(runs, func):
+    timings = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - started)
+    return min(timings) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description='点滴瞬间API序列化性能对比')
+    parser.add_argument('--moments', type=int, default=10000)
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        os.environ['LOVEBLOG_DATABASE_URI'] = 'sqlite:///' + os.path.join(temp_dir, 'bench.db')
+        os.chdir(temp_dir)
+        sys.path.insert(0, ROOT_DIR)
+
+        from flask import jsonify
+        from app import create_app, db, Anniversary, UserInfo, Attachment, Moment
+        from benchmarks.dataset import seed_dataset
+        import serializers
+
+        app = create_app({'TESTING': True, 'JOB_WORKER_THREADS': 0})
+        with app.app_context():
+            seed_dataset(db, Anniversary, UserInfo, Attachment, Moment, moments=args.moments, extra_attachments=0)
+
+        def old_api():
+            moments = Moment.query.order_by(Moment.created_at.desc()).all()
+            data = [{
+                'id': moment.id,
+                'content': moment.content,
+                'created_at': moment.created_at.isoformat(),
+                'images': eval(moment.image_paths)
+            } for moment in moments]
+            return jsonify(data).get_data()
+
+        def new_api(accept='application/json', fields=None):
+            def run():
+                with app.test_request_context(headers={'Accept': accept}):
+                    selected = serializers.parse_fields('moment', fields)
+                    rows = db.session.execute(
+                        db.select(*serializers.model_columns(Moment, 'moment', selected))
+                        .order_by(Moment.created_at.desc())
+                    )
+                    response = serializers.api_response(serializers.serialize_rows(rows, 'moment', selected))
+                    db.session.remove()
+                    return response.get_data()
+            return run
+
+        cases = [('jsonify（旧）', old_api), ('orjson', new_api()), ('orjson ?fields=id,content', new_api(fields='id,content'))]
+        if serializers.msgpack is not None:
+            cases.append(('msgpack', new_api('application/msgpack')))
+
+        with app.test_request_context():
+            baseline = None
+            for name, func in cases:
+                elapsed = _best_of(args.runs, func)
+                size = len(func())
+                db.session.remove()
+                baseline = baseline or elapsed
+                print(f'{name:<28} {elapsed:>9.1f} ms  x{baseline / elapsed:>5.2f}  {size / 1024:>9.1f} KB')
+            db.engine.dispose()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+# 并发读写测试：多个进程同时写入点滴瞬间、读取列表，模拟多个gunicorn工作进程
+# 对比SQLite默认设置（回滚日志、无写队列）与 sqlite_engine 中的WAL配置下的读吞吐量
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MODES = {
+    # SQLite默认设置
+    'default': {
+        'SQLITE_PRAGMAS': {'journal_mode': 'DELETE', 'synchronous': None, 'busy_timeout': None,
+                           'mmap_size': None, 'cache_size': None, 'temp_store': None},
+        'SQLITE_WRITE_QUEUE': False,
+    },
+    # WAL + 调优参数 + 串行化写队列
+    'tuned': {},
+}
+
+
+def _worker(role, config, duration, results):
+    from app import create_app, db, Moment
+
+    app = create_app(config)
+    operations = 0
+    errors = 0
+    deadline = time.monotonic() + duration
+    with app.app_context():
+        while time.monotonic() < deadline:
+            try:
+                if role == 'writer':
+                    db.session.add(Moment(content='并发写入测试', image_paths='[]'))
+                    db.session.commit()
+                else:
+                    Moment.query.order_by(Moment.created_at.desc()).limit(20).all()
+                    db.session.rollback()
+                operations += 1
+            except Exception:
+                db.session.rollback()
+                errors += 1
+    results.put((role, operations, errors))
+
+
+def run_mode(mode, readers, writers, duration, temp_dir):
+    db_path = os.path.join(temp_dir, f'{mode}.db')
+    config = dict(MODES[mode])
+    config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + db_path
+
+    # 先创建数据表，避免多个进程同时建表
+    from app import create_app
+    create_app(config)
+
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=_worker, args=('reader', config, duration, results)) for _ in range(readers)]
+    processes += [multiprocessing.Process(target=_worker, args=('writer', config, duration, results)) for _ in range(writers)]
+    for process in processes:
+        process.start()
+
+    summary = {'reads': 0, 'read_errors': 0, 'writes': 0, 'write_errors': 0}
+    for _ in processes:
+        role, operations, errors = results.get()
+        prefix = 'read' if role == 'reader' else 'write'
+        summary[prefix + 's'] += operations
+        summary[prefix + '_errors'] += errors
+    for process in processes:
+        process.join()
+
+    summary['reads_per_second'] = round(summary['reads'] / duration, 1)
+    summary['writes_per_second'] = round(summary['writes'] / duration, 1)
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description='SQLite并发读写测试')
+    parser.add_argument('--readers', type=int, default=4)
+    parser.add_argument('--writers', type=int, default=2)
+    parser.add_argument('--duration', type=float, default=5.0)
+    parser.add_argument('--json', dest='json_path', help='将结果写入JSON文件')
+    args = parser.parse_args()
+    json_path = os.path.abspath(args.json_path) if args.json_path else None
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        os.environ['LOVEBLOG_DATABASE_URI'] = 'sqlite:///' + os.path.join(temp_dir, 'bench.db')
+        # 上传目录使用相对路径，在临时目录中创建
+        os.chdir(temp_dir)
+        sys.path.insert(0, ROOT_DIR)
+
+        results = {}
+        for mode in MODES:
+            results[mode] = run_mode(mode, args.readers, args.writers, args.duration, temp_dir)
+            result = results[mode]
+            print(f"{mode:<8} 读 {result['reads_per_second']:>9.1f}/s (错误 {result['read_errors']})  "
+                  f"写 {result['writes_per_second']:>8.1f}/s (错误 {result['write_errors']})")
+
+    if json_path:
+        with open(json_path, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# 应用启动耗时测试
+# 1. 在新的Python进程中 import app（即工作进程启动时的耗时）
+# 2. 已导入模块后再调用 create_app()
+# 3. 首次访问延迟加载的后台页面
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+IMPORT_SCRIPT = '''
+import time
+started = time.perf_counter()
+import app
+print(time.perf_counter() - started)
+'''
+
+
+def bench_import(runs, env):
+    """
+    在独立进程中测量 import app 的耗时
+    """
+    timings = []
+    for _ in range(runs):
+        output = subprocess.check_output([sys.executable, '-c', IMPORT_SCRIPT], env=env, cwd=env['LOVEBLOG_BENCH_DIR'])
+        timings.append(float(output.decode().strip().splitlines()[-1]))
+    return timings
+
+
+def bench_in_process(runs):
+    """
+    在当前进程中测量 create_app() 和首次访问延迟加载蓝图的耗时
+    """
+    from app import create_app
+
+    create_timings = []
+    lazy_timings = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        app = create_app()
+        create_timings.append(time.perf_counter() - started)
+
+        client = app.test_client()
+        started = time.perf_counter()
+        client.get('/admin_backup')
+        lazy_timings.append(time.perf_counter() - started)
+    return create_timings, lazy_timings
+
+
+def summarize(timings):
+    return {
+        'runs': len(timings),
+        'median_ms': round(statistics.median(timings) * 1000, 3),
+        'min_ms': round(min(timings) * 1000, 3),
+        'max_ms': round(max(timings) * 1000, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='应用启动耗时测试')
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--json', dest='json_path', help='将结果写入JSON文件')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        env = dict(os.environ)
+        env['PYTHONPATH'] = ROOT_DIR + os.pathsep + env.get('PYTHONPATH', '')
+        env['LOVEBLOG_DATABASE_URI'] = 'sqlite:///' + os.path.join(temp_dir, 'bench.db')
+        env['LOVEBLOG_BENCH_DIR'] = temp_dir
+        os.environ['LOVEBLOG_DATABASE_URI'] = env['LOVEBLOG_DATABASE_URI']
+
+        results = {'import_app': summarize(bench_import(args.runs, env))}
+
+        # 上传目录使用相对路径，在临时目录中创建
+        cwd = os.getcwd()
+        os.chdir(temp_dir)
+        sys.path.insert(0, ROOT_DIR)
+        try:
+            create_timings, lazy_timings = bench_in_process(args.runs)
+        finally:
+            os.chdir(cwd)
+        results['create_app'] = summarize(create_timings)
+        results['first_lazy_admin_request'] = summarize(lazy_timings)
+
+    for name, result in results.items():
+        print(f"{name:<28} median {result['median_ms']:>9.3f} ms  (min {result['min_ms']:.3f}, max {result['max_ms']:.3f})")
+
+    if args.json_path:
+        with open(args.json_path, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+import argparse
+import datetime
+import os
+import random
+import sys
+
+# 测试数据生成器：直接用批量INSERT写入数据库，不经过ORM逐条添加
+# 也可以单独运行，向应用配置的数据库（需先用 db_init.py 清空）写入测试数据:
+#   python -m benchmarks.dataset --moments 10000 --images-per-moment 3
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 每批插入的行数
+BATCH_SIZE = 5000
+
+
+def _write_file(root, filepath, content):
+    path = os.path.join(root, filepath.lstrip('/'))
+    with open(path, 'wb') as f:
+        f.write(content)
+
+
+def seed_dataset(db, Anniversary, UserInfo, Attachment, Moment, anniversaries=20, moments=50,
+                 images_per_moment=3, extra_attachments=20, seed=0, files_root=None, image_bytes=4096):
+    """
+    生成一份接近真实使用情况的数据：纪念日、用户信息（头像和壁纸指向附件）、
+    带图片的点滴瞬间，以及未被引用的附件
+    需在应用上下文中调用，数据表需为空
+    :param anniversaries: 纪念日数量（含"我们在一起啦"）
+    :param moments: 点滴瞬间数量
+    :param images_per_moment: 每条点滴瞬间的图片数量
+    :param extra_attachments: 未被引用的附件数量
+    :param seed: 随机数种子，相同参数生成相同的数据
+    :param files_root: 同时生成图片文件时的根目录（即 /static/uploads/... 路径的起点），为None时只写数据库
+    :param image_bytes: 生成的图片文件大小
+    :return: 各表的记录数
+    """
+    rng = random.Random(seed)
+    now = datetime.datetime(2024, 1, 1, 12, 0, 0)
+    today = now.date()
+    counts = {'anniversary': 0, 'user_info': 0, 'attachment': 0, 'moment': 0}
+    pending = {Anniversary: [], UserInfo: [], Attachment: [], Moment: []}
+
+    if files_root:
+        for subfolder in ('moments', 'basic_info'):
+            os.makedirs(os.path.join(files_root, 'static', 'uploads', subfolder), exist_ok=True)
+    # 所有图片使用相同的内容，生成大量文件时不必每次生成随机数据
+    image_content = rng.randbytes(image_bytes) if files_root else None
+
+    def add(model, row):
+        rows = pending[model]
+        rows.append(row)
+        counts[model.__tablename__] += 1
+        if len(rows) >= BATCH_SIZE:
+            db.session.execute(model.__table__.insert(), rows)
+            rows.clear()
+
+    def add_attachment(filepath, referenced):
+        if files_root:
+            _write_file(files_root, filepath, image_content)
+        add(Attachment, {
+            'filename': filepath.rsplit('/', 1)[-1], 'filepath': filepath,
+            'size': image_bytes if files_root else rng.randint(20000, 3000000),
+            'upload_date': now - datetime.timedelta(minutes=counts['attachment']),
+            'is_referenced': referenced, 'referenced_count': 1 if referenced else 0,
+        })
+        return filepath
+
+    add(Anniversary, {
+        'title': '我们在一起啦', 'date': datetime.date(2020, 1, 30), 'icon': 'heart',
+        'icon_color': 'text-danger', 'card_color': 'card-red', 'sort_order': 1,
+        'is_future': False, 'recurrence': 'none', 'next_date': datetime.date(2020, 1, 30),
+    })
+    for index in range(2, anniversaries + 1):
+        day = today + datetime.timedelta(days=rng.randint(-2000, 365))
+        add(Anniversary, {
+            'title': f'纪念日{index}', 'date': day, 'icon': 'star', 'icon_color': 'text-primary',
+            'card_color': 'card-blue', 'sort_order': index, 'is_future': day > today,
+            'recurrence': rng.choice(('none', 'yearly', 'monthly')), 'next_date': day,
+        })
+
+    add(UserInfo, {
+        'username1': '木木', 'username2': '毛毛',
+        'avatar1': add_attachment('/static/uploads/basic_info/avatar1.jpg', True),
+        'avatar2': add_attachment('/static/uploads/basic_info/avatar2.jpg', True),
+        'banner': add_attachment('/static/uploads/basic_info/banner.jpg', True),
+    })
+
+    for index in range(moments):
+        created_at = now - datetime.timedelta(hours=index * 7)
+        image_paths = [
+            add_attachment(f'/static/uploads/moments/moment_{index}_{image}.jpg', True)
+            for image in range(images_per_moment)
+        ]
+        add(Moment, {
+            'content': f'第{index + 1}条点滴瞬间' + '今天也很开心。' * rng.randint(1, 20),
+            'created_at': created_at, 'updated_at': created_at,
+            # 与 moments.py 保持一致，图片路径列表按 str() 格式保存
+            'image_paths': str(image_paths),
+        })
+
+    for index in range(extra_attachments):
+        add_attachment(f'/static/uploads/unused_{index}.jpg', False)
+
+    for model, rows in pending.items():
+        if rows:
+            db.session.execute(model.__table__.insert(), rows)
+    db.session.commit()
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description='向应用数据库写入测试数据')
+    parser.add_argument('--anniversaries', type=int, default=20)
+    parser.add_argument('--moments', type=int, default=1000)
+    parser.add_argument('--images-per-moment', type=int, default=3)
+    parser.add_argument('--extra-attachments', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--with-files', action='store_true', help='同时在 static/uploads 下生成图片文件')
+    args = parser.parse_args()
+
+    sys.path.insert(0, ROOT_DIR)
+    from app import app, db, Anniversary, UserInfo, Attachment, Moment
+    from data_versions import bump_data_version, DATA_VERSION_NAMES
+
+    with app.app_context():
+        if Moment.query.first() or Attachment.query.first() or UserInfo.query.first():
+            sys.exit('数据库中已有数据，请先运行 db_init.py 清空数据')
+        # db_init.py 会保留"我们在一起啦"，这里重新生成
+        db.session.execute(Anniversary.__table__.delete())
+        counts = seed_dataset(db, Anniversary, UserInfo, Attachment, Moment,
+                              anniversaries=args.anniversaries, moments=args.moments,
+                              images_per_moment=args.images_per_moment,
+                              extra_attachments=args.extra_attachments, seed=args.seed,
+                              files_root=app.root_path if args.with_files else None)
+        # 让正在运行的应用进程的缓存失效
+        bump_data_version(db, *DATA_VERSION_NAMES)
+        db.session.commit()
+    print('已生成: ' + '，'.join(f'{name} {count}' for name, count in counts.items()))
+
+
+if __name__ == '__main__':
+    main()
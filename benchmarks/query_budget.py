@@ -0,0 +1,169 @@
+import argparse
+import json
+import os
+import re
+import sys
+import tempfile
+from collections import Counter
+
+# SQL语句数量预算检查
+# 生成一份测试数据后，通过Flask测试客户端依次请求各个路由，统计每个请求执行的SQL语句：
+# 1. 语句数量超过预算视为失败
+# 2. 同一请求中同一条语句（参数不同）执行 N_PLUS_ONE_THRESHOLD 次及以上，视为N+1查询
+# 数据量变化不应影响语句数量，新增的循环查询会在这里暴露出来
+# 用法: python -m benchmarks.query_budget [--json 结果文件]，有失败时退出码为1
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 同一语句在一次请求中执行多少次视为N+1查询
+N_PLUS_ONE_THRESHOLD = 3
+
+# (名称, 请求方法, URL, 请求参数, 最多允许的SQL语句数)
+# 写操作放在最后，避免影响前面的读请求
+ROUTE_BUDGETS = [
+    ('home', 'GET', '/', {}, 2),
+    ('admin', 'GET', '/admin', {}, 0),
+    ('admin_anniversaries', 'GET', '/admin_anniversaries', {}, 2),
+    ('get_anniversary', 'GET', '/admin/get/2', {}, 1),
+    ('upcoming_anniversaries', 'GET', '/api/anniversaries/upcoming', {}, 1),
+    ('get_max_sort_order', 'GET', '/admin/get_max_sort_order', {}, 1),
+    ('calendar_feed', 'GET', '/calendar.ics', {}, 2),
+    ('get_basic_info', 'GET', '/admin/get_basic_info', {}, 1),
+    ('admin_basic_info', 'GET', '/admin_basic_info', {}, 1),
+    ('admin_moments', 'GET', '/admin_moments', {}, 1),
+    ('moments_list', 'GET', '/moments', {}, 1),
+    ('moments_api', 'GET', '/api/moments', {}, 1),
+    ('moments_on_this_day', 'GET', '/api/moments/on_this_day', {}, 1),
+    ('admin_attachments', 'GET', '/admin_attachments', {}, 1),
+    ('admin_backup', 'GET', '/admin_backup', {}, 0),
+    ('export_ndjson', 'GET', '/admin/export_ndjson', {}, 8),
+    ('update_order', 'POST', '/admin/update_order',
+     {'json': {'order': [{'id': 2, 'sort_order': 3}, {'id': 3, 'sort_order': 2}]}}, 6),
+    ('move_anniversary', 'POST', '/admin/move_anniversary', {'json': {'id': 2, 'target_id': 5}}, 6),
+    ('delete_moment', 'POST', '/admin/delete_moment/1', {}, 6),
+    # 后台任务：包括提交、领取、报告进度和完成任务的约10条语句
+    ('scan_attachments', 'POST', '/admin/scan_attachments', {}, 16),
+]
+
+_PARAMETER_PATTERN = re.compile(r"\b\d+\b|'[^']*'")
+
+
+class QueryRecorder:
+    """
+    记录引擎执行的SQL语句，executemany 只算一条
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.statements = []
+
+    def _on_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+
+    def __enter__(self):
+        from sqlalchemy import event
+        self.statements = []
+        event.listen(self.engine, 'before_cursor_execute', self._on_execute)
+        return self
+
+    def __exit__(self, *exc_info):
+        from sqlalchemy import event
+        event.remove(self.engine, 'before_cursor_execute', self._on_execute)
+
+
+def find_repeated_statements(statements, threshold=N_PLUS_ONE_THRESHOLD):
+    """
+    找出重复执行的语句；语句中的数字和字符串字面量视为参数，忽略差异
+    :return: [(语句, 执行次数)]
+    """
+    counts = Counter(_PARAMETER_PATTERN.sub('?', ' '.join(statement.split())) for statement in statements)
+    return [(statement, count) for statement, count in counts.most_common() if count >= threshold]
+
+
+def check_routes(app, db, routes=ROUTE_BUDGETS):
+    """
+    依次请求路由并检查SQL语句数量
+    :return: 每个路由的检查结果列表
+    """
+    client = app.test_client()
+    # 第一次请求会执行每天一次的纪念日下一次日期刷新，不计入预算
+    client.get('/')
+
+    with app.app_context():
+        engine = db.engine
+
+    results = []
+    for name, method, url, kwargs, budget in routes:
+        with QueryRecorder(engine) as recorder:
+            response = client.open(url, method=method, **kwargs)
+            # 流式响应在读取时才执行查询
+            response.get_data()
+            # 提交了后台任务的请求，任务执行的语句也计入
+            data = response.get_json(silent=True)
+            if isinstance(data, dict) and data.get('job_id'):
+                app.extensions['job_queue'].run_pending()
+        repeated = find_repeated_statements(recorder.statements)
+        results.append({
+            'name': name,
+            'method': method,
+            'url': url,
+            'status': response.status_code,
+            'statements': len(recorder.statements),
+            'budget': budget,
+            'over_budget': len(recorder.statements) > budget,
+            'n_plus_one': [{'statement': statement, 'count': count} for statement, count in repeated],
+        })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='SQL语句数量预算检查')
+    parser.add_argument('--moments', type=int, default=50)
+    parser.add_argument('--anniversaries', type=int, default=20)
+    parser.add_argument('--verbose', action='store_true', help='输出每个请求执行的重复语句')
+    parser.add_argument('--json', dest='json_path', help='将结果写入JSON文件')
+    args = parser.parse_args()
+    json_path = os.path.abspath(args.json_path) if args.json_path else None
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        os.environ['LOVEBLOG_DATABASE_URI'] = 'sqlite:///' + os.path.join(temp_dir, 'budget.db')
+        # 上传目录使用相对路径，在临时目录中创建
+        os.chdir(temp_dir)
+        sys.path.insert(0, ROOT_DIR)
+
+        from app import create_app, db, Anniversary, UserInfo, Attachment, Moment
+        from benchmarks.dataset import seed_dataset
+
+        app = create_app({'TESTING': True, 'JOB_WORKER_THREADS': 0})
+        with app.app_context():
+            seed_dataset(db, Anniversary, UserInfo, Attachment, Moment,
+                         anniversaries=args.anniversaries, moments=args.moments)
+        results = check_routes(app, db)
+        with app.app_context():
+            db.engine.dispose()
+
+    failed = False
+    for result in results:
+        problems = []
+        if result['status'] >= 400:
+            problems.append(f"状态码 {result['status']}")
+        if result['over_budget']:
+            problems.append('超出预算')
+        if result['n_plus_one']:
+            problems.append('疑似N+1查询')
+        failed = failed or bool(problems)
+        print(f"{'失败' if problems else '通过'}  {result['name']:<24} {result['statements']:>3}/{result['budget']:<3} "
+              f"{'，'.join(problems)}")
+        if args.verbose or result['n_plus_one']:
+            for item in result['n_plus_one']:
+                print(f"      x{item['count']}  {item['statement']}")
+
+    if json_path:
+        with open(json_path, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=4)
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+import datetime
+import hashlib
+from datetime import date
+from flask import Blueprint, Response, request
+from data_versions import get_data_version
+from tenants import current_tenant_name, tenant_extensions
+from recurrence import (RECURRENCE_NONE, RECURRENCE_YEARLY, RECURRENCE_MONTHLY,
+                        iter_occurrences)
+
+# 创建日历订阅蓝图
+calendar_feed_bp = Blueprint('calendar_feed', __name__)
+
+# 无法用RRULE表示的重复纪念日（农历、31日每月等）展开的年份范围
+FEED_YEARS_BEFORE = 1
+FEED_YEARS_AHEAD = 10
+
+# 日历名称
+CALENDAR_NAME = '我们的纪念日'
+
+# 已生成的日历缓存（多租户时每个租户一份），数据版本或年份变化后重新生成
+def _get_feed_cache():
+    return tenant_extensions().setdefault('calendar_feed', {'key': None, 'etag': None, 'body': None})
+
+
+def _escape_text(text):
+    """
+    转义iCalendar文本中的特殊字符
+    """
+    return (text or '').replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,').replace('\n', '\\n')
+
+
+def _fold_line(line):
+    """
+    按iCalendar规范将超过75字节的行折行
+    """
+    encoded = line.encode('utf-8')
+    if len(encoded) <= 75:
+        return line
+    parts = []
+    current = ''
+    limit = 75
+    for char in line:
+        if len((current + char).encode('utf-8')) > limit:
+            parts.append(current)
+            current = char
+            # 续行以空格开头，占用一个字节
+            limit = 74
+        else:
+            current += char
+    parts.append(current)
+    return '\r\n '.join(parts)
+
+
+def _rrule_for(anniversary):
+    """
+    返回可以直接用RRULE表示的重复规则，不能表示时返回None
+    （月末/闰日需要按月末取值，农历无法用RRULE表示）
+    """
+    if anniversary.recurrence == RECURRENCE_YEARLY and (anniversary.date.month, anniversary.date.day) != (2, 29):
+        return 'FREQ=YEARLY'
+    if anniversary.recurrence == RECURRENCE_MONTHLY and anniversary.date.day <= 28:
+        return 'FREQ=MONTHLY'
+    return None
+
+
+def _event_lines(uid, start, title, dtstamp, rrule=None):
+    end = start + datetime.timedelta(days=1)
+    lines = [
+        'BEGIN:VEVENT',
+        f'UID:{uid}',
+        f'DTSTAMP:{dtstamp}',
+        f"DTSTART;VALUE=DATE:{start.strftime('%Y%m%d')}",
+        f"DTEND;VALUE=DATE:{end.strftime('%Y%m%d')}",
+        f'SUMMARY:{_escape_text(title)}',
+    ]
+    if rrule:
+        lines.append(f'RRULE:{rrule}')
+    lines.append('END:VEVENT')
+    return lines
+
+
+def build_calendar(anniversaries, today, host='loveblog'):
+    """
+    根据纪念日列表生成iCalendar内容
+    :param anniversaries: 纪念日列表
+    :param today: 今天的日期，决定展开重复纪念日的范围
+    :param host: 用于生成事件UID的域名
+    :return: iCalendar文本
+    """
+    dtstamp = datetime.datetime.now(datetime.timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+    window_start = date(today.year - FEED_YEARS_BEFORE, 1, 1)
+    window_end = date(today.year + FEED_YEARS_AHEAD, 12, 31)
+
+    lines = [
+        'BEGIN:VCALENDAR',
+        'VERSION:2.0',
+        'PRODID:-//Love Blog//Anniversaries//CN',
+        'CALSCALE:GREGORIAN',
+        'METHOD:PUBLISH',
+        f'X-WR-CALNAME:{CALENDAR_NAME}',
+    ]
+    for anniversary in anniversaries:
+        uid = f'anniversary-{anniversary.id}@{host}'
+        rrule = _rrule_for(anniversary)
+        if anniversary.recurrence == RECURRENCE_NONE or rrule:
+            lines.extend(_event_lines(uid, anniversary.date, anniversary.title, dtstamp, rrule))
+            continue
+
+        # 逐个展开无法用RRULE表示的重复纪念日
+        for occurrence in iter_occurrences(anniversary.date, anniversary.recurrence, window_end):
+            if occurrence < window_start:
+                continue
+            occurrence_uid = f"anniversary-{anniversary.id}-{occurrence.strftime('%Y%m%d')}@{host}"
+            lines.extend(_event_lines(occurrence_uid, occurrence, anniversary.title, dtstamp))
+    lines.append('END:VCALENDAR')
+    return '\r\n'.join(_fold_line(line) for line in lines) + '\r\n'
+
+
+# 注册路由函数到蓝图
+def register_calendar_feed_routes(bp, db, Anniversary):
+    # 纪念日日历订阅
+    @bp.route('/calendar.ics')
+    def calendar_ics():
+        today = date.today()
+        # 缓存键：租户 + 纪念日数据版本 + 年份（农历等展开范围按年份计算）
+        key = (current_tenant_name(), get_data_version(db, 'anniversary'), today.year, request.host)
+        _feed_cache = _get_feed_cache()
+
+        if _feed_cache['key'] != key:
+            anniversaries = Anniversary.query.order_by(Anniversary.sort_order.asc()).all()
+            body = build_calendar(anniversaries, today, request.host.split(':')[0]).encode('utf-8')
+            # ETag只由缓存键决定，多个进程各自生成的结果也能得到相同的ETag
+            _feed_cache['etag'] = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+            _feed_cache['body'] = body
+            _feed_cache['key'] = key
+
+        response = Response(_feed_cache['body'], mimetype='text/calendar')
+        response.set_etag(_feed_cache['etag'])
+        response.headers['Content-Disposition'] = 'inline; filename=anniversaries.ics'
+        return response.make_conditional(request)
+
+    return bp
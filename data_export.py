@@ -0,0 +1,273 @@
+import io
+import json
+import datetime
+from flask import Blueprint, Response, request, redirect, url_for, stream_with_context
+from anniversaries import invalidate_next_dates
+from data_versions import IMAGE_HASH_INDEX_VERSION, bump_data_version
+from markdown_render import MARKDOWN_VERSION, rendered_content
+
+# 创建数据导出蓝图
+data_export_bp = Blueprint('data_export', __name__)
+
+# 导出文件格式标识和版本
+EXPORT_FORMAT = 'loveblog-ndjson'
+EXPORT_VERSION = 1
+
+# 导入时每批插入的行数（整个导入在一个事务中）
+IMPORT_BATCH_SIZE = 5000
+
+# 默认纪念日标题，合并导入时不重复导入
+DEFAULT_ANNIVERSARY_TITLE = '我们在一起啦'
+
+
+def get_export_models(Anniversary, UserInfo, Attachment, Moment):
+    """
+    按导出/导入顺序返回 {表名: 模型类}
+    """
+    return {
+        Anniversary.__tablename__: Anniversary,
+        UserInfo.__tablename__: UserInfo,
+        Attachment.__tablename__: Attachment,
+        Moment.__tablename__: Moment,
+    }
+
+
+def _encode_value(value):
+    """
+    将数据库中的值转换为可JSON序列化的值
+    """
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    return value
+
+
+def _decode_value(column, value):
+    """
+    根据列类型将JSON中的值还原为Python对象
+    """
+    if value is None:
+        return None
+    python_type = None
+    try:
+        python_type = column.type.python_type
+    except NotImplementedError:
+        pass
+    if python_type is datetime.datetime:
+        return datetime.datetime.fromisoformat(value)
+    if python_type is datetime.date:
+        return datetime.date.fromisoformat(value[:10])
+    if python_type is bool:
+        return bool(value)
+    return value
+
+
+def iter_export_lines(db, models, chunk_size=1000):
+    """
+    逐行生成NDJSON导出内容
+    第一行是文件头，包含格式版本和每个表的列名，之后每行是一条记录
+    :param db: SQLAlchemy实例
+    :param models: {表名: 模型类}
+    :param chunk_size: 每次从数据库读取的行数
+    """
+    header = {
+        'format': EXPORT_FORMAT,
+        'version': EXPORT_VERSION,
+        'exported_at': datetime.datetime.now().isoformat(),
+        'models': {name: [c.name for c in model.__table__.columns] for name, model in models.items()},
+    }
+    yield json.dumps(header, ensure_ascii=False) + '\n'
+
+    for name, model in models.items():
+        table = model.__table__
+        result = db.session.execute(
+            table.select().order_by(table.c.id).execution_options(yield_per=chunk_size)
+        )
+        for row in result.mappings():
+            data = {key: _encode_value(value) for key, value in row.items()}
+            yield json.dumps({'model': name, 'data': data}, ensure_ascii=False) + '\n'
+
+
+def import_ndjson(db, models, lines, mode='merge', batch_size=IMPORT_BATCH_SIZE):
+    """
+    从NDJSON导入数据
+    mode='replace' 时先清空所有表并保留原ID；
+    mode='merge' 时追加到现有数据之后，ID按表内最大ID整体偏移（新ID = 旧ID + 偏移量）
+    清空和所有批次的插入在同一个事务中，文件中途出错时回滚，数据库保持导入前的状态
+    :param db: SQLAlchemy实例
+    :param models: {表名: 模型类}
+    :param lines: 可迭代的文本行（第一行为文件头）
+    :param mode: 'merge' 或 'replace'
+    :param batch_size: 每批插入的行数
+    :return: 导入统计信息
+    """
+    if mode not in ('merge', 'replace'):
+        raise ValueError(f'不支持的导入模式: {mode}')
+
+    lines = iter(lines)
+    try:
+        header = json.loads(next(lines))
+    except StopIteration:
+        raise ValueError('导入文件为空')
+    if header.get('format') != EXPORT_FORMAT:
+        raise ValueError('不是有效的导出文件')
+    if header.get('version', 0) > EXPORT_VERSION:
+        raise ValueError(f"导出文件版本过新: {header.get('version')}")
+
+    # 只导入两边都存在的列，兼容新旧版本的表结构差异
+    import_columns = {}
+    for name, model in models.items():
+        exported = header.get('models', {}).get(name, [])
+        import_columns[name] = [c for c in model.__table__.columns if c.name in exported]
+
+    # 计算ID偏移量，实现批量导入时的ID重映射
+    id_offsets = {}
+    for name, model in models.items():
+        if mode == 'merge':
+            id_offsets[name] = db.session.query(db.func.max(model.id)).scalar() or 0
+        else:
+            id_offsets[name] = 0
+
+    anniversary_table = 'anniversary' if 'anniversary' in models else None
+    moment_table = 'moment' if 'moment' in models else None
+    sort_order_offset = 0
+    skip_default_anniversary = False
+    skip_user_info = False
+    if mode == 'merge':
+        if anniversary_table:
+            Anniversary = models[anniversary_table]
+            sort_order_offset = db.session.query(db.func.max(Anniversary.sort_order)).scalar() or 0
+            skip_default_anniversary = Anniversary.query.filter_by(title=DEFAULT_ANNIVERSARY_TITLE).first() is not None
+        if 'user_info' in models:
+            # 基础信息是单行记录，合并时保留现有的
+            skip_user_info = models['user_info'].query.first() is not None
+
+    buffers = {name: [] for name in models}
+    stats = {name: 0 for name in models}
+    skipped = 0
+
+    def flush(name):
+        rows = buffers[name]
+        if rows:
+            db.session.execute(models[name].__table__.insert(), rows)
+            stats[name] += len(rows)
+            buffers[name] = []
+
+    try:
+        if mode == 'replace':
+            for model in reversed(list(models.values())):
+                db.session.execute(model.__table__.delete())
+
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            name = record.get('model')
+            data = record.get('data', {})
+            if name not in models:
+                skipped += 1
+                continue
+            if name == 'user_info' and skip_user_info:
+                skipped += 1
+                continue
+            if name == anniversary_table and skip_default_anniversary and data.get('title') == DEFAULT_ANNIVERSARY_TITLE:
+                skipped += 1
+                continue
+
+            row = {c.name: _decode_value(c, data.get(c.name)) for c in import_columns[name]}
+            if 'id' in row and row['id'] is not None:
+                row['id'] += id_offsets[name]
+            if name == anniversary_table and row.get('sort_order') is not None:
+                row['sort_order'] += sort_order_offset
+            # 旧版本导出的点滴瞬间没有渲染好的HTML，或由其他版本的渲染器生成，导入时重新渲染
+            if name == moment_table and row.get('content_html_version') != MARKDOWN_VERSION:
+                row.update(rendered_content(row.get('content')))
+
+            buffers[name].append(row)
+            if len(buffers[name]) >= batch_size:
+                flush(name)
+
+        for name in models:
+            flush(name)
+
+        # 导入后更新数据版本，让各进程的缓存失效
+        bump_data_version(db, *models, IMAGE_HASH_INDEX_VERSION)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    return {'imported': stats, 'skipped': skipped, 'id_offsets': id_offsets}
+
+
+# 注册路由函数到蓝图
+def register_data_export_routes(bp, app, db, Anniversary, UserInfo, Attachment, Moment):
+    """
+    注册数据导出/导入相关路由到蓝图
+    :param bp: 蓝图实例
+    :param app: Flask应用实例
+    :param db: SQLAlchemy实例
+    :return: 已注册路由的蓝图
+    """
+    models = get_export_models(Anniversary, UserInfo, Attachment, Moment)
+
+    # 流式导出NDJSON
+    @bp.route('/admin/export_ndjson')
+    def export_ndjson():
+        timestamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+        return Response(
+            stream_with_context(iter_export_lines(db, models)),
+            mimetype='application/x-ndjson',
+            headers={'Content-Disposition': f'attachment; filename=loveblog_export_{timestamp}.ndjson'}
+        )
+
+    # 导入NDJSON
+    @bp.route('/admin/import_ndjson', methods=['POST'])
+    def import_ndjson_route():
+        try:
+            if 'ndjson_file' not in request.files or request.files['ndjson_file'].filename == '':
+                return redirect(url_for('backup.admin_backup', message='请选择导出文件', message_type='danger'))
+
+            mode = request.form.get('mode', 'merge')
+            stream = io.TextIOWrapper(request.files['ndjson_file'].stream, encoding='utf-8')
+            result = import_ndjson(db, models, stream, mode=mode)
+            # 导入的下一次日期可能已经过期
+            invalidate_next_dates()
+
+            total = sum(result['imported'].values())
+            return redirect(url_for('backup.admin_backup', message=f'导入成功，共导入{total}条记录', message_type='success'))
+        except Exception as e:
+            app.logger.error(f'导入过程中发生错误: {str(e)}')
+            return redirect(url_for('backup.admin_backup', message=f'导入失败: {str(e)}', message_type='danger'))
+
+    return bp
+
+
+if __name__ == '__main__':
+    # 命令行用法:
+    #   python data_export.py export loveblog.ndjson
+    #   python data_export.py import loveblog.ndjson [--mode merge|replace]
+    import argparse
+    import time
+    from app import app, db, Anniversary, UserInfo, Attachment, Moment
+
+    parser = argparse.ArgumentParser(description='爱情小站数据导出/导入（NDJSON）')
+    parser.add_argument('action', choices=['export', 'import'])
+    parser.add_argument('path')
+    parser.add_argument('--mode', choices=['merge', 'replace'], default='merge')
+    parser.add_argument('--batch-size', type=int, default=IMPORT_BATCH_SIZE)
+    args = parser.parse_args()
+
+    models = get_export_models(Anniversary, UserInfo, Attachment, Moment)
+    started = time.perf_counter()
+    with app.app_context():
+        if args.action == 'export':
+            with open(args.path, 'w', encoding='utf-8') as f:
+                for line in iter_export_lines(db, models):
+                    f.write(line)
+            print(f'导出完成: {args.path}')
+        else:
+            with open(args.path, 'r', encoding='utf-8') as f:
+                result = import_ndjson(db, models, f, mode=args.mode, batch_size=args.batch_size)
+            print(f"导入完成: {result['imported']}，跳过{result['skipped']}条")
+    print(f'耗时 {time.perf_counter() - started:.2f} 秒')
@@ -0,0 +1,69 @@
+import uuid
+from flask import g, has_app_context, has_request_context
+from tenants import tenant_extensions
+
+# 数据版本号：每类数据（如纪念日）一行，数据每次修改后换成新的随机版本号
+# 各个gunicorn进程通过比较版本号判断自己的缓存是否过期
+# 使用随机值而不是自增数字，恢复旧备份后也不会与之前缓存的版本号重复
+
+# 相似图片索引的代数：只在整体替换附件数据（恢复备份、导入数据、补算哈希）后更新，各进程据此重建索引，
+# 上传、打包等普通修改只更新 attachment 版本号，索引按ID增量更新
+IMAGE_HASH_INDEX_VERSION = 'image_hash_index'
+
+# 所有需要跟踪版本的数据（恢复备份、导入数据后全部更新）
+DATA_VERSION_NAMES = ('anniversary', 'user_info', 'attachment', 'moment', IMAGE_HASH_INDEX_VERSION)
+
+# 定义数据版本模型
+def init_data_version_model(db):
+    class DataVersion(db.Model):
+        __tablename__ = 'data_version'
+        name = db.Column(db.String(50), primary_key=True)
+        version = db.Column(db.String(32), nullable=False)
+
+    return DataVersion
+
+# 数据修改后更新版本号（在同一事务中提交）
+def bump_data_version(db, *names):
+    # 本次请求中已读取的版本号不再有效；记录修改过的数据，请求结束后用于增量导出静态网站
+    if has_app_context():
+        g.pop('data_versions', None)
+        g.setdefault('changed_data_versions', set()).update(names)
+    for name in names:
+        token = uuid.uuid4().hex
+        result = db.session.execute(
+            db.text('UPDATE data_version SET version = :version WHERE name = :name'),
+            {'version': token, 'name': name}
+        )
+        if result.rowcount == 0:
+            db.session.execute(
+                db.text('INSERT INTO data_version (name, version) VALUES (:name, :version)'),
+                {'version': token, 'name': name}
+            )
+
+# 获取当前版本号，从未修改过时返回空字符串
+def get_data_version(db, name):
+    version = db.session.execute(
+        db.text('SELECT version FROM data_version WHERE name = :name'),
+        {'name': name}
+    ).scalar()
+    return version or ''
+
+# 一次查询获取所有数据的版本号，同一请求中只查询一次
+def get_request_data_versions(db):
+    if has_request_context() and 'data_versions' in g:
+        return g.data_versions
+    versions = dict.fromkeys(DATA_VERSION_NAMES, '')
+    versions.update(db.session.execute(db.text('SELECT name, version FROM data_version')).all())
+    if has_request_context():
+        g.data_versions = versions
+    return versions
+
+# 按数据版本缓存很少修改的数据（如用户信息），每个进程一份，保存在 app.extensions 中（多租户时每个租户一份）
+# 版本号或 variant（如日期）变化后调用 loader 重新加载；loader 应返回与数据库会话无关的普通对象
+def cached_by_data_version(db, name, key, loader, variant=None):
+    cache = tenant_extensions().setdefault('data_version_cache', {})
+    version = get_request_data_versions(db)[name]
+    entry = cache.get(key)
+    if entry is None or entry[0] != version or entry[1] != variant:
+        entry = cache[key] = (version, variant, loader())
+    return entry[2]
@@ -2,12 +2,15 @@ import os
 import shutil
 from datetime import date  # 导入date类
 from app import app, db, Anniversary, UserInfo, Attachment, Moment
+from migrations import run_migrations
+from db_maintenance import run_maintenance
 
 # 确保在应用上下文内运行
 with app.app_context():
     # 检查并创建所有数据表（如果表不存在）
     print("正在检查数据库表...")
     db.create_all()
+    run_migrations(db)
     
     print("清空所有表中的数据...")
     # 清空所有表的数据，但保留表结构
@@ -32,6 +35,9 @@ with app.app_context():
     
     db.session.add(anniversary)
     db.session.commit()
+
+    print("归还清空数据后留下的空闲页...")
+    print(run_maintenance(app, db)['message'])
     
     print("清空uploads目录下的文件...")
     # 清空uploads目录下的所有文件
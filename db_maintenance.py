@@ -0,0 +1,236 @@
+import datetime
+import os
+import time
+from flask import Blueprint, current_app, jsonify, render_template, request
+from jobs import enqueue_job
+from sqlite_engine import get_write_queue
+from tenants import DATABASE_FILENAME, current_tenant_name, get_database_path, use_tenant
+
+# 数据库维护
+# 删除附件、点滴瞬间以及 db_init.py 清空数据后，SQLite文件中留下的空闲页不会自动归还，查询规划统计信息也不会更新。
+# db_maintenance 后台任务依次执行：
+# - 还不是 auto_vacuum=INCREMENTAL 的数据库先设置后执行一次完整的 VACUUM（之后新建的数据库默认就是INCREMENTAL）；
+#   之后每次用 PRAGMA incremental_vacuum 分批归还空闲页，每批之间释放写队列，不长时间阻塞请求
+# - ANALYZE（用 analysis_limit 限制每个索引的采样行数）更新查询规划统计信息
+# - PRAGMA wal_checkpoint(TRUNCATE) 把WAL写回数据库文件并截断
+# 任务工作线程每分钟检查一次：距上次维护超过 MAINTENANCE_INTERVAL_HOURS 小时，
+# 且本进程和数据库文件都已空闲 MAINTENANCE_QUIET_SECONDS 秒时提交维护任务（多租户时每个租户分别检查）
+# /admin/database 显示数据库大小、空闲页和碎片率，可手动执行维护（?full=1 执行完整的 VACUUM 整理碎片）
+
+# 创建数据库维护蓝图
+db_maintenance_bp = Blueprint('db_maintenance', __name__)
+
+MAINTENANCE_JOB = 'db_maintenance'
+
+# 默认维护间隔（小时，0表示不自动维护）和空闲时间（秒）
+DEFAULT_MAINTENANCE_INTERVAL_HOURS = 24
+DEFAULT_MAINTENANCE_QUIET_SECONDS = 300
+
+# 检查是否需要维护的间隔（秒）
+MAINTENANCE_CHECK_INTERVAL = 60
+
+# 每批归还的空闲页数
+INCREMENTAL_VACUUM_PAGES = 1000
+
+# ANALYZE 时每个索引最多采样的行数
+ANALYSIS_LIMIT = 1000
+
+AUTO_VACUUM_MODES = {0: 'NONE', 1: 'FULL', 2: 'INCREMENTAL'}
+
+
+def _pragma(connection, name):
+    return connection.exec_driver_sql(f'PRAGMA {name}').scalar()
+
+
+def _fragmentation(connection):
+    """
+    用 dbstat 虚拟表统计B树页面的不连续比例（按遍历顺序，相邻两页的页号不连续即算一次）
+    :return: 百分比，SQLite编译时没有启用 dbstat 时返回None
+    """
+    try:
+        rows = connection.exec_driver_sql('SELECT name, pageno FROM dbstat ORDER BY name, path').all()
+    except Exception:
+        return None
+    jumps = pairs = 0
+    previous_name = previous_page = None
+    for name, page in rows:
+        if name == previous_name:
+            pairs += 1
+            jumps += page != previous_page + 1
+        previous_name, previous_page = name, page
+    return round(jumps * 100 / pairs, 1) if pairs else 0.0
+
+
+def get_database_stats(db, fragmentation=True):
+    """
+    当前数据库（多租户时为当前租户的数据库）的大小和空闲页统计
+    :param fragmentation: 是否统计碎片率（需要读取所有页面）
+    """
+    path = get_database_path(db)
+    with db.session.get_bind().connect() as connection:
+        page_size = _pragma(connection, 'page_size')
+        page_count = _pragma(connection, 'page_count')
+        freelist_count = _pragma(connection, 'freelist_count')
+        auto_vacuum = _pragma(connection, 'auto_vacuum')
+        analyzed = connection.exec_driver_sql(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sqlite_stat1'").first() is not None
+        fragmented = _fragmentation(connection) if fragmentation else None
+    wal_path = path + '-wal'
+    return {
+        'path': path,
+        'size': page_size * page_count,
+        'wal_size': os.path.getsize(wal_path) if os.path.exists(wal_path) else 0,
+        'page_size': page_size,
+        'page_count': page_count,
+        'freelist_count': freelist_count,
+        'free_bytes': page_size * freelist_count,
+        'free_percent': round(freelist_count * 100 / page_count, 1) if page_count else 0.0,
+        'fragmentation': fragmented,
+        'auto_vacuum': AUTO_VACUUM_MODES.get(auto_vacuum, str(auto_vacuum)),
+        'analyzed': analyzed,
+    }
+
+
+def _format_size(size):
+    return f'{size / 1024 / 1024:.1f} MB'
+
+
+def run_maintenance(app, db, full=False, context=None):
+    """
+    维护当前数据库：归还空闲页、更新统计信息、截断WAL
+    :param full: 是否执行完整的 VACUUM（重建数据库文件，同时整理碎片）
+    :param context: 后台任务上下文（可选），用于报告进度和检查取消
+    :return: 包含结果消息的字典
+    """
+    before = get_database_stats(db, fragmentation=False)
+    write_queue = get_write_queue()
+    steps = []
+    # VACUUM 不能在事务中执行，使用自动提交的连接；写操作仍通过写队列与其他请求串行
+    with db.session.get_bind().connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+        def exclusive(sql):
+            if write_queue is not None:
+                write_queue.acquire()
+            try:
+                result = connection.exec_driver_sql(sql)
+                return result.all() if result.returns_rows else []
+            finally:
+                if write_queue is not None:
+                    write_queue.release()
+
+        if full or before['auto_vacuum'] != 'INCREMENTAL':
+            if context:
+                context.report(0, '正在执行 VACUUM')
+            exclusive('PRAGMA auto_vacuum = INCREMENTAL')
+            exclusive('VACUUM')
+            steps.append('VACUUM')
+        elif before['freelist_count']:
+            total = before['freelist_count']
+            while True:
+                if context:
+                    context.check_cancelled()
+                    remaining = _pragma(connection, 'freelist_count')
+                    context.report((total - remaining) * 80 // total, f'正在归还空闲页（剩余 {remaining} 页）')
+                # incremental_vacuum 每返回一行归还一页，需要读取完所有结果
+                exclusive(f'PRAGMA incremental_vacuum({INCREMENTAL_VACUUM_PAGES})')
+                if not _pragma(connection, 'freelist_count'):
+                    break
+            steps.append(f'归还 {total} 个空闲页')
+
+        if context:
+            context.report(80, '正在更新统计信息')
+        connection.exec_driver_sql(f'PRAGMA analysis_limit = {ANALYSIS_LIMIT}')
+        exclusive('ANALYZE')
+        steps.append('ANALYZE')
+
+        if context:
+            context.report(90, '正在执行WAL检查点')
+        busy, wal_pages, checkpointed = connection.exec_driver_sql('PRAGMA wal_checkpoint(TRUNCATE)').one()
+        steps.append('WAL检查点' + ('（有其他连接正在读取，未能截断）' if busy else ''))
+
+    after = get_database_stats(db, fragmentation=False)
+    return {
+        'message': f"{'、'.join(steps)}：数据库 {_format_size(before['size'])} -> {_format_size(after['size'])}，"
+                   f"WAL {_format_size(before['wal_size'])} -> {_format_size(after['wal_size'])}",
+        'before': before,
+        'after': after,
+    }
+
+
+def _database_file(app, db, tenant_name):
+    pool = app.extensions.get('tenant_pool')
+    if tenant_name:
+        return os.path.join(pool.tenant_root(tenant_name), DATABASE_FILENAME)
+    return os.path.abspath(db.engine.url.database)
+
+
+def schedule_maintenance(app, db, Job):
+    """
+    为到期且空闲的数据库提交维护任务（由任务工作线程定期调用）
+    :return: 提交了维护任务的租户名列表（主数据库为''）
+    """
+    interval_hours = app.config.get('MAINTENANCE_INTERVAL_HOURS', DEFAULT_MAINTENANCE_INTERVAL_HOURS)
+    quiet_seconds = app.config.get('MAINTENANCE_QUIET_SECONDS', DEFAULT_MAINTENANCE_QUIET_SECONDS)
+    now = time.time()
+    if not interval_hours or now - app.extensions['db_maintenance_last_request'][0] < quiet_seconds:
+        return []
+
+    # 每个租户最近一次维护任务的提交时间（任务表在主数据库中）
+    last_runs = dict(db.session.execute(
+        db.select(Job.tenant, db.func.max(Job.created_at)).where(Job.job_type == MAINTENANCE_JOB).group_by(Job.tenant)
+    ).all())
+    due_before = datetime.datetime.now() - datetime.timedelta(hours=interval_hours)
+    pool = app.extensions.get('tenant_pool')
+    scheduled = []
+    # 多租户时主数据库（保存任务表）也需要维护
+    for name in [''] + (pool.names() if pool is not None else []):
+        last_run = last_runs.get(name)
+        if last_run is not None and last_run > due_before:
+            continue
+        # 数据库文件最近有写入，不是空闲时段
+        path = _database_file(app, db, name)
+        if any(now - os.path.getmtime(file) < quiet_seconds for file in (path, path + '-wal') if os.path.exists(file)):
+            continue
+        with app.app_context():
+            if name:
+                use_tenant(name)
+            enqueue_job(MAINTENANCE_JOB)
+        scheduled.append(name)
+    return scheduled
+
+
+def init_db_maintenance(app, db, Job):
+    """
+    记录本进程最后一次处理请求的时间，并让任务工作线程定期检查是否需要维护
+    """
+    # 用列表保存，请求钩子中直接修改，不需要加锁
+    last_request = app.extensions['db_maintenance_last_request'] = [0.0]
+
+    @app.before_request
+    def record_request_time():
+        last_request[0] = time.time()
+
+    app.extensions['job_queue'].add_periodic(lambda: schedule_maintenance(app, db, Job), MAINTENANCE_CHECK_INTERVAL)
+
+
+def register_db_maintenance_routes(bp, db, Job):
+    # 数据库状态页面
+    @bp.route('/admin/database')
+    def admin_database():
+        stats = get_database_stats(db)
+        jobs = Job.query.filter_by(job_type=MAINTENANCE_JOB, tenant=current_tenant_name()) \
+            .order_by(Job.id.desc()).limit(10).all()
+        return render_template('admin_database.html', stats=stats, jobs=jobs,
+                               interval_hours=current_app.config.get('MAINTENANCE_INTERVAL_HOURS',
+                                                                     DEFAULT_MAINTENANCE_INTERVAL_HOURS))
+
+    # 手动提交维护任务，?full=1 执行完整的 VACUUM
+    @bp.route('/admin/database/maintenance', methods=['POST'])
+    def start_maintenance():
+        try:
+            full = request.values.get('full') in ('1', 'true')
+            job = enqueue_job(MAINTENANCE_JOB, {'full': True} if full else None)
+            return jsonify({'success': True, 'message': '已开始维护数据库', 'job_id': job.id})
+        except Exception as e:
+            return jsonify({'success': False, 'message': str(e)})
+
+    return bp
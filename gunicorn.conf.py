@@ -0,0 +1,34 @@
+# gunicorn 配置文件，启动命令: gunicorn app:app
+import gc
+import os
+import shutil
+
+bind = '0.0.0.0:1314'
+workers = 2
+
+# 在主进程中导入应用（执行一次 create_app()），工作进程通过fork共享已加载的代码和数据
+preload_app = True
+
+# 各工作进程把性能指标写入此目录，/admin/metrics 合并所有工作进程的数据
+# 需在导入应用之前设置
+METRICS_DIR = os.path.abspath('instance/metrics')
+os.environ.setdefault('LOVEBLOG_METRICS_DIR', METRICS_DIR)
+
+
+def on_starting(server):
+    # 重新启动时清空上一次运行留下的指标快照
+    shutil.rmtree(os.environ['LOVEBLOG_METRICS_DIR'], ignore_errors=True)
+
+
+def pre_fork(server, worker):
+    # 冻结主进程中已创建的对象，避免垃圾回收修改对象头导致写时复制的内存页被复制
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    # 每个工作进程使用自己的数据库连接
+    from app import db, app
+    with app.app_context():
+        db.engine.dispose()
+    # 启动本进程的后台任务工作线程
+    app.extensions['job_queue'].start()
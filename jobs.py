@@ -0,0 +1,475 @@
+import datetime
+import json
+import os
+import socket
+import threading
+import time
+from flask import Blueprint, current_app, g, jsonify, request
+from sqlalchemy.exc import IntegrityError, OperationalError
+from tenants import current_tenant_name, use_tenant
+
+# 后台任务队列
+# 扫描附件、备份、恢复等耗时操作不在请求中执行，而是写入 job 表，由工作线程取出执行：
+# - 任务保存在数据库中，进程重启后不会丢失
+# - 同一租户的同一类型任务同一时间最多只有一个在运行（job表上的部分唯一索引保证）
+# - 多租户时任务表只在主数据库中，所有租户共用工作线程，任务在提交它的租户中执行
+# - 运行中的任务定期更新心跳时间，心跳超时视为执行它的进程已崩溃，重新排队（超过最大次数则标记失败）
+# - 排队中的任务可直接取消，运行中的任务由任务函数在安全的位置检查取消标记后退出
+
+# 创建后台任务蓝图
+jobs_bp = Blueprint('jobs', __name__)
+
+# 任务状态
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_SUCCEEDED = 'succeeded'
+JOB_FAILED = 'failed'
+JOB_CANCELLED = 'cancelled'
+JOB_FINISHED_STATUSES = (JOB_SUCCEEDED, JOB_FAILED, JOB_CANCELLED)
+
+# 以下参数均可通过 app.config 中同名的 JOB_ 配置项覆盖
+DEFAULT_JOB_WORKER_THREADS = 1        # 每个进程的工作线程数，为0时不在该进程中执行任务
+DEFAULT_JOB_POLL_INTERVAL = 1.0       # 没有任务时查询新任务的间隔（秒）
+DEFAULT_JOB_HEARTBEAT_INTERVAL = 10   # 运行中任务的心跳间隔（秒）
+DEFAULT_JOB_STALE_SECONDS = 60        # 心跳超过多少秒未更新视为进程已崩溃
+DEFAULT_JOB_MAX_ATTEMPTS = 3          # 因进程崩溃重新执行的最大次数
+
+
+class JobCancelled(Exception):
+    """
+    任务已被取消
+    """
+
+
+# 定义后台任务模型
+def init_job_model(db):
+    class Job(db.Model):
+        __table_args__ = (
+            db.Index('ix_job_status_type', 'status', 'job_type'),
+            # 同一租户的同一类型同一时间只能有一个运行中的任务
+            db.Index('ix_job_running_type', 'job_type', 'tenant', unique=True, sqlite_where=db.text("status = 'running'")),
+        )
+        id = db.Column(db.Integer, primary_key=True)
+        job_type = db.Column(db.String(50), nullable=False)
+        tenant = db.Column(db.String(64), nullable=False, default='', server_default='')  # 单租户时为空字符串
+        status = db.Column(db.String(20), nullable=False, default=JOB_QUEUED)
+        params = db.Column(db.Text, default='{}')  # JSON格式的任务参数
+        result = db.Column(db.Text)  # JSON格式的执行结果
+        error = db.Column(db.Text)
+        progress = db.Column(db.Integer, default=0)  # 0-100
+        message = db.Column(db.String(255), default='')  # 当前进度说明或结果消息
+        attempts = db.Column(db.Integer, default=0)
+        max_attempts = db.Column(db.Integer, default=DEFAULT_JOB_MAX_ATTEMPTS)
+        cancel_requested = db.Column(db.Boolean, default=False)
+        worker = db.Column(db.String(100))  # 执行任务的 主机名:进程号:线程名
+        heartbeat_at = db.Column(db.DateTime)
+        created_at = db.Column(db.DateTime, default=datetime.datetime.now)
+        started_at = db.Column(db.DateTime)
+        finished_at = db.Column(db.DateTime)
+
+    return Job
+
+
+def _format_time(value):
+    return value.isoformat(timespec='seconds') if value else None
+
+
+def job_to_dict(job):
+    return {
+        'id': job.id,
+        'job_type': job.job_type,
+        'status': job.status,
+        'params': json.loads(job.params or '{}'),
+        'result': json.loads(job.result) if job.result else None,
+        'error': job.error,
+        'progress': job.progress,
+        'message': job.message,
+        'attempts': job.attempts,
+        'cancel_requested': job.cancel_requested,
+        'created_at': _format_time(job.created_at),
+        'started_at': _format_time(job.started_at),
+        'finished_at': _format_time(job.finished_at),
+    }
+
+
+class JobContext:
+    """
+    传给任务函数的上下文：读取参数、报告进度、检查是否被取消
+    """
+
+    # 两次进度更新、两次读取取消标记的最小间隔（秒），任务函数可以在循环中随意调用
+    REPORT_INTERVAL = 0.5
+    CANCEL_CHECK_INTERVAL = 0.5
+
+    def __init__(self, queue, job_id, params):
+        self.queue = queue
+        self.job_id = job_id
+        self.params = params
+        self._last_report = 0
+        self._last_cancel_check = 0
+
+    def report(self, progress, message=None):
+        now = time.monotonic()
+        if progress < 100 and now - self._last_report < self.REPORT_INTERVAL:
+            return
+        self._last_report = now
+        values = {'progress': max(0, min(100, int(progress))), 'heartbeat_at': datetime.datetime.now()}
+        if message is not None:
+            values['message'] = message[:255]
+        self.queue._update_job(self.job_id, **values)
+
+    def check_cancelled(self):
+        now = time.monotonic()
+        if now - self._last_cancel_check < self.CANCEL_CHECK_INTERVAL:
+            return
+        self._last_cancel_check = now
+        if self.queue._is_cancel_requested(self.job_id):
+            raise JobCancelled('任务已取消')
+
+
+class JobQueue:
+    """
+    基于SQLite的后台任务队列
+    :param handlers: {任务类型: 任务函数}，任务函数接收 JobContext，返回可JSON序列化的结果（通常包含message）
+    """
+
+    def __init__(self, app, db, Job, handlers):
+        self.app = app
+        self.db = db
+        self.Job = Job
+        self.handlers = dict(handlers)
+        self.threads = app.config.get('JOB_WORKER_THREADS', DEFAULT_JOB_WORKER_THREADS)
+        self.poll_interval = app.config.get('JOB_POLL_INTERVAL', DEFAULT_JOB_POLL_INTERVAL)
+        self.heartbeat_interval = app.config.get('JOB_HEARTBEAT_INTERVAL', DEFAULT_JOB_HEARTBEAT_INTERVAL)
+        self.stale_seconds = app.config.get('JOB_STALE_SECONDS', DEFAULT_JOB_STALE_SECONDS)
+        self.max_attempts = app.config.get('JOB_MAX_ATTEMPTS', DEFAULT_JOB_MAX_ATTEMPTS)
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._running = set()
+        self._started_pid = None
+        self._last_recovery = 0
+        # 周期性检查：[函数, 间隔秒数, 下次执行时间]
+        self._periodic = []
+
+    # ---- 提交和管理任务（在请求中调用） ----
+
+    def enqueue(self, job_type, params=None):
+        """
+        提交任务；已有参数相同的任务在排队时直接返回该任务
+        :return: Job实例
+        """
+        if job_type not in self.handlers:
+            raise ValueError(f'未知的任务类型: {job_type}')
+        Job = self.Job
+        params_text = json.dumps(params or {}, ensure_ascii=False, sort_keys=True)
+        tenant = current_tenant_name()
+        job = Job.query.filter_by(job_type=job_type, tenant=tenant, status=JOB_QUEUED, params=params_text).first()
+        if job is None:
+            job = Job(job_type=job_type, tenant=tenant, status=JOB_QUEUED, params=params_text,
+                      max_attempts=self.max_attempts, message='等待执行')
+            self.db.session.add(job)
+            self.db.session.commit()
+        # 当前进程还没有工作线程时（如开发服务器）顺便启动
+        self.start()
+        self._wake.set()
+        return job
+
+    def cancel(self, job_id):
+        """
+        取消任务：排队中的任务直接取消，运行中的任务设置取消标记
+        :return: (是否成功, 消息)
+        """
+        job = self.db.session.get(self.Job, job_id)
+        if job is None or job.tenant != current_tenant_name():
+            return False, '任务不存在'
+        if job.status == JOB_QUEUED:
+            job.status = JOB_CANCELLED
+            job.message = '任务已取消'
+            job.finished_at = datetime.datetime.now()
+            self.db.session.commit()
+            return True, '任务已取消'
+        if job.status == JOB_RUNNING:
+            job.cancel_requested = True
+            self.db.session.commit()
+            return True, '已请求取消，任务会在安全的位置停止'
+        return False, '任务已结束，无法取消'
+
+    def add_periodic(self, func, interval):
+        """
+        注册周期性检查：工作线程每隔 interval 秒在应用上下文中调用一次 func()（通常用于按条件提交任务）
+        每个进程各自执行，func 需要自己避免重复提交
+        """
+        self._periodic.append([func, interval, 0])
+
+    # ---- 工作线程 ----
+
+    def start(self):
+        """
+        在当前进程中启动工作线程和心跳线程（fork出的子进程需要重新启动）
+        """
+        if self.threads <= 0:
+            return
+        with self._lock:
+            if self._started_pid == os.getpid():
+                return
+            self._started_pid = os.getpid()
+            self._running = set()
+            self._stop.clear()
+        for index in range(self.threads):
+            threading.Thread(target=self._worker_loop, name=f'job-worker-{index}', daemon=True).start()
+        threading.Thread(target=self._heartbeat_loop, name='job-heartbeat', daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def run_forever(self):
+        """
+        在当前线程中持续执行任务，用于独立的任务进程
+        """
+        threading.Thread(target=self._heartbeat_loop, name='job-heartbeat', daemon=True).start()
+        self._worker_loop()
+
+    def run_pending(self):
+        """
+        在当前线程中执行完所有可执行的任务后返回（命令行和性能测试使用）
+        :return: 执行的任务数量
+        """
+        count = 0
+        while not self._stop.is_set():
+            with self.app.app_context():
+                self._recover_stale_jobs()
+                job_id = self._claim()
+            if job_id is None:
+                return count
+            self._execute(job_id)
+            count += 1
+        return count
+
+    def _run_periodic(self):
+        now = time.monotonic()
+        with self._lock:
+            due = [entry for entry in self._periodic if entry[2] <= now]
+            for entry in due:
+                entry[2] = now + entry[1]
+        for func, _, _ in due:
+            try:
+                with self.app.app_context():
+                    func()
+            except Exception:
+                self.app.logger.exception('周期性检查出错')
+
+    def _worker_loop(self):
+        while not self._stop.is_set():
+            try:
+                self._run_periodic()
+                if self.run_pending() == 0:
+                    self._wake.wait(self.poll_interval)
+                    self._wake.clear()
+            except Exception:
+                self.app.logger.exception('后台任务工作线程出错')
+                time.sleep(self.poll_interval)
+
+    def _heartbeat_loop(self):
+        while not self._stop.wait(self.heartbeat_interval):
+            with self._lock:
+                job_ids = list(self._running)
+            if not job_ids:
+                continue
+            table = self.Job.__table__
+            with self.app.app_context():
+                self._execute_update(table.update().where(table.c.id.in_(job_ids))
+                                     .values(heartbeat_at=datetime.datetime.now()))
+
+    def _worker_name(self):
+        return f'{socket.gethostname()}:{os.getpid()}:{threading.current_thread().name}'[:100]
+
+    def _claim(self):
+        """
+        取出最早排队、且同一租户的同类型没有运行中任务的任务，标记为运行中
+        :return: 任务ID，没有可执行的任务时返回None
+        """
+        Job = self.Job
+        db = self.db
+        running = db.aliased(Job)
+        busy = db.select(running.id).where(running.status == JOB_RUNNING, running.job_type == Job.job_type,
+                                           running.tenant == Job.tenant)
+        candidates = db.session.query(Job.id).filter(Job.status == JOB_QUEUED, ~busy.exists()) \
+            .order_by(Job.id).limit(5).all()
+        db.session.rollback()
+        for (job_id,) in candidates:
+            now = datetime.datetime.now()
+            try:
+                # 条件更新：其他进程已取走该任务时不会更新任何行
+                claimed = db.session.execute(
+                    db.update(Job).where(Job.id == job_id, Job.status == JOB_QUEUED).values(
+                        status=JOB_RUNNING, attempts=Job.attempts + 1, worker=self._worker_name(),
+                        started_at=now, heartbeat_at=now, progress=0, message='正在执行'
+                    ).execution_options(synchronize_session=False)
+                ).rowcount
+                db.session.commit()
+            except IntegrityError:
+                # 同一租户的同类型任务刚被其他进程开始执行
+                db.session.rollback()
+                continue
+            if claimed:
+                return job_id
+        return None
+
+    def _recover_stale_jobs(self):
+        """
+        心跳超时的运行中任务视为执行它的进程已崩溃：未超过最大次数的重新排队，否则标记失败
+        """
+        if time.monotonic() - self._last_recovery < self.heartbeat_interval:
+            return
+        self._last_recovery = time.monotonic()
+        Job = self.Job
+        db = self.db
+        stale_before = datetime.datetime.now() - datetime.timedelta(seconds=self.stale_seconds)
+        stale_jobs = Job.query.filter(Job.status == JOB_RUNNING, Job.heartbeat_at < stale_before).all()
+        for job in stale_jobs:
+            job.worker = None
+            if job.cancel_requested:
+                job.status = JOB_CANCELLED
+                job.message = '任务已取消'
+                job.finished_at = datetime.datetime.now()
+            elif job.attempts < job.max_attempts:
+                job.status = JOB_QUEUED
+                job.message = f'执行中断，等待第{job.attempts + 1}次执行'
+            else:
+                job.status = JOB_FAILED
+                job.error = job.message = f'执行{job.attempts}次均中断，已放弃'
+                job.finished_at = datetime.datetime.now()
+        db.session.commit()
+
+    def _execute(self, job_id):
+        with self.app.app_context():
+            job = self.db.session.get(self.Job, job_id)
+            job_type = job.job_type
+            tenant = job.tenant
+            context = JobContext(self, job_id, json.loads(job.params or '{}'))
+            self.db.session.rollback()
+            # 慢查询日志中记录执行语句的任务类型
+            g.job_type = job_type
+
+            with self._lock:
+                self._running.add(job_id)
+            try:
+                # 切换到提交任务的租户（任务表本身仍在主数据库中）
+                if tenant:
+                    use_tenant(tenant)
+                result = self.handlers[job_type](context)
+                self.db.session.commit()
+                message = result.get('message', '执行完成') if isinstance(result, dict) else '执行完成'
+                self._finish(job_id, job_type, JOB_SUCCEEDED, message, result=result)
+            except JobCancelled as e:
+                self.db.session.rollback()
+                self._finish(job_id, job_type, JOB_CANCELLED, str(e))
+            except Exception as e:
+                self.db.session.rollback()
+                self.app.logger.exception(f'后台任务 {job_id}（{job_type}）执行失败')
+                self._finish(job_id, job_type, JOB_FAILED, f'执行失败: {e}', error=str(e))
+            finally:
+                with self._lock:
+                    self._running.discard(job_id)
+
+    def _finish(self, job_id, job_type, status, message, result=None, error=None):
+        Job = self.Job
+        values = {
+            'status': status,
+            'message': message[:255],
+            'result': json.dumps(result, ensure_ascii=False) if result is not None else None,
+            'error': error,
+            'finished_at': datetime.datetime.now(),
+            'worker': None,
+        }
+        if status == JOB_SUCCEEDED:
+            values['progress'] = 100
+        updated = self.db.session.execute(
+            self.db.update(Job).where(Job.id == job_id).values(**values)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        if not updated:
+            # 恢复备份会整体替换数据库（包括job表），任务记录不存在时重新写入
+            self.db.session.add(Job(id=job_id, job_type=job_type, tenant=current_tenant_name(), attempts=1, **values))
+        self.db.session.commit()
+
+    # ---- 任务执行中的进度和取消标记（使用独立连接，不影响任务函数自己的事务） ----
+
+    def _execute_update(self, statement):
+        try:
+            with self.db.engine.begin() as connection:
+                connection.execute(statement)
+        except OperationalError:
+            # 数据库正忙时跳过本次更新，下次再写
+            pass
+
+    def _update_job(self, job_id, **values):
+        table = self.Job.__table__
+        self._execute_update(table.update().where(table.c.id == job_id).values(**values))
+
+    def _is_cancel_requested(self, job_id):
+        table = self.Job.__table__
+        with self.db.engine.connect() as connection:
+            return bool(connection.execute(
+                self.db.select(table.c.cancel_requested).where(table.c.id == job_id)
+            ).scalar())
+
+
+def init_job_queue(app, db, Job, handlers):
+    """
+    创建后台任务队列，保存在 app.extensions['job_queue'] 中
+    工作线程不在这里启动（gunicorn --preload 的主进程不执行任务），
+    由 gunicorn 的 post_fork、第一次提交任务或 python jobs.py 启动
+    :return: JobQueue实例
+    """
+    job_queue = JobQueue(app, db, Job, handlers)
+    app.extensions['job_queue'] = job_queue
+    return job_queue
+
+
+def enqueue_job(job_type, params=None):
+    """
+    向当前应用的任务队列提交任务
+    :return: Job实例
+    """
+    return current_app.extensions['job_queue'].enqueue(job_type, params)
+
+
+def register_job_routes(bp, db, Job):
+    # 任务列表
+    @bp.route('/admin/jobs')
+    def list_jobs():
+        limit = min(request.args.get('limit', 20, type=int), 100)
+        query = Job.query.filter_by(tenant=current_tenant_name())
+        job_type = request.args.get('type')
+        if job_type:
+            query = query.filter_by(job_type=job_type)
+        jobs = query.order_by(Job.id.desc()).limit(limit).all()
+        return jsonify({'success': True, 'jobs': [job_to_dict(job) for job in jobs]})
+
+    # 任务状态和进度
+    @bp.route('/admin/jobs/<int:job_id>')
+    def get_job(job_id):
+        job = db.session.get(Job, job_id)
+        if job is None or job.tenant != current_tenant_name():
+            return jsonify({'success': False, 'message': '任务不存在'}), 404
+        return jsonify({'success': True, 'job': job_to_dict(job)})
+
+    # 取消任务
+    @bp.route('/admin/jobs/<int:job_id>/cancel', methods=['POST'])
+    def cancel_job(job_id):
+        success, message = current_app.extensions['job_queue'].cancel(job_id)
+        return jsonify({'success': success, 'message': message})
+
+    return bp
+
+
+if __name__ == '__main__':
+    # 独立的任务进程: python jobs.py
+    # 与网页进程分开执行任务时，网页进程可设置 JOB_WORKER_THREADS = 0
+    from app import app
+
+    app.logger.info('后台任务进程已启动')
+    app.extensions['job_queue'].run_forever()
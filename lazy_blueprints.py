@@ -0,0 +1,73 @@
+import threading
+from flask import Blueprint, current_app
+
+# 延迟加载的蓝图
+# 只在后台使用的模块（备份、附件管理）在应用启动时只注册URL规则，
+# 第一次访问其中任意一个地址时才导入模块、注册路由函数
+# 参考 Flask 文档中的 "Lazily Loading Views"
+
+
+class _RouteCollector:
+    """
+    模拟蓝图注册时的状态对象，只收集视图函数而不修改应用
+    （应用处理过请求后不能再注册蓝图）
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.first_registration = True
+        self.views = {}
+
+    def add_url_rule(self, rule, endpoint=None, view_func=None, **options):
+        self.views[endpoint or view_func.__name__] = view_func
+
+
+class LazyBlueprint:
+    """
+    延迟加载的蓝图
+    :param name: 蓝图名称，与模块中 Blueprint(name, ...) 一致，决定 url_for 使用的端点前缀
+    :param rules: [(URL规则, 端点, 请求方法列表), ...]
+    :param loader: 加载函数，接收一个新的蓝图实例，导入模块并注册路由后返回该蓝图
+    """
+
+    def __init__(self, name, rules, loader):
+        self.name = name
+        self.rules = rules
+        self.loader = loader
+        self._views = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        # 每个应用一个副本，避免多个应用共享已加载的视图
+        lazy = LazyBlueprint(self.name, self.rules, self.loader)
+        views = {}
+        for rule, endpoint, methods in self.rules:
+            # 同一端点的多个URL规则必须使用同一个视图函数
+            if endpoint not in views:
+                views[endpoint] = lazy.view(endpoint)
+            app.add_url_rule(rule, f'{self.name}.{endpoint}', views[endpoint], methods=methods)
+        return lazy
+
+    @property
+    def loaded(self):
+        return self._views is not None
+
+    def view(self, endpoint):
+        def lazy_view(**kwargs):
+            return self._load()[endpoint](**kwargs)
+        lazy_view.__name__ = endpoint
+        return lazy_view
+
+    def _load(self):
+        if self._views is None:
+            with self._lock:
+                if self._views is None:
+                    bp = self.loader(Blueprint(self.name, __name__))
+                    collector = _RouteCollector(current_app._get_current_object())
+                    for deferred in bp.deferred_functions:
+                        deferred(collector)
+                    missing = {endpoint for _, endpoint, _ in self.rules} - set(collector.views)
+                    if missing:
+                        raise RuntimeError(f"延迟加载的蓝图 {self.name} 缺少路由: {', '.join(sorted(missing))}")
+                    self._views = collector.views
+        return self._views
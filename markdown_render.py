@@ -0,0 +1,215 @@
+import re
+from markupsafe import escape
+
+# 点滴瞬间的Markdown渲染
+# 保存点滴瞬间时把内容渲染成HTML存入 content_html 列，页面和API直接输出，查看时不再解析。
+# 只支持常用的一小部分语法，不依赖第三方库：
+#     段落（段内换行保留为 <br>）、# 标题、> 引用、- 列表、1. 列表、--- 分隔线、``` 代码块、
+#     **粗体**、*斜体*、~~删除线~~、`代码`、[链接](https://...)、自动识别的网址、:heart: 等表情
+# 输入中的HTML全部转义，只输出这里生成的标签，链接只允许 http(s)、mailto 和站内路径，因此结果不需要再清理。
+# 修改渲染规则后递增 MARKDOWN_VERSION，再执行 python markdown_render.py 重新渲染已有的点滴瞬间。
+
+MARKDOWN_VERSION = 2
+
+# 表情短代码
+EMOJI = {
+    'heart': '❤️', 'two_hearts': '💕', 'sparkling_heart': '💖', 'broken_heart': '💔', 'couple': '💑',
+    'kiss': '💋', 'ring': '💍', 'rose': '🌹', 'bouquet': '💐', 'gift': '🎁', 'cake': '🎂', 'tada': '🎉',
+    'balloon': '🎈', 'sparkles': '✨', 'star': '⭐', 'sunny': '☀️', 'moon': '🌙', 'rainbow': '🌈',
+    'snowflake': '❄️', 'christmas_tree': '🎄', 'fire': '🔥', 'camera': '📷', 'airplane': '✈️',
+    'coffee': '☕', 'pizza': '🍕', 'cat': '🐱', 'dog': '🐶', 'pig': '🐷', 'rabbit': '🐰', 'bear': '🐻',
+    'smile': '😄', 'blush': '😊', 'wink': '😉', 'joy': '😂', 'heart_eyes': '😍', 'kissing_heart': '😘',
+    'hug': '🤗', 'cry': '😢', 'sob': '😭', 'angry': '😠', 'sleepy': '😪', 'thinking': '🤔',
+    'thumbsup': '👍', '+1': '👍', 'ok_hand': '👌', 'clap': '👏', 'pray': '🙏',
+}
+
+# 站内标题从 h3 开始，避免在卡片中过大
+HEADING_OFFSET = 2
+
+_FENCE = re.compile(r'^\s*```')
+_HEADING = re.compile(r'^(#{1,6})\s+(.*?)\s*#*\s*$')
+_RULE = re.compile(r'^\s*([-*_])(\s*\1){2,}\s*$')
+_QUOTE = re.compile(r'^\s*>\s?(.*)$')
+_UNORDERED = re.compile(r'^\s*[-*+]\s+(.*)$')
+_ORDERED = re.compile(r'^\s*\d{1,9}[.)]\s+(.*)$')
+
+_CODE_SPAN = re.compile(r'`([^`]+)`')
+_LINK = re.compile(r'\[([^\]\n]+)\]\(\s*([^\s)]+)\s*\)')
+_AUTOLINK = re.compile(r'(?<![A-Za-z0-9/])https?://[^\s<>\x00]+[^\s<>\x00.,;:!?)\]）。，；：！？]')
+_STRONG = re.compile(r'(\*\*|__)(?=\S)(.+?)(?<=\S)\1')
+_EM = re.compile(r'(?<!\*)\*(?=\S)(.+?)(?<=\S)\*(?!\*)')
+_DEL = re.compile(r'~~(?=\S)(.+?)(?<=\S)~~')
+_EMOJI = re.compile(r':([a-z0-9_+]+):')
+_PLACEHOLDER = re.compile('\x00(\\d+)\x00')
+# 站内路径不能以 // 或 /\ 开头（浏览器把 /\ 当作 //，会变成指向其他网站的链接）
+_SAFE_URL = re.compile(r'^(https?://|mailto:|/(?![/\\]))', re.IGNORECASE)
+
+
+def _link(url, text):
+    return f'<a href="{url}" rel="nofollow noopener noreferrer">{text}</a>'
+
+
+def render_inline(text):
+    """
+    渲染一行中的行内语法
+    :param text: 未转义的文本
+    :return: HTML
+    """
+    # 代码和链接先换成占位符，其中的内容不再处理其他语法
+    protected = []
+
+    def protect(html):
+        protected.append(html)
+        return f'\x00{len(protected) - 1}\x00'
+
+    text = str(escape(text.replace('\x00', '')))
+    text = _CODE_SPAN.sub(lambda m: protect(f'<code>{m.group(1)}</code>'), text)
+
+    def replace_link(match):
+        label, url = match.groups()
+        if not _SAFE_URL.match(url):
+            return match.group(0)
+        return protect(_link(url, label))
+
+    text = _LINK.sub(replace_link, text)
+    text = _AUTOLINK.sub(lambda m: protect(_link(m.group(0), m.group(0))), text)
+    text = _STRONG.sub(r'<strong>\2</strong>', text)
+    text = _EM.sub(r'<em>\1</em>', text)
+    text = _DEL.sub(r'<del>\1</del>', text)
+    text = _EMOJI.sub(lambda m: EMOJI.get(m.group(1), m.group(0)), text)
+    # 链接文字中可能还有代码的占位符
+    while _PLACEHOLDER.search(text):
+        text = _PLACEHOLDER.sub(lambda m: protected[int(m.group(1))], text)
+    return text
+
+
+def render_markdown(text):
+    """
+    把Markdown文本渲染为HTML
+    :param text: Markdown文本
+    :return: HTML（已转义，可直接输出）
+    """
+    lines = (text or '').replace('\r\n', '\n').replace('\r', '\n').split('\n')
+    blocks = []
+    paragraph = []
+    index = 0
+
+    def flush_paragraph():
+        if paragraph:
+            blocks.append('<p>' + '<br>'.join(render_inline(line.strip()) for line in paragraph) + '</p>')
+            paragraph.clear()
+
+    while index < len(lines):
+        line = lines[index]
+        if not line.strip():
+            flush_paragraph()
+            index += 1
+            continue
+
+        if _FENCE.match(line):
+            flush_paragraph()
+            code = []
+            index += 1
+            while index < len(lines) and not _FENCE.match(lines[index]):
+                code.append(lines[index])
+                index += 1
+            blocks.append(f'<pre><code>{escape(chr(10).join(code))}</code></pre>')
+            index += 1
+            continue
+
+        heading = _HEADING.match(line)
+        if heading:
+            flush_paragraph()
+            level = min(len(heading.group(1)) + HEADING_OFFSET, 6)
+            blocks.append(f'<h{level}>{render_inline(heading.group(2))}</h{level}>')
+            index += 1
+            continue
+
+        if _RULE.match(line):
+            flush_paragraph()
+            blocks.append('<hr>')
+            index += 1
+            continue
+
+        if _QUOTE.match(line):
+            flush_paragraph()
+            quoted = []
+            while index < len(lines) and _QUOTE.match(lines[index]):
+                quoted.append(_QUOTE.match(lines[index]).group(1))
+                index += 1
+            blocks.append(f'<blockquote>{render_markdown(chr(10).join(quoted))}</blockquote>')
+            continue
+
+        for pattern, tag in ((_UNORDERED, 'ul'), (_ORDERED, 'ol')):
+            if pattern.match(line):
+                flush_paragraph()
+                items = []
+                while index < len(lines) and pattern.match(lines[index]):
+                    items.append(f'<li>{render_inline(pattern.match(lines[index]).group(1))}</li>')
+                    index += 1
+                blocks.append(f'<{tag}>{"".join(items)}</{tag}>')
+                break
+        else:
+            paragraph.append(line)
+            index += 1
+
+    flush_paragraph()
+    return '\n'.join(blocks)
+
+
+def rendered_content(content):
+    """
+    :return: 点滴瞬间的 content_html 和 content_html_version 列的值
+    """
+    return {'content_html': render_markdown(content), 'content_html_version': MARKDOWN_VERSION}
+
+
+def rerender_moments(db, force=False, batch_size=500, context=None):
+    """
+    重新渲染 content_html 为空或渲染版本不是当前版本的点滴瞬间
+    :param force: 是否重新渲染所有点滴瞬间
+    :param context: 后台任务上下文（可选），用于报告进度和检查取消
+    :return: 重新渲染的数量
+    """
+    from data_versions import bump_data_version
+
+    query = 'SELECT id, content FROM moment'
+    if not force:
+        query += ' WHERE content_html IS NULL OR content_html_version IS NULL OR content_html_version != :version'
+    rows = db.session.execute(db.text(query), {'version': MARKDOWN_VERSION}).all()
+    for start in range(0, len(rows), batch_size):
+        if context:
+            context.check_cancelled()
+            context.report(start * 100 // len(rows), f'正在渲染点滴瞬间（{start}/{len(rows)}）')
+        db.session.execute(
+            db.text('UPDATE moment SET content_html = :content_html, content_html_version = :content_html_version '
+                    'WHERE id = :id'),
+            [dict(rendered_content(content), id=moment_id) for moment_id, content in rows[start:start + batch_size]]
+        )
+        db.session.commit()
+    if rows:
+        bump_data_version(db, 'moment')
+        db.session.commit()
+    return len(rows)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='重新渲染点滴瞬间的Markdown（修改 MARKDOWN_VERSION 后执行）')
+    parser.add_argument('--all', action='store_true', help='重新渲染所有点滴瞬间，而不只是版本过期的')
+    parser.add_argument('--tenant', help='只处理指定租户（多租户模式下默认处理所有租户）')
+    args = parser.parse_args()
+
+    from app import app, db
+    from tenants import use_tenant
+
+    pool = app.extensions.get('tenant_pool')
+    with app.app_context():
+        if pool is None:
+            print(f'已渲染 {rerender_moments(db, force=args.all)} 条点滴瞬间')
+        else:
+            for name in [args.tenant] if args.tenant else pool.names():
+                use_tenant(name)
+                print(f'{name}: 已渲染 {rerender_moments(db, force=args.all)} 条点滴瞬间')
+                db.session.remove()
@@ -0,0 +1,232 @@
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from flask import Blueprint, Response, current_app, g, has_app_context, has_request_context, request
+from sqlalchemy import event
+
+# 创建性能指标蓝图
+metrics_bp = Blueprint('metrics', __name__)
+
+# 请求耗时直方图的分桶上限（秒）
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# 多进程部署时各工作进程写入指标快照的间隔（秒）
+DEFAULT_METRICS_FLUSH_INTERVAL = 5
+
+
+def _new_series():
+    return {
+        'count': 0,
+        'sum': 0.0,
+        # 每个分桶单独计数，输出时再累加为Prometheus要求的累计值
+        'buckets': [0] * (len(LATENCY_BUCKETS) + 1),
+        'sql_count': 0,
+        'sql_seconds': 0.0,
+        'response_bytes': 0,
+    }
+
+
+def _merge_series(target, source):
+    target['count'] += source['count']
+    target['sum'] += source['sum']
+    target['buckets'] = [a + b for a, b in zip(target['buckets'], source['buckets'])]
+    target['sql_count'] += source['sql_count']
+    target['sql_seconds'] += source['sql_seconds']
+    target['response_bytes'] += source['response_bytes']
+
+
+class RouteMetrics:
+    """
+    按(端点, 请求方法, 状态码)统计请求耗时、SQL语句数量和耗时、响应字节数
+    每个进程单独计数；设置了 metrics_dir 时定期把本进程的数据写入 <metrics_dir>/<pid>.json，
+    输出时合并所有工作进程的数据
+    """
+
+    def __init__(self, metrics_dir=None, flush_interval=DEFAULT_METRICS_FLUSH_INTERVAL):
+        self.metrics_dir = metrics_dir
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._series = {}
+        self._last_flush = time.monotonic()
+
+    def record(self, key, duration, sql_count, sql_seconds, response_bytes):
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = _new_series()
+            series['count'] += 1
+            series['sum'] += duration
+            series['buckets'][bisect_left(LATENCY_BUCKETS, duration)] += 1
+            series['sql_count'] += sql_count
+            series['sql_seconds'] += sql_seconds
+            series['response_bytes'] += response_bytes
+
+        if self.metrics_dir and time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def snapshot(self):
+        with self._lock:
+            return {key: dict(series, buckets=list(series['buckets'])) for key, series in self._series.items()}
+
+    def _snapshot_path(self, pid):
+        return os.path.join(self.metrics_dir, f'{pid}.json')
+
+    def flush(self):
+        """
+        把本进程的数据写入快照文件（先写临时文件再替换，读取方不会读到写了一半的文件）
+        """
+        self._last_flush = time.monotonic()
+        os.makedirs(self.metrics_dir, exist_ok=True)
+        path = self._snapshot_path(os.getpid())
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump([[list(key), series] for key, series in self.snapshot().items()], f)
+        os.replace(temp_path, path)
+
+    def collect(self):
+        """
+        合并所有进程的数据：本进程使用内存中的最新数据，其他进程读取快照文件
+        已退出的工作进程的快照文件保留，计数器不会因为工作进程重启而减少
+        """
+        merged = self.snapshot()
+        if not self.metrics_dir or not os.path.isdir(self.metrics_dir):
+            return merged
+
+        own_file = f'{os.getpid()}.json'
+        for filename in os.listdir(self.metrics_dir):
+            if not filename.endswith('.json') or filename == own_file:
+                continue
+            try:
+                with open(os.path.join(self.metrics_dir, filename), encoding='utf-8') as f:
+                    items = json.load(f)
+            except (OSError, ValueError):
+                continue
+            for key, series in items:
+                key = tuple(key)
+                if key in merged:
+                    _merge_series(merged[key], series)
+                else:
+                    merged[key] = series
+        return merged
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render_prometheus(series_map):
+    """
+    按Prometheus文本格式输出指标
+    :param series_map: {(端点, 请求方法, 状态码): 统计数据}
+    :return: 文本
+    """
+    items = sorted(series_map.items())
+    lines = [
+        '# HELP loveblog_request_duration_seconds 请求处理耗时',
+        '# TYPE loveblog_request_duration_seconds histogram',
+    ]
+    label_texts = []
+    for (endpoint, method, status), series in items:
+        labels = f'endpoint="{_escape_label(endpoint)}",method="{method}",status="{status}"'
+        label_texts.append(labels)
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS, series['buckets']):
+            cumulative += count
+            lines.append(f'loveblog_request_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f'loveblog_request_duration_seconds_bucket{{{labels},le="+Inf"}} {series["count"]}')
+        lines.append(f'loveblog_request_duration_seconds_sum{{{labels}}} {series["sum"]:.6f}')
+        lines.append(f'loveblog_request_duration_seconds_count{{{labels}}} {series["count"]}')
+
+    counters = [
+        ('loveblog_sql_statements_total', 'SQL语句执行次数', 'sql_count', '{}'),
+        ('loveblog_sql_duration_seconds_total', 'SQL语句执行耗时', 'sql_seconds', '{:.6f}'),
+        ('loveblog_response_bytes_total', '响应体字节数', 'response_bytes', '{}'),
+    ]
+    for name, help_text, field, value_format in counters:
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} counter')
+        for labels, (_, series) in zip(label_texts, items):
+            lines.append(f'{name}{{{labels}}} {value_format.format(series[field])}')
+
+    return '\n'.join(lines) + '\n'
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info['metrics_query_start'] = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.pop('metrics_query_start', None)
+    if started is None or not has_app_context():
+        return
+    elapsed = time.perf_counter() - started
+    # 超过阈值的语句写入慢查询日志（见 slow_queries.py）
+    slow_query_log = current_app.extensions.get('slow_query_log')
+    if slow_query_log is not None and elapsed >= slow_query_log.threshold:
+        slow_query_log.record(cursor, statement, parameters, executemany, elapsed)
+    if not has_request_context():
+        return
+    g.metrics_sql_count = g.get('metrics_sql_count', 0) + 1
+    g.metrics_sql_seconds = g.get('metrics_sql_seconds', 0.0) + elapsed
+
+
+def _start_request_timer():
+    g.metrics_started = time.perf_counter()
+
+
+def _record_request(response):
+    started = g.pop('metrics_started', None)
+    if started is None:
+        return response
+    route_metrics = current_app.extensions['route_metrics']
+    route_metrics.record(
+        (request.endpoint or 'unmatched', request.method, response.status_code),
+        time.perf_counter() - started,
+        g.pop('metrics_sql_count', 0),
+        g.pop('metrics_sql_seconds', 0.0),
+        # 流式响应没有Content-Length，按0计
+        response.content_length or 0,
+    )
+    return response
+
+
+def watch_engine(engine):
+    """
+    统计该引擎执行的SQL语句并记录慢查询（主数据库之外的引擎，如租户数据库，打开时调用）
+    """
+    event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+
+
+def init_metrics(app, db):
+    """
+    为应用启用请求指标统计，需在 db.init_app(app) 之后调用
+    :param app: Flask应用实例
+    :param db: SQLAlchemy实例
+    :return: RouteMetrics实例
+    """
+    route_metrics = RouteMetrics(
+        app.config.get('METRICS_DIR'),
+        app.config.get('METRICS_FLUSH_INTERVAL', DEFAULT_METRICS_FLUSH_INTERVAL),
+    )
+    app.extensions['route_metrics'] = route_metrics
+
+    with app.app_context():
+        watch_engine(db.engine)
+
+    app.before_request(_start_request_timer)
+    app.after_request(_record_request)
+    return route_metrics
+
+
+def register_metrics_routes(bp):
+    # Prometheus抓取接口
+    @bp.route('/admin/metrics')
+    def metrics():
+        route_metrics = current_app.extensions['route_metrics']
+        return Response(render_prometheus(route_metrics.collect()),
+                        content_type='text/plain; version=0.0.4; charset=utf-8')
+
+    return bp
@@ -0,0 +1,226 @@
+from flask import has_app_context
+from sqlite_engine import get_write_queue
+
+# 数据库结构迁移
+# db.create_all() 只会创建不存在的表，不会修改已有的表，
+# 已有数据库需要按版本号依次执行下面的迁移。当前版本号保存在 SQLite 的 PRAGMA user_version 中。
+# 每个迁移都可以重复执行（新建数据库时表已按最新结构创建，迁移不会重复修改）
+
+
+def _table_columns(db, table):
+    return {row[1] for row in db.session.execute(db.text(f'PRAGMA table_info({table})'))}
+
+
+def _index_exists(db, name):
+    return db.session.execute(
+        db.text("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = :name"),
+        {'name': name}
+    ).first() is not None
+
+
+# 1. 纪念日排序值唯一索引
+def migrate_anniversary_sort_order_index(db):
+    if _index_exists(db, 'ix_anniversary_sort_order'):
+        return
+
+    # 旧数据中可能有重复的排序值，先按(排序值, ID)重新编号为1..N
+    duplicated = db.session.execute(db.text(
+        'SELECT 1 FROM anniversary GROUP BY sort_order HAVING COUNT(*) > 1 LIMIT 1'
+    )).first()
+    if duplicated:
+        ids = db.session.execute(db.text('SELECT id FROM anniversary ORDER BY sort_order, id')).scalars().all()
+        table = db.table('anniversary', db.column('id'), db.column('sort_order'))
+        db.session.execute(
+            table.update().values(sort_order=db.case({id: index + 1 for index, id in enumerate(ids)}, value=table.c.id))
+        )
+
+    db.session.execute(db.text(
+        'CREATE UNIQUE INDEX IF NOT EXISTS ix_anniversary_sort_order ON anniversary (sort_order)'
+    ))
+
+
+# 2. 纪念日重复规则和预先计算的下一次日期
+def migrate_anniversary_recurrence(db):
+    columns = _table_columns(db, 'anniversary')
+    if 'recurrence' not in columns:
+        db.session.execute(db.text(
+            "ALTER TABLE anniversary ADD COLUMN recurrence VARCHAR(20) NOT NULL DEFAULT 'none'"
+        ))
+    if 'next_date' not in columns:
+        db.session.execute(db.text('ALTER TABLE anniversary ADD COLUMN next_date DATE'))
+        db.session.execute(db.text('UPDATE anniversary SET next_date = date'))
+    db.session.execute(db.text(
+        'CREATE INDEX IF NOT EXISTS ix_anniversary_next_date ON anniversary (next_date)'
+    ))
+
+
+# 3. 热点查询索引
+def migrate_hot_path_indexes(db):
+    # 按图片路径查附件（删除点滴瞬间、扫描附件引用）
+    db.session.execute(db.text('CREATE INDEX IF NOT EXISTS ix_attachment_filepath ON attachment (filepath)'))
+    # 首页按标题查"我们在一起啦"
+    db.session.execute(db.text('CREATE INDEX IF NOT EXISTS ix_anniversary_title ON anniversary (title)'))
+    # 点滴瞬间按创建时间倒序排列
+    db.session.execute(db.text('CREATE INDEX IF NOT EXISTS ix_moment_created_at ON moment (created_at)'))
+    # 附件管理按上传时间排序、按引用状态过滤
+    db.session.execute(db.text('CREATE INDEX IF NOT EXISTS ix_attachment_upload_date ON attachment (upload_date)'))
+    db.session.execute(db.text('CREATE INDEX IF NOT EXISTS ix_attachment_is_referenced ON attachment (is_referenced)'))
+
+
+# 4. 附件的图片感知哈希（已有附件由"查找相似图片"任务补算）
+def migrate_attachment_phash(db):
+    if 'phash' not in _table_columns(db, 'attachment'):
+        db.session.execute(db.text('ALTER TABLE attachment ADD COLUMN phash VARCHAR(16)'))
+
+
+# 5. 点滴瞬间的月日列和索引（"那年今日"）
+def migrate_moment_month_day(db):
+    if 'month_day' not in _table_columns(db, 'moment'):
+        db.session.execute(db.text('ALTER TABLE moment ADD COLUMN month_day VARCHAR(5)'))
+    db.session.execute(db.text(
+        "UPDATE moment SET month_day = strftime('%m-%d', created_at) WHERE month_day IS NULL"
+    ))
+    db.session.execute(db.text(
+        'CREATE INDEX IF NOT EXISTS ix_moment_month_day ON moment (month_day, created_at)'
+    ))
+
+
+# 6. 后台任务的租户列（多租户时所有租户共用主数据库中的任务表），同一租户的同类任务同一时间只能运行一个
+def migrate_job_tenant(db):
+    columns = _table_columns(db, 'job')
+    # 租户数据库中没有任务表
+    if not columns:
+        return
+    if 'tenant' not in columns:
+        db.session.execute(db.text("ALTER TABLE job ADD COLUMN tenant VARCHAR(64) NOT NULL DEFAULT ''"))
+    db.session.execute(db.text('DROP INDEX IF EXISTS ix_job_running_type'))
+    db.session.execute(db.text(
+        "CREATE UNIQUE INDEX ix_job_running_type ON job (job_type, tenant) WHERE status = 'running'"
+    ))
+
+
+# 7. 附件所在的打包文件、偏移和长度
+def migrate_attachment_pack(db):
+    columns = _table_columns(db, 'attachment')
+    if 'pack_file' not in columns:
+        db.session.execute(db.text('ALTER TABLE attachment ADD COLUMN pack_file VARCHAR(64)'))
+    if 'pack_offset' not in columns:
+        db.session.execute(db.text('ALTER TABLE attachment ADD COLUMN pack_offset INTEGER'))
+    if 'pack_length' not in columns:
+        db.session.execute(db.text('ALTER TABLE attachment ADD COLUMN pack_length INTEGER'))
+
+
+# 8. 点滴瞬间预先渲染的Markdown HTML，已有的点滴瞬间在迁移时渲染
+def migrate_moment_content_html(db):
+    from markdown_render import rendered_content
+
+    columns = _table_columns(db, 'moment')
+    if 'content_html' not in columns:
+        db.session.execute(db.text('ALTER TABLE moment ADD COLUMN content_html TEXT'))
+    if 'content_html_version' not in columns:
+        db.session.execute(db.text('ALTER TABLE moment ADD COLUMN content_html_version INTEGER'))
+    rows = db.session.execute(db.text('SELECT id, content FROM moment WHERE content_html IS NULL')).all()
+    if rows:
+        db.session.execute(
+            db.text('UPDATE moment SET content_html = :content_html, content_html_version = :content_html_version '
+                    'WHERE id = :id'),
+            [dict(rendered_content(content), id=moment_id) for moment_id, content in rows]
+        )
+
+
+# 9. 批量导入的点滴瞬间的导入标识
+def migrate_moment_import_key(db):
+    if 'import_key' not in _table_columns(db, 'moment'):
+        db.session.execute(db.text('ALTER TABLE moment ADD COLUMN import_key VARCHAR(32)'))
+    db.session.execute(db.text('CREATE UNIQUE INDEX IF NOT EXISTS ix_moment_import_key ON moment (import_key)'))
+
+
+# 10. 附件表改为 AUTOINCREMENT，删除的附件ID不再复用（SQLite不能修改主键，需要重建表）
+def migrate_attachment_autoincrement(db):
+    table_sql = db.session.execute(
+        db.text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'attachment'")
+    ).scalar()
+    if not table_sql or 'AUTOINCREMENT' in table_sql.upper():
+        return
+    columns = ', '.join(_table_columns(db, 'attachment') & set(db.metadata.tables['attachment'].columns.keys()))
+    db.session.execute(db.text('ALTER TABLE attachment RENAME TO attachment_old'))
+    # 旧表的索引随表改名，先删除，新表按模型重新创建同名索引
+    for (index_name,) in db.session.execute(db.text(
+            "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'attachment_old' AND sql IS NOT NULL"
+    )).all():
+        db.session.execute(db.text(f'DROP INDEX {index_name}'))
+    db.metadata.tables['attachment'].create(bind=db.session.connection())
+    db.session.execute(db.text(f'INSERT INTO attachment ({columns}) SELECT {columns} FROM attachment_old'))
+    db.session.execute(db.text('DROP TABLE attachment_old'))
+
+
+# 迁移列表：(版本号, 名称, 迁移函数)，版本号只能递增，已发布的迁移不要修改
+MIGRATIONS = [
+    (1, 'anniversary_sort_order_index', migrate_anniversary_sort_order_index),
+    (2, 'anniversary_recurrence', migrate_anniversary_recurrence),
+    (3, 'hot_path_indexes', migrate_hot_path_indexes),
+    (4, 'attachment_phash', migrate_attachment_phash),
+    (5, 'moment_month_day', migrate_moment_month_day),
+    (6, 'job_tenant', migrate_job_tenant),
+    (7, 'attachment_pack', migrate_attachment_pack),
+    (8, 'moment_content_html', migrate_moment_content_html),
+    (9, 'moment_import_key', migrate_moment_import_key),
+    (10, 'attachment_autoincrement', migrate_attachment_autoincrement),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def get_schema_version(db):
+    return db.session.execute(db.text('PRAGMA user_version')).scalar()
+
+
+def run_migrations(db, logger=None):
+    """
+    执行所有未执行的迁移，执行过迁移后运行ANALYZE更新查询规划统计信息
+    需在应用上下文中、db.create_all() 之后调用
+    :param db: SQLAlchemy实例
+    :param logger: 日志对象（可选）
+    :return: 本次执行的迁移名称列表
+    """
+    # 多个进程同时启动时，通过写队列保证只有一个进程执行迁移
+    write_queue = get_write_queue() if has_app_context() else None
+    if write_queue is not None:
+        write_queue.acquire()
+    try:
+        current_version = get_schema_version(db)
+        applied = []
+        for version, name, migrate in MIGRATIONS:
+            if version <= current_version:
+                continue
+            migrate(db)
+            db.session.execute(db.text(f'PRAGMA user_version = {int(version)}'))
+            db.session.commit()
+            applied.append(name)
+            if logger:
+                logger.info(f'已执行数据库迁移 {version}: {name}')
+
+        if applied:
+            db.session.execute(db.text('ANALYZE'))
+            db.session.commit()
+        return applied
+    except Exception:
+        db.session.rollback()
+        raise
+    finally:
+        if write_queue is not None:
+            write_queue.release()
+
+
+if __name__ == '__main__':
+    # 命令行用法:
+    #   python migrations.py          查看当前版本
+    #   python migrations.py upgrade  执行未执行的迁移
+    import sys
+    from app import app, db
+
+    with app.app_context():
+        if len(sys.argv) > 1 and sys.argv[1] == 'upgrade':
+            applied = run_migrations(db)
+            print(f"已执行迁移: {', '.join(applied)}" if applied else '没有需要执行的迁移')
+        print(f'当前数据库版本: {get_schema_version(db)}，最新版本: {LATEST_VERSION}')
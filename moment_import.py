@@ -0,0 +1,387 @@
+import csv
+import datetime
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import posixpath
+import re
+import shutil
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from flask import Blueprint, current_app, jsonify, request
+from werkzeug.utils import secure_filename
+from data_versions import bump_data_version
+from image_hash import compute_image_hash
+from jobs import enqueue_job
+from markdown_render import rendered_content
+from moments import allowed_file
+from tenants import get_upload_folder
+
+# 批量导入点滴瞬间
+# 从目录或zip压缩包导入照片和文字，压缩包（或目录）中需要有一个清单文件 moments.json / moments.csv：
+#     JSON: [{"content": "文字", "created_at": "2021-05-20 13:14", "images": ["photos/1.jpg", ...]}, ...]
+#           （也可以是 {"moments": [...]}）
+#     CSV:  表头为 content,created_at,images，多张图片用 ; 或 | 分隔
+# 字段也可以写成 text / timestamp、time、date / photos，时间可以是ISO格式、"2021年5月20日 13:14" 或Unix时间戳，
+# 图片路径相对于清单文件所在目录。聊天记录等其他来源的导出先转换成这种清单即可导入。
+# - 图片在进程池中复制到上传目录并计算感知哈希，数据库写入按批提交，每批同时写入点滴瞬间和附件记录
+# - 每条记录按时间、内容和图片路径计算导入标识保存在 moment.import_key 中，重复导入同一清单时跳过已导入的记录；
+#   有图片复制失败的记录不会写入，重新导入时再次尝试
+# 命令行：python moment_import.py 目录或压缩包 [--manifest 清单路径] [--tenant 租户]
+# 管理页面上传的压缩包保存在备份目录中，由 import_moments 后台任务导入，完成后删除
+
+# 创建批量导入蓝图
+moment_import_bp = Blueprint('moment_import', __name__)
+
+IMPORT_JOB = 'import_moments'
+
+MANIFEST_NAMES = ('moments.json', 'moments.csv', 'manifest.json', 'manifest.csv')
+
+# 清单字段的别名
+CONTENT_FIELDS = ('content', 'text', 'message')
+TIME_FIELDS = ('created_at', 'timestamp', 'time', 'date')
+IMAGE_FIELDS = ('images', 'photos', 'image', 'files')
+
+# 每批写入数据库的点滴瞬间数
+DEFAULT_IMPORT_BATCH_SIZE = 200
+
+# 图片数不超过该值时直接在当前进程处理，不启动进程池
+POOL_MIN_IMAGES = 8
+
+_TIME_FORMATS = ('%Y/%m/%d %H:%M:%S', '%Y/%m/%d %H:%M', '%Y/%m/%d',
+                 '%Y年%m月%d日 %H:%M:%S', '%Y年%m月%d日 %H:%M', '%Y年%m月%d日')
+_IMAGE_SEPARATOR = re.compile(r'[;|\n]')
+
+
+def parse_timestamp(value):
+    """
+    解析清单中的时间
+    :param value: ISO格式或常见中文格式的字符串，或Unix时间戳（秒或毫秒）
+    :return: 本地时间的datetime（不带时区）
+    :raises ValueError: 无法解析
+    """
+    if isinstance(value, (int, float)) or (isinstance(value, str) and re.fullmatch(r'\d+(\.\d+)?', value.strip())):
+        timestamp = float(value)
+        # 13位的毫秒时间戳
+        if timestamp > 1e11:
+            timestamp /= 1000
+        return datetime.datetime.fromtimestamp(timestamp)
+    value = (value or '').strip()
+    if not value:
+        raise ValueError('缺少时间')
+    try:
+        parsed = datetime.datetime.fromisoformat(value)
+    except ValueError:
+        for time_format in _TIME_FORMATS:
+            try:
+                return datetime.datetime.strptime(value, time_format)
+            except ValueError:
+                continue
+        raise ValueError(f'无法识别的时间: {value}')
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone().replace(tzinfo=None)
+    return parsed
+
+
+def _field(row, names):
+    for name in names:
+        if row.get(name) not in (None, ''):
+            return row[name]
+    return None
+
+
+class ImportSource:
+    """
+    导入来源：目录或zip压缩包，成员路径统一使用 / 分隔
+    """
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        if os.path.isdir(self.path):
+            self.is_zip = False
+            self.names = set()
+            for root, _, files in os.walk(self.path):
+                relative = os.path.relpath(root, self.path)
+                for file in files:
+                    name = file if relative == '.' else os.path.join(relative, file)
+                    self.names.add(name.replace(os.sep, '/'))
+        elif zipfile.is_zipfile(self.path):
+            self.is_zip = True
+            with zipfile.ZipFile(self.path) as archive:
+                self.names = {name for name in archive.namelist() if not name.endswith('/')}
+        else:
+            raise ValueError(f'导入来源必须是目录或zip压缩包: {path}')
+
+    def find_manifest(self, name=None):
+        """
+        :param name: 指定的清单路径，为空时使用层级最浅的 moments.json 等文件
+        :return: 清单的成员路径
+        """
+        if name:
+            name = name.replace('\\', '/').lstrip('/')
+            if name not in self.names:
+                raise ValueError(f'找不到清单文件: {name}')
+            return name
+        candidates = [name for name in self.names if posixpath.basename(name).lower() in MANIFEST_NAMES]
+        if not candidates:
+            raise ValueError(f'找不到清单文件（{" / ".join(MANIFEST_NAMES)}）')
+        return min(candidates, key=lambda name: (name.count('/'), name))
+
+    def read(self, member):
+        if self.is_zip:
+            with zipfile.ZipFile(self.path) as archive:
+                return archive.read(member)
+        with open(os.path.join(self.path, member), 'rb') as f:
+            return f.read()
+
+    def resolve(self, base, relative):
+        """
+        清单中的图片路径转换为成员路径，不存在或指向来源之外时返回None
+        """
+        member = posixpath.normpath(posixpath.join(base, relative.strip().replace('\\', '/')))
+        if member.startswith(('../', '/')) or member not in self.names:
+            return None
+        return member
+
+
+def read_manifest(source, manifest):
+    """
+    :return: 清单中的记录列表，每项包含 content、created_at 和 images 原始值
+    """
+    text = source.read(manifest).decode('utf-8-sig')
+    if manifest.lower().endswith('.csv'):
+        return list(csv.DictReader(io.StringIO(text)))
+    data = json.loads(text)
+    if isinstance(data, dict):
+        data = data.get('moments', [])
+    if not isinstance(data, list):
+        raise ValueError('JSON清单应为列表或包含 moments 列表的对象')
+    return [row for row in data if isinstance(row, dict)]
+
+
+def _import_key(created_at, content, images):
+    payload = json.dumps([created_at.isoformat(), content, images], ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:32]
+
+
+def parse_entries(rows):
+    """
+    校验清单记录并计算导入标识
+    :return: (记录列表, 错误信息列表)，记录包含 key、content、created_at 和 images（相对路径列表）
+    """
+    entries = []
+    errors = []
+    for index, row in enumerate(rows, 1):
+        content = str(_field(row, CONTENT_FIELDS) or '').strip()
+        images = _field(row, IMAGE_FIELDS) or []
+        if isinstance(images, str):
+            images = [image.strip() for image in _IMAGE_SEPARATOR.split(images)]
+        images = [str(image) for image in images if image]
+        if not content and not images:
+            errors.append(f'第{index}条没有内容和图片')
+            continue
+        try:
+            created_at = parse_timestamp(_field(row, TIME_FIELDS))
+        except (ValueError, OverflowError, OSError) as e:
+            errors.append(f'第{index}条: {e}')
+            continue
+        entries.append({'key': _import_key(created_at, content, images), 'content': content,
+                        'created_at': created_at, 'images': images})
+    return entries, errors
+
+
+def _store_image(source_path, is_zip, member, target):
+    """
+    在进程池中执行：把图片复制到上传目录并计算感知哈希
+    目标文件名由导入标识决定，中断后重新导入时已复制的文件直接使用
+    :return: (文件大小, 感知哈希)
+    """
+    if not os.path.exists(target):
+        partial = target + '.part'
+        if is_zip:
+            with zipfile.ZipFile(source_path) as archive, archive.open(member) as src, open(partial, 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+        else:
+            shutil.copyfile(os.path.join(source_path, member), partial)
+        os.replace(partial, target)
+    return os.path.getsize(target), compute_image_hash(target)
+
+
+def _existing_keys(db, Moment, keys, chunk_size=500):
+    existing = set()
+    for start in range(0, len(keys), chunk_size):
+        existing.update(db.session.execute(
+            db.select(Moment.import_key).where(Moment.import_key.in_(keys[start:start + chunk_size]))
+        ).scalars())
+    return existing
+
+
+def import_moments(app, db, Moment, Attachment, path, manifest=None, workers=None,
+                   batch_size=DEFAULT_IMPORT_BATCH_SIZE, context=None):
+    """
+    从目录或zip压缩包批量导入点滴瞬间
+    :param path: 目录或zip压缩包路径
+    :param manifest: 清单文件的路径（相对于来源），为空时自动查找
+    :param workers: 处理图片的进程数，默认为CPU核数
+    :param context: 后台任务上下文（可选），用于报告进度和检查取消
+    :return: 包含结果消息和各项统计的字典
+    """
+    source = ImportSource(path)
+    manifest = source.find_manifest(manifest)
+    base = posixpath.dirname(manifest)
+    entries, errors = parse_entries(read_manifest(source, manifest))
+
+    # 跳过已导入的记录和清单中重复的记录
+    existing = _existing_keys(db, Moment, [entry['key'] for entry in entries])
+    pending = []
+    for entry in entries:
+        if entry['key'] not in existing:
+            existing.add(entry['key'])
+            pending.append(entry)
+    skipped = len(entries) - len(pending)
+
+    # 确定每张图片的来源成员和目标文件
+    folder = os.path.join(get_upload_folder(app), 'moments')
+    os.makedirs(folder, exist_ok=True)
+    tasks = []
+    missing = 0
+    for entry in pending:
+        entry['files'] = []
+        for index, image in enumerate(entry['images']):
+            member = source.resolve(base, image)
+            if member is None or not allowed_file(member):
+                missing += 1
+                continue
+            filename = f"moment_import_{entry['key'][:16]}_{index}.{member.rsplit('.', 1)[1].lower()}"
+            entry['files'].append((posixpath.basename(member), filename))
+            tasks.append((source.path, source.is_zip, member, os.path.join(folder, filename)))
+
+    workers = workers or app.config.get('IMPORT_WORKERS') or os.cpu_count() or 1
+    executor = None
+    # 子进程用 fork 创建：spawn 会在子进程中重新导入主模块，python app.py 运行时会在每个子进程中再创建一个应用
+    # （包括任务工作线程）。不支持 fork 的系统在当前进程中处理图片
+    if workers > 1 and len(tasks) > POOL_MIN_IMAGES and 'fork' in multiprocessing.get_all_start_methods():
+        executor = ProcessPoolExecutor(max_workers=min(workers, len(tasks)),
+                                       mp_context=multiprocessing.get_context('fork'))
+    imported = image_count = failed = incomplete = 0
+    try:
+        # 先提交所有图片，写入数据库与后面批次的图片处理同时进行
+        if executor is not None:
+            results = iter([executor.submit(_store_image, *task) for task in tasks])
+        else:
+            results = iter([None] * len(tasks))
+        task_iter = iter(tasks)
+
+        for start in range(0, len(pending), batch_size):
+            if context:
+                context.check_cancelled()
+                context.report(start * 100 // len(pending), f'正在导入点滴瞬间（{start}/{len(pending)}）')
+            for entry in pending[start:start + batch_size]:
+                image_paths = []
+                attachments = []
+                complete = True
+                for original_filename, filename in entry['files']:
+                    task, future = next(task_iter), next(results)
+                    try:
+                        size, image_hash = future.result() if future is not None else _store_image(*task)
+                    except (OSError, zipfile.BadZipFile) as e:
+                        app.logger.warning(f'导入图片 {task[2]} 失败: {e}')
+                        failed += 1
+                        complete = False
+                        continue
+                    filepath = f'/static/uploads/moments/{filename}'
+                    attachments.append(Attachment(filename=original_filename, filepath=filepath, size=size,
+                                                  is_referenced=True, referenced_count=1, phash=image_hash))
+                    image_paths.append(filepath)
+                # 有图片复制失败的记录整条不导入（不写入导入标识），重新导入时再次尝试；已复制的图片会直接使用
+                if not complete:
+                    incomplete += 1
+                    continue
+                db.session.add_all(attachments)
+                db.session.add(Moment(content=entry['content'], created_at=entry['created_at'],
+                                      updated_at=entry['created_at'], image_paths=str(image_paths),
+                                      import_key=entry['key'], **rendered_content(entry['content'])))
+                imported += 1
+                image_count += len(image_paths)
+            bump_data_version(db, 'moment', 'attachment')
+            db.session.commit()
+    except BaseException:
+        db.session.rollback()
+        raise
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    message = f'导入 {imported} 条点滴瞬间、{image_count} 张图片'
+    if skipped:
+        message += f'，跳过已导入的 {skipped} 条'
+    if missing:
+        message += f'，{missing} 张图片不存在或格式不支持'
+    if failed:
+        message += f'，{failed} 张图片复制失败，{incomplete} 条记录未导入（可重新导入）'
+    if errors:
+        message += f'，{len(errors)} 条记录无效（{errors[0]}）'
+    return {'message': message, 'imported': imported, 'images': image_count, 'skipped': skipped,
+            'missing_images': missing, 'failed_images': failed, 'incomplete': incomplete, 'errors': errors[:100]}
+
+
+# 导入后台任务：导入上传后保存在备份目录中的压缩包，完成后删除该文件
+def run_import_job(app, db, Moment, Attachment, context):
+    from backup import get_backup_folder
+
+    archive_path = os.path.join(get_backup_folder(app), secure_filename(context.params['filename']))
+    try:
+        return import_moments(app, db, Moment, Attachment, archive_path, context=context)
+    finally:
+        if os.path.exists(archive_path):
+            os.remove(archive_path)
+
+
+def register_moment_import_routes(bp):
+    # 上传压缩包并提交导入任务
+    @bp.route('/admin/moments/import', methods=['POST'])
+    def start_import():
+        from backup import get_backup_folder
+
+        try:
+            archive = request.files.get('archive')
+            if archive is None or not archive.filename:
+                return jsonify({'success': False, 'message': '请选择要导入的压缩包'})
+            if not archive.filename.lower().endswith('.zip'):
+                return jsonify({'success': False, 'message': '请选择zip压缩包'})
+
+            timestamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S_%f')
+            filename = f'import_{timestamp}.zip'
+            archive.save(os.path.join(get_backup_folder(current_app), filename))
+            job = enqueue_job(IMPORT_JOB, {'filename': filename})
+            return jsonify({'success': True, 'message': '已开始导入点滴瞬间', 'job_id': job.id})
+        except Exception as e:
+            return jsonify({'success': False, 'message': str(e)})
+
+    return bp
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='从目录或zip压缩包批量导入点滴瞬间')
+    parser.add_argument('path', help='包含照片和清单文件（moments.json / moments.csv）的目录或zip压缩包')
+    parser.add_argument('--manifest', help='清单文件路径（相对于目录或压缩包），默认自动查找')
+    parser.add_argument('--workers', type=int, help='处理图片的进程数，默认为CPU核数')
+    parser.add_argument('--tenant', help='导入到指定租户（多租户模式下必须指定）')
+    args = parser.parse_args()
+
+    from app import app, db, Moment, Attachment
+    from tenants import use_tenant
+
+    with app.app_context():
+        if app.extensions.get('tenant_pool') is not None:
+            if not args.tenant:
+                parser.error('多租户模式下需要用 --tenant 指定租户')
+            use_tenant(args.tenant)
+        result = import_moments(app, db, Moment, Attachment, args.path, manifest=args.manifest, workers=args.workers)
+        print(result['message'])
+        for error in result['errors']:
+            print(f'  {error}')
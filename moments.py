@@ -1,8 +1,12 @@
 from flask import Blueprint, render_template, request, redirect, url_for, jsonify
-from flask_sqlalchemy import SQLAlchemy
+import calendar
 import datetime
 import os
 from werkzeug.utils import secure_filename
+from data_versions import bump_data_version, cached_by_data_version
+from markdown_render import rendered_content
+from tenants import get_upload_folder, resolve_upload_path
+from serializers import MODEL_FIELDS, parse_fields, parse_image_paths, model_columns, serialize_rows, api_response
 
 # 创建蓝图
 moments_bp = Blueprint('moments', __name__)
@@ -11,17 +15,54 @@ moments_bp = Blueprint('moments', __name__)
 UPLOAD_FOLDER = 'static/uploads/moments'
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
 
+# 新增点滴瞬间时根据创建时间计算月日（MM-DD）
+def _default_month_day(context):
+    created_at = context.get_current_parameters().get('created_at') or datetime.datetime.now()
+    return created_at.strftime('%m-%d')
+
 # 定义点滴瞬间模型
 def init_moment_model(db):
     class Moment(db.Model):
         id = db.Column(db.Integer, primary_key=True)
-        content = db.Column(db.Text, nullable=False)  # 文字内容
-        created_at = db.Column(db.DateTime, default=datetime.datetime.now)
+        content = db.Column(db.Text, nullable=False)  # 文字内容（Markdown）
+        # 保存时渲染好的HTML及渲染器版本，页面和API直接使用，不在查看时解析Markdown
+        content_html = db.Column(db.Text, nullable=True)
+        content_html_version = db.Column(db.Integer, nullable=True)
+        created_at = db.Column(db.DateTime, default=datetime.datetime.now, index=True)
         updated_at = db.Column(db.DateTime, default=datetime.datetime.now, onupdate=datetime.datetime.now)
         image_paths = db.Column(db.Text, default='[]')  # 存储图片路径的JSON字符串
+        # 创建时间的月日（MM-DD），用于按索引查找"那年今日"
+        month_day = db.Column(db.String(5), default=_default_month_day)
+        # 批量导入的点滴瞬间的导入标识（清单中的时间、内容和图片的哈希），重复导入时据此跳过，手动添加的为NULL
+        import_key = db.Column(db.String(32), nullable=True)
+
+        __table_args__ = (db.Index('ix_moment_month_day', 'month_day', 'created_at'),
+                          db.Index('ix_moment_import_key', 'import_key', unique=True))
     
     return Moment
 
+# 查找往年同一天的点滴瞬间，按创建时间倒序排列
+# 非闰年的2月28日同时显示2月29日的点滴瞬间
+def find_on_this_day(db, Moment, day, fields=None):
+    month_days = [day.strftime('%m-%d')]
+    if month_days[0] == '02-28' and not calendar.isleap(day.year):
+        month_days.append('02-29')
+    fields = fields or tuple(MODEL_FIELDS['moment'])
+    rows = db.session.execute(
+        db.select(*model_columns(Moment, 'moment', fields))
+        .where(Moment.month_day.in_(month_days), Moment.created_at < datetime.datetime(day.year, 1, 1))
+        .order_by(Moment.created_at.desc())
+    )
+    return serialize_rows(rows, 'moment', fields)
+
+# 首页的"那年今日"，按点滴瞬间数据版本和日期缓存
+def get_on_this_day(db, Moment, day):
+    return cached_by_data_version(db, 'moment', 'on_this_day', lambda: find_on_this_day(db, Moment, day), variant=day)
+
+# 请求是否由管理页面的脚本发出（Accept: application/json），是则返回JSON，否则按表单提交重定向
+def _wants_json():
+    return request.accept_mimetypes.best == 'application/json'
+
 # 检查文件类型是否允许
 def allowed_file(filename):
     return '.' in filename and \
@@ -30,10 +71,7 @@ def allowed_file(filename):
 # 注册路由函数到蓝图
 # 修改register_moment_routes函数定义，添加Attachment参数
 def register_moment_routes(bp, app, db, Moment, Attachment):
-    # 确保上传目录存在
-    if not os.path.exists(UPLOAD_FOLDER):
-        os.makedirs(UPLOAD_FOLDER)
-    
+    # 上传目录由 create_app() 统一创建
     # 点滴瞬间管理页面
     @bp.route('/admin_moments')
     def admin_moments():
@@ -42,7 +80,7 @@ def register_moment_routes(bp, app, db, Moment, Attachment):
         
         # 将图片路径的JSON字符串转换为列表
         for moment in moments:
-            moment.images = eval(moment.image_paths)
+            moment.images = parse_image_paths(moment.image_paths)
         
         message = request.args.get('message')
         message_type = request.args.get('message_type', 'success')
@@ -55,11 +93,15 @@ def register_moment_routes(bp, app, db, Moment, Attachment):
     # 添加新的点滴瞬间
     @bp.route('/admin/add_moment', methods=['POST'])
     def add_moment():
+        # 感知哈希依赖Pillow，只在上传时导入
+        from image_hash import compute_image_hash, find_similar_attachments, DEFAULT_SIMILAR_DISTANCE
+
         try:
             content = request.form['content']
             
             # 处理文件上传
             image_paths = []
+            similar_count = 0
             files = request.files.getlist('images[]')
             
             for file in files:
@@ -69,11 +111,16 @@ def register_moment_routes(bp, app, db, Moment, Attachment):
                     unique_filename = f"moment_{timestamp}_{original_filename}"
                     
                     # 保存文件
-                    filepath = os.path.join(app.config['UPLOAD_FOLDER'], 'moments', unique_filename)
+                    filepath = os.path.join(get_upload_folder(app), 'moments', unique_filename)
                     file.save(filepath)
                     
                     # 获取文件大小
                     file_size = os.path.getsize(filepath)
+                    # 计算感知哈希，统计已经上传过的相似照片
+                    image_hash = compute_image_hash(filepath)
+                    if find_similar_attachments(db, Attachment, image_hash,
+                                                app.config.get('IMAGE_SIMILAR_DISTANCE', DEFAULT_SIMILAR_DISTANCE)):
+                        similar_count += 1
                     
                     # 先在附件表中创建记录
                     new_attachment = Attachment(
@@ -81,7 +128,8 @@ def register_moment_routes(bp, app, db, Moment, Attachment):
                         filepath=f"/static/uploads/moments/{unique_filename}",
                         size=file_size,
                         is_referenced=True,
-                        referenced_count=1
+                        referenced_count=1,
+                        phash=image_hash
                     )
                     db.session.add(new_attachment)
                     
@@ -91,18 +139,30 @@ def register_moment_routes(bp, app, db, Moment, Attachment):
             # 创建新的点滴瞬间记录
             new_moment = Moment(
                 content=content,
-                image_paths=str(image_paths)
+                image_paths=str(image_paths),
+                **rendered_content(content)
             )
             
             # 添加到数据库
             db.session.add(new_moment)
+            bump_data_version(db, 'moment')
             db.session.commit()
             
+            message = '点滴瞬间添加成功！'
+            if similar_count:
+                message += f'其中 {similar_count} 张图片与已有的照片相似，可在附件管理中查看'
+            # 脚本请求只返回新增的一项，由页面插入到列表中
+            if _wants_json():
+                new_moment.images = image_paths
+                return jsonify({'success': True, 'message': message, 'id': new_moment.id,
+                                'html': render_template('_moment_item.html', moment=new_moment)})
             # 重定向回管理页面，显示成功消息
-            return redirect(url_for('moments.admin_moments', message='点滴瞬间添加成功！', message_type='success'))
+            return redirect(url_for('moments.admin_moments', message=message, message_type='success'))
         except Exception as e:
             # 出错时回滚事务
             db.session.rollback()
+            if _wants_json():
+                return jsonify({'success': False, 'message': f'添加失败: {str(e)}'})
             return redirect(url_for('moments.admin_moments', message=f'添加失败: {str(e)}', message_type='error'))
     
     # 删除点滴瞬间
@@ -115,18 +175,23 @@ def register_moment_routes(bp, app, db, Moment, Attachment):
             # 处理图片删除
             if moment.image_paths and moment.image_paths != '[]':
                 # 解析图片路径列表
-                image_paths = eval(moment.image_paths)
+                image_paths = parse_image_paths(moment.image_paths)
+                
+                # 一次查询所有图片对应的附件，而不是每张图片查询一次
+                attachments = {}
+                for attachment in Attachment.query.filter(Attachment.filepath.in_(image_paths)).all():
+                    attachments.setdefault(attachment.filepath, attachment)
                 
                 for image_path in image_paths:
                     # 构建完整的文件路径
-                    full_path = os.path.join(app.root_path, image_path.lstrip('/'))
+                    full_path = resolve_upload_path(app, image_path)
                     
                     # 检查文件是否存在，如果存在则删除
                     if os.path.exists(full_path):
                         os.remove(full_path)
                     
                     # 更新附件表中的引用计数和引用状态
-                    attachment = Attachment.query.filter_by(filepath=image_path).first()
+                    attachment = attachments.get(image_path)
                     if attachment:
                         attachment.referenced_count -= 1
                         if attachment.referenced_count <= 0:
@@ -134,6 +199,7 @@ def register_moment_routes(bp, app, db, Moment, Attachment):
             
             # 从数据库中删除点滴瞬间记录
             db.session.delete(moment)
+            bump_data_version(db, 'moment')
             db.session.commit()
             
             return jsonify({'success': True})
@@ -149,27 +215,34 @@ def register_moment_routes(bp, app, db, Moment, Attachment):
         
         # 将图片路径的JSON字符串转换为列表
         for moment in moments:
-            moment.images = eval(moment.image_paths)
+            moment.images = parse_image_paths(moment.image_paths)
             # 格式化日期
             moment.formatted_date = moment.created_at.strftime('%Y-%m-%d %H:%M')
         
         return render_template('moments.html', moments=moments)
     
-    # 获取点滴瞬间API
+    # 获取点滴瞬间API，支持 ?fields=id,content 只返回部分字段
     @bp.route('/api/moments')
     def get_moments_api():
-        moments = Moment.query.order_by(Moment.created_at.desc()).all()
-        moments_data = []
-        
-        for moment in moments:
-            images = eval(moment.image_paths)
-            moments_data.append({
-                'id': moment.id,
-                'content': moment.content,
-                'created_at': moment.created_at.isoformat(),
-                'images': images
-            })
-        
-        return jsonify(moments_data)
+        try:
+            fields = parse_fields('moment')
+        except ValueError as e:
+            return jsonify({'success': False, 'message': str(e)}), 400
+        # 只查询需要的列，不创建模型实例
+        rows = db.session.execute(
+            db.select(*model_columns(Moment, 'moment', fields)).order_by(Moment.created_at.desc())
+        )
+        return api_response(serialize_rows(rows, 'moment', fields))
+    
+    # 那年今日：往年同一天的点滴瞬间，?date=YYYY-MM-DD 指定日期（默认今天）
+    @bp.route('/api/moments/on_this_day')
+    def get_on_this_day_api():
+        try:
+            fields = parse_fields('moment')
+            day_str = request.args.get('date')
+            day = datetime.datetime.strptime(day_str, '%Y-%m-%d').date() if day_str else datetime.date.today()
+        except ValueError as e:
+            return jsonify({'success': False, 'message': str(e)}), 400
+        return api_response(find_on_this_day(db, Moment, day, fields))
     
     return bp
\ No newline at end of file
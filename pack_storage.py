@@ -0,0 +1,230 @@
+import datetime
+import io
+import mimetypes
+import os
+from flask import current_app, request
+from werkzeug.wsgi import wrap_file
+from tenants import get_upload_folder, resolve_upload_path
+
+# 旧附件的打包存储
+# 几万张小照片会占用大量inode，遍历目录和备份时磁盘需要反复寻道。
+# 打包任务把上传超过 PACK_AFTER_DAYS 天的附件依次追加到 uploads/packs 下的打包文件中，
+# 在附件表中记录所在的打包文件、偏移和长度，提交后再删除原文件。
+# - 打包文件只追加不修改，超过 PACK_MAX_BYTES 后开始写下一个；写入后崩溃时原文件还在，多写的数据不会被引用
+# - 删除已打包的附件只删除记录，打包文件中的数据不回收
+# - 访问 /static/uploads/... 时原文件不存在则从打包文件中读取：每个请求单独打开打包文件并定位到偏移，
+#   响应设置了长度，gunicorn 会用 os.sendfile 直接从文件发送，其他服务器按块读取；支持 Range 请求
+# - 备份时打包文件先按顺序整体写入（不压缩），不再逐个读取小文件
+
+# 打包文件所在目录（相对于上传目录）
+PACK_DIR = 'packs'
+
+# 默认打包上传超过多少天的附件，以及单个打包文件的大小上限
+DEFAULT_PACK_AFTER_DAYS = 90
+DEFAULT_PACK_MAX_BYTES = 256 * 1024 * 1024
+
+# 每打包多少个文件提交一次（提交后才删除原文件）
+PACK_BATCH_SIZE = 100
+
+
+def get_pack_folder(app):
+    return os.path.join(get_upload_folder(app), PACK_DIR)
+
+
+def _pack_filename(number):
+    return f'pack-{number:06d}.pack'
+
+
+def _open_pack_for_append(folder, max_bytes):
+    """
+    打开最后一个还没写满的打包文件，都已写满时新建一个
+    :return: (文件名, 文件对象)
+    """
+    os.makedirs(folder, exist_ok=True)
+    names = sorted(name for name in os.listdir(folder) if name.startswith('pack-') and name.endswith('.pack'))
+    if names and os.path.getsize(os.path.join(folder, names[-1])) < max_bytes:
+        name = names[-1]
+    else:
+        name = _pack_filename(int(names[-1][5:11]) + 1 if names else 1)
+    pack = open(os.path.join(folder, name), 'ab')
+    pack.seek(0, os.SEEK_END)
+    return name, pack
+
+
+def pack_old_attachments(app, db, Attachment, context=None):
+    """
+    把上传时间早于 PACK_AFTER_DAYS 天的附件移入打包文件（后台任务）
+    :param context: 后台任务上下文（可选），用于报告进度和检查取消
+    :return: 包含结果消息的字典
+    """
+    from data_versions import bump_data_version
+    from image_hash import compute_image_hash, is_image_path
+
+    days = app.config.get('PACK_AFTER_DAYS', DEFAULT_PACK_AFTER_DAYS)
+    max_bytes = app.config.get('PACK_MAX_BYTES', DEFAULT_PACK_MAX_BYTES)
+    cutoff = datetime.datetime.now() - datetime.timedelta(days=days)
+    pending = db.session.execute(
+        db.select(Attachment.id, Attachment.filepath, Attachment.phash)
+        .where(Attachment.pack_file.is_(None), Attachment.upload_date < cutoff)
+        .order_by(Attachment.upload_date, Attachment.id)
+    ).all()
+
+    folder = get_pack_folder(app)
+    table = Attachment.__table__
+    packed = packed_bytes = 0
+    pack_name, pack = _open_pack_for_append(folder, max_bytes)
+    batch = []
+
+    def commit_batch():
+        # 打包文件写入磁盘后再提交记录，提交后再删除原文件
+        pack.flush()
+        os.fsync(pack.fileno())
+        for attachment_id, name, offset, length, image_hash, _ in batch:
+            values = {'pack_file': name, 'pack_offset': offset, 'pack_length': length}
+            if image_hash is not None:
+                values['phash'] = image_hash
+            db.session.execute(table.update().where(table.c.id == attachment_id).values(**values))
+        bump_data_version(db, 'attachment')
+        db.session.commit()
+        for *_, file_path in batch:
+            os.remove(file_path)
+        batch.clear()
+
+    try:
+        for index, (attachment_id, filepath, phash) in enumerate(pending):
+            if context:
+                context.check_cancelled()
+                context.report(index * 100 // len(pending), f'正在打包附件（{index}/{len(pending)}）')
+            file_path = resolve_upload_path(app, filepath)
+            if not os.path.isfile(file_path):
+                continue
+            # 打包后不再单独计算哈希，还没有哈希的图片先算好
+            image_hash = compute_image_hash(file_path) if phash is None and is_image_path(filepath) else None
+            with open(file_path, 'rb') as f:
+                data = f.read()
+            offset = pack.tell()
+            pack.write(data)
+            batch.append((attachment_id, pack_name, offset, len(data), image_hash, file_path))
+            packed += 1
+            packed_bytes += len(data)
+
+            if len(batch) >= PACK_BATCH_SIZE or pack.tell() >= max_bytes:
+                commit_batch()
+            if pack.tell() >= max_bytes:
+                pack.close()
+                pack_name, pack = _open_pack_for_append(folder, max_bytes)
+        if batch:
+            commit_batch()
+    finally:
+        pack.close()
+
+    return {'message': f'已打包 {packed} 个附件（{packed_bytes / 1024 / 1024:.1f} MB）',
+            'packed': packed, 'bytes': packed_bytes}
+
+
+class PackSlice(io.RawIOBase):
+    """
+    打包文件中一段数据的只读视图
+    fileno() 返回打包文件本身，读取位置与底层文件同步，gunicorn 可以从当前位置按响应长度调用 os.sendfile
+    """
+
+    def __init__(self, path, offset, length):
+        super().__init__()
+        self._file = open(path, 'rb')
+        self._offset = offset
+        self._length = length
+        self._position = 0
+        self._file.seek(offset)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def fileno(self):
+        return self._file.fileno()
+
+    def tell(self):
+        return self._position
+
+    def seek(self, position, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            position += self._position
+        elif whence == os.SEEK_END:
+            position += self._length
+        self._position = max(0, min(position, self._length))
+        self._file.seek(self._offset + self._position)
+        return self._position
+
+    def readinto(self, buffer):
+        size = min(len(buffer), self._length - self._position)
+        if size <= 0:
+            return 0
+        read = self._file.readinto(memoryview(buffer)[:size])
+        self._position += read
+        return read
+
+    def close(self):
+        self._file.close()
+        super().close()
+
+
+def open_packed_attachment(app, pack_file, offset, length):
+    """
+    打开已打包的附件
+    :return: 可读取、可定位的文件对象
+    """
+    return PackSlice(os.path.join(get_pack_folder(app), os.path.basename(pack_file)), offset, length)
+
+
+def send_packed_attachment(app, filename, pack_file, offset, length, upload_date=None):
+    """
+    从打包文件返回附件内容（支持条件请求和 Range 请求）
+    """
+    data = wrap_file(request.environ, open_packed_attachment(app, pack_file, offset, length))
+    response = app.response_class(data, mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream',
+                                  direct_passthrough=True)
+    response.content_length = length
+    # 打包文件只追加，同一位置的内容不会变化
+    response.set_etag(f'{pack_file}-{offset}-{length}')
+    if upload_date:
+        response.last_modified = upload_date
+    max_age = app.get_send_file_max_age(filename)
+    if max_age is not None:
+        response.cache_control.public = True
+        response.cache_control.max_age = max_age
+    return response.make_conditional(request, accept_ranges=True, complete_length=length)
+
+
+def iter_packed_attachments(db, Attachment):
+    """
+    :return: [(附件路径, 打包文件, 偏移, 长度)]
+    """
+    return db.session.execute(
+        db.select(Attachment.filepath, Attachment.pack_file, Attachment.pack_offset, Attachment.pack_length)
+        .where(Attachment.pack_file.is_not(None))
+    ).all()
+
+
+def init_pack_storage(app, db, Attachment):
+    """
+    上传文件不存在时从打包文件中读取，需在 init_static_assets、init_tenants 之后调用
+    """
+    static_view = app.view_functions['static']
+
+    def static(filename):
+        if filename.startswith('uploads/'):
+            filepath = '/static/' + filename
+            if not os.path.exists(resolve_upload_path(current_app, filepath)):
+                location = db.session.execute(
+                    db.select(Attachment.pack_file, Attachment.pack_offset, Attachment.pack_length,
+                              Attachment.upload_date)
+                    .where(Attachment.filepath == filepath, Attachment.pack_file.is_not(None))
+                    .limit(1)
+                ).first()
+                if location is not None:
+                    return send_packed_attachment(current_app, filename, *location)
+        return static_view(filename=filename)
+
+    app.view_functions['static'] = static
@@ -0,0 +1,128 @@
+import calendar
+import datetime
+
+# 农历换算依赖 lunardate（可选依赖，未安装时不支持农历重复）
+try:
+    from lunardate import LunarDate
+except ImportError:
+    LunarDate = None
+
+# 重复规则
+RECURRENCE_NONE = 'none'
+RECURRENCE_YEARLY = 'yearly'
+RECURRENCE_MONTHLY = 'monthly'
+RECURRENCE_LUNAR_YEARLY = 'lunar_yearly'
+
+# 重复规则及其显示名称（用于后台表单）
+RECURRENCE_CHOICES = [
+    (RECURRENCE_NONE, '不重复'),
+    (RECURRENCE_YEARLY, '每年'),
+    (RECURRENCE_MONTHLY, '每月'),
+    (RECURRENCE_LUNAR_YEARLY, '每年（农历）'),
+]
+RECURRENCE_RULES = {value for value, _ in RECURRENCE_CHOICES}
+
+
+def _clamp_day(year, month, day):
+    """
+    构造日期，当月没有这一天时取当月最后一天（如2月30日取2月28/29日）
+    """
+    return datetime.date(year, month, min(day, calendar.monthrange(year, month)[1]))
+
+
+def _lunar_to_solar(year, month, day):
+    """
+    农历日期转公历日期，农历小月没有三十日时取二十九日
+    """
+    try:
+        return LunarDate(year, month, day).to_solar_date()
+    except ValueError:
+        return LunarDate(year, month, day - 1).to_solar_date()
+
+
+def occurrence_in_period(start_date, rule, year, month=None):
+    """
+    计算重复纪念日在指定年份（每月重复时为指定年月）的那一次日期
+    :param start_date: 纪念日的原始日期
+    :param rule: 重复规则
+    :param year: 年份
+    :param month: 月份，仅每月重复时使用
+    :return: 当期的公历日期；早于原始日期或无法换算时返回None
+    """
+    if rule == RECURRENCE_YEARLY:
+        occurrence = _clamp_day(year, start_date.month, start_date.day)
+    elif rule == RECURRENCE_MONTHLY:
+        occurrence = _clamp_day(year, month, start_date.day)
+    elif rule == RECURRENCE_LUNAR_YEARLY:
+        if LunarDate is None:
+            raise ValueError('农历重复需要安装 lunardate')
+        lunar = LunarDate.from_solar_date(start_date.year, start_date.month, start_date.day)
+        try:
+            occurrence = _lunar_to_solar(year, lunar.month, lunar.day)
+        except ValueError:
+            # 超出农历换算支持的年份范围
+            return None
+    else:
+        occurrence = start_date
+
+    if occurrence < start_date:
+        return None
+    return occurrence
+
+
+def next_occurrence(start_date, rule, today):
+    """
+    计算纪念日在今天及之后的下一次日期
+    不重复的纪念日直接返回原始日期（可能早于今天）
+    :param start_date: 纪念日的原始日期
+    :param rule: 重复规则
+    :param today: 今天的日期
+    :return: 下一次的日期
+    """
+    if rule not in RECURRENCE_RULES or rule == RECURRENCE_NONE or start_date >= today:
+        return start_date
+
+    if rule == RECURRENCE_MONTHLY:
+        year, month = today.year, today.month
+        for _ in range(2):
+            occurrence = occurrence_in_period(start_date, rule, year, month)
+            if occurrence and occurrence >= today:
+                return occurrence
+            year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+        return start_date
+
+    # 农历新年在公历1-2月，今天的农历年可能是上一年，因此从上一年开始找
+    for year in range(today.year - 1, today.year + 2):
+        occurrence = occurrence_in_period(start_date, rule, year)
+        if occurrence and occurrence >= today:
+            return occurrence
+    return start_date
+
+
+def iter_occurrences(start_date, rule, until):
+    """
+    依次生成从原始日期到截止日期（含）之间的所有日期
+    :param start_date: 纪念日的原始日期
+    :param rule: 重复规则
+    :param until: 截止日期
+    """
+    if rule not in RECURRENCE_RULES or rule == RECURRENCE_NONE:
+        if start_date <= until:
+            yield start_date
+        return
+
+    if rule == RECURRENCE_MONTHLY:
+        year, month = start_date.year, start_date.month
+        while (year, month) <= (until.year, until.month):
+            occurrence = occurrence_in_period(start_date, rule, year, month)
+            if occurrence and occurrence <= until:
+                yield occurrence
+            year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+        return
+
+    # 原始日期的农历年可能是上一年，从上一年开始找（早于原始日期的会被过滤）
+    first_year = start_date.year - 1 if rule == RECURRENCE_LUNAR_YEARLY else start_date.year
+    for year in range(first_year, until.year + 1):
+        occurrence = occurrence_in_period(start_date, rule, year)
+        if occurrence and occurrence <= until:
+            yield occurrence
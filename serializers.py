@@ -0,0 +1,195 @@
+import ast
+import datetime
+import json
+from flask import request, current_app
+
+# 模型序列化
+# 各API统一用这里的字段定义把模型（或只查询了部分列的结果行）转换为字典，
+# 支持 ?fields=id,content 只返回部分字段（同时只查询需要的列），
+# 用 orjson 编码JSON，客户端发送 Accept: application/msgpack 时返回MessagePack
+
+# orjson 比标准库json快很多，未安装时使用标准库
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# MessagePack是可选依赖（pip install msgpack），未安装时总是返回JSON
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+_loads = orjson.loads if orjson is not None else json.loads
+
+JSON_MIMETYPE = 'application/json'
+MSGPACK_MIMETYPES = ('application/msgpack', 'application/x-msgpack')
+
+
+# 转换函数只对非空值调用
+def _isoformat(value):
+    return value.isoformat()
+
+
+def _date_string(value):
+    return value.strftime('%Y-%m-%d')
+
+
+def parse_image_paths(value):
+    """
+    解析点滴瞬间的图片路径列表
+    数据库中保存的是 str(list) 的结果（单引号），路径中没有引号和反斜杠时可以直接换成双引号按JSON解析
+    该列也可能来自导入的文件，只按字面量解析，不是列表的值按没有图片处理
+    """
+    if not value:
+        return []
+    if '"' not in value and '\\' not in value:
+        try:
+            paths = _loads(value.replace("'", '"'))
+        except ValueError:
+            paths = None
+        if paths is not None:
+            return paths if isinstance(paths, list) else []
+    try:
+        paths = ast.literal_eval(value)
+    except (ValueError, SyntaxError, MemoryError, RecursionError):
+        return []
+    return paths if isinstance(paths, list) else []
+
+
+# 每个模型可输出的字段：{字段名: (模型属性, 转换函数)}，字段顺序即输出顺序
+MODEL_FIELDS = {
+    'anniversary': {
+        'id': ('id', None),
+        'title': ('title', None),
+        'date': ('date', _date_string),
+        'icon': ('icon', None),
+        'icon_color': ('icon_color', None),
+        'card_color': ('card_color', None),
+        'is_future': ('is_future', None),
+        'recurrence': ('recurrence', None),
+        'sort_order': ('sort_order', None),
+    },
+    'user_info': {
+        'username1': ('username1', None),
+        'username2': ('username2', None),
+        'avatar1': ('avatar1', None),
+        'avatar2': ('avatar2', None),
+        'banner': ('banner', None),
+    },
+    'attachment': {
+        'id': ('id', None),
+        'filename': ('filename', None),
+        'filepath': ('filepath', None),
+        'size': ('size', None),
+        'upload_date': ('upload_date', _isoformat),
+    },
+    'moment': {
+        'id': ('id', None),
+        'content': ('content', None),
+        'content_html': ('content_html', None),
+        'created_at': ('created_at', _isoformat),
+        'images': ('image_paths', parse_image_paths),
+    },
+}
+
+
+def parse_fields(model_name, value=None):
+    """
+    解析请求中的 fields 参数
+    :param model_name: MODEL_FIELDS 中的模型名
+    :param value: 逗号分隔的字段名，默认取请求参数 fields
+    :return: 字段名元组，未指定时返回全部字段
+    :raises ValueError: 包含不存在的字段
+    """
+    available = MODEL_FIELDS[model_name]
+    if value is None:
+        value = request.args.get('fields')
+    if not value:
+        return tuple(available)
+    fields = tuple(dict.fromkeys(name.strip() for name in value.split(',') if name.strip()))
+    unknown = [name for name in fields if name not in available]
+    if unknown or not fields:
+        raise ValueError(f"不支持的字段：{', '.join(unknown)}，可用字段：{', '.join(available)}")
+    return fields
+
+
+def model_columns(Model, model_name, fields):
+    """
+    返回输出这些字段需要查询的列，用于 db.select(*columns)
+    """
+    specs = MODEL_FIELDS[model_name]
+    return [getattr(Model, specs[name][0]) for name in fields]
+
+
+def serialize(obj, model_name, fields=None):
+    """
+    将模型实例或查询结果行转换为字典
+    :param obj: 模型实例，或包含所需列的结果行
+    :param model_name: MODEL_FIELDS 中的模型名
+    :param fields: 要输出的字段，默认全部
+    """
+    specs = MODEL_FIELDS[model_name]
+    data = {}
+    for name in fields or specs:
+        attribute, convert = specs[name]
+        value = getattr(obj, attribute)
+        data[name] = convert(value) if convert is not None and value is not None else value
+    return data
+
+
+def serialize_rows(rows, model_name, fields=None):
+    """
+    批量转换 db.select(*model_columns(...)) 的查询结果
+    按位置取值，比逐个按属性名读取结果行快很多
+    :param rows: 查询结果，每行的列顺序与 fields 一致
+    """
+    specs = MODEL_FIELDS[model_name]
+    plan = [(name, specs[name][1]) for name in fields or specs]
+    results = []
+    for row in rows:
+        data = {}
+        for (name, convert), value in zip(plan, row):
+            data[name] = convert(value) if convert is not None and value is not None else value
+        results.append(data)
+    return results
+
+
+def _default(value):
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    raise TypeError(f'无法序列化的类型：{type(value).__name__}')
+
+
+def dumps_json(data):
+    """
+    编码为UTF-8的JSON字节串
+    """
+    if orjson is not None:
+        return orjson.dumps(data, default=_default)
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':'), default=_default).encode('utf-8')
+
+
+def wants_msgpack():
+    """
+    客户端是否优先接受MessagePack（未安装msgpack时总是返回False）
+    """
+    if msgpack is None:
+        return False
+    best = request.accept_mimetypes.best_match((JSON_MIMETYPE,) + MSGPACK_MIMETYPES)
+    return best in MSGPACK_MIMETYPES
+
+
+def api_response(data, status=200):
+    """
+    按 Accept 请求头返回JSON或MessagePack响应，用于替代 jsonify
+    """
+    if wants_msgpack():
+        body = msgpack.packb(data, default=_default, use_bin_type=True)
+        mimetype = MSGPACK_MIMETYPES[0]
+    else:
+        body = dumps_json(data)
+        mimetype = JSON_MIMETYPE
+    response = current_app.response_class(body, status=status, mimetype=mimetype)
+    response.vary.add('Accept')
+    return response
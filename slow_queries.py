@@ -0,0 +1,215 @@
+import datetime
+import json
+import os
+import re
+import threading
+from collections import deque
+from flask import Blueprint, current_app, g, has_request_context, render_template, request
+from tenants import current_tenant_name
+
+# 跨进程文件锁（Windows上没有fcntl，日志轮转只在进程内加锁）
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# 慢查询日志
+# 页面变慢时需要知道是哪条语句。metrics 的SQL事件钩子（watch_engine，主数据库和租户数据库都会注册）
+# 发现耗时超过 SLOW_QUERY_THRESHOLD_MS 毫秒的语句时调用 SlowQueryLog.record()，记录：
+# - 语句、耗时、调用的路由（后台任务为任务类型）、租户
+# - 参数的形状（类型和长度，不记录参数值，日志中不会出现点滴瞬间内容等数据）
+# - 在同一连接上执行 EXPLAIN QUERY PLAN 得到的查询计划，moment、attachment、anniversary 表的全表扫描单独标出
+# 记录以JSON行写入 SLOW_QUERY_LOG，超过大小上限时轮转。每条记录单独以追加方式打开文件写入，
+# 多个工作进程写同一个文件时轮转后不会继续写到旧文件中
+# /admin/slow_queries 显示最近的记录
+
+# 创建慢查询蓝图
+slow_queries_bp = Blueprint('slow_queries', __name__)
+
+# 默认阈值（毫秒，0表示不记录）、日志文件大小上限和保留的轮转文件数
+DEFAULT_SLOW_QUERY_THRESHOLD_MS = 100
+DEFAULT_SLOW_QUERY_LOG_MAX_BYTES = 1024 * 1024
+DEFAULT_SLOW_QUERY_LOG_BACKUP_COUNT = 5
+
+# 全表扫描需要标出的表
+DEFAULT_WATCHED_TABLES = ('moment', 'attachment', 'anniversary')
+
+# 管理页面显示的记录数
+RECENT_LIMIT = 200
+
+# 语句中保留的最大字符数
+STATEMENT_MAX_LENGTH = 4000
+
+# 只有这些语句能执行 EXPLAIN QUERY PLAN
+_EXPLAINABLE = re.compile(r'^\s*(SELECT|WITH|UPDATE|DELETE|INSERT|REPLACE)\b', re.IGNORECASE)
+# SQLite 3.36 之后为 "SCAN moment"，之前为 "SCAN TABLE moment"；带 USING INDEX 的是索引扫描
+_FULL_SCAN = re.compile(r'^SCAN (?:TABLE )?(\w+)(?: AS \w+)?$')
+
+
+def _value_shape(value):
+    if isinstance(value, (str, bytes)):
+        return f'{type(value).__name__}[{len(value)}]'
+    if value is None:
+        return 'null'
+    return type(value).__name__
+
+
+def parameter_shape(parameters, executemany=False):
+    """
+    参数的形状：只保留类型和字符串长度，不记录参数值
+    :return: 如 "(int, str[12])"，executemany 时为 "300 × (int, str[12])"
+    """
+    if executemany:
+        rows = list(parameters or [])
+        return f'{len(rows)} × {parameter_shape(rows[0]) if rows else "()"}'
+    if isinstance(parameters, dict):
+        return '{' + ', '.join(f'{key}: {_value_shape(value)}' for key, value in parameters.items()) + '}'
+    return '(' + ', '.join(_value_shape(value) for value in parameters or ()) + ')'
+
+
+def explain_query_plan(cursor, statement, parameters, executemany=False):
+    """
+    在执行该语句的DB-API连接上执行 EXPLAIN QUERY PLAN（不经过SQLAlchemy，不会再次触发SQL事件）
+    :return: 查询计划每一行的说明，无法获取时返回None
+    """
+    if not _EXPLAINABLE.match(statement):
+        return None
+    if executemany:
+        parameters = next(iter(parameters), ())
+    try:
+        rows = cursor.connection.execute('EXPLAIN QUERY PLAN ' + statement, parameters or ()).fetchall()
+    except Exception:
+        return None
+    return [row[-1] for row in rows]
+
+
+def find_full_scans(plan, tables=DEFAULT_WATCHED_TABLES):
+    """
+    :return: 查询计划中被全表扫描的表（只检查 tables 中的表）
+    """
+    scanned = []
+    for detail in plan or ():
+        match = _FULL_SCAN.match(detail)
+        if match and match.group(1) in tables and match.group(1) not in scanned:
+            scanned.append(match.group(1))
+    return scanned
+
+
+def _caller():
+    if has_request_context():
+        return f'{request.method} {request.endpoint or request.path}'
+    job_type = g.get('job_type')
+    return f'job:{job_type}' if job_type else 'cli'
+
+
+class SlowQueryLog:
+    """
+    写入慢查询日志文件的JSON行，超过大小上限时轮转（slow_queries.log.1 ... .N）
+    """
+
+    def __init__(self, path, threshold_ms=DEFAULT_SLOW_QUERY_THRESHOLD_MS, max_bytes=DEFAULT_SLOW_QUERY_LOG_MAX_BYTES,
+                 backup_count=DEFAULT_SLOW_QUERY_LOG_BACKUP_COUNT, watched_tables=DEFAULT_WATCHED_TABLES):
+        self.path = path
+        self.threshold = threshold_ms / 1000
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.watched_tables = tuple(watched_tables)
+        self._lock = threading.Lock()
+
+    def record(self, cursor, statement, parameters, executemany, duration):
+        """
+        记录一条慢查询（在SQL事件钩子中调用，写日志失败不影响原语句）
+        """
+        plan = explain_query_plan(cursor, statement, parameters, executemany)
+        entry = {
+            'time': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'duration_ms': round(duration * 1000, 1),
+            'statement': statement[:STATEMENT_MAX_LENGTH],
+            'parameters': parameter_shape(parameters, executemany),
+            'caller': _caller(),
+            'tenant': current_tenant_name(),
+            'plan': plan,
+            'full_scans': find_full_scans(plan, self.watched_tables),
+            'pid': os.getpid(),
+        }
+        try:
+            self._write(json.dumps(entry, ensure_ascii=False))
+        except OSError as e:
+            current_app.logger.warning(f'写入慢查询日志失败: {e}')
+        return entry
+
+    def _write(self, line):
+        with self._lock:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(line + '\n')
+                size = f.tell()
+            if size > self.max_bytes:
+                self._rotate()
+
+    def _rotate(self):
+        with open(self.path + '.lock', 'a') as guard:
+            if fcntl is not None:
+                fcntl.flock(guard.fileno(), fcntl.LOCK_EX)
+            # 其他进程可能已经轮转过
+            if not os.path.exists(self.path) or os.path.getsize(self.path) <= self.max_bytes:
+                return
+            if self.backup_count <= 0:
+                os.remove(self.path)
+                return
+            for index in range(self.backup_count - 1, 0, -1):
+                source = f'{self.path}.{index}'
+                if os.path.exists(source):
+                    os.replace(source, f'{self.path}.{index + 1}')
+            os.replace(self.path, self.path + '.1')
+
+    def recent(self, limit=RECENT_LIMIT):
+        """
+        最近的记录（所有进程），新的在前
+        """
+        entries = deque(maxlen=limit)
+        for path in (self.path + '.1', self.path):
+            if not os.path.exists(path):
+                continue
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        continue
+        return list(reversed(entries))
+
+
+def init_slow_query_log(app):
+    """
+    启用慢查询日志（阈值为0时不启用），需在 init_metrics(app, db) 之后调用
+    """
+    threshold_ms = app.config.get('SLOW_QUERY_THRESHOLD_MS', DEFAULT_SLOW_QUERY_THRESHOLD_MS)
+    if not threshold_ms:
+        return None
+    slow_query_log = SlowQueryLog(
+        app.config.get('SLOW_QUERY_LOG') or os.path.join(app.instance_path, 'slow_queries.log'),
+        threshold_ms=threshold_ms,
+        max_bytes=app.config.get('SLOW_QUERY_LOG_MAX_BYTES', DEFAULT_SLOW_QUERY_LOG_MAX_BYTES),
+        backup_count=app.config.get('SLOW_QUERY_LOG_BACKUP_COUNT', DEFAULT_SLOW_QUERY_LOG_BACKUP_COUNT),
+        watched_tables=app.config.get('SLOW_QUERY_WATCHED_TABLES', DEFAULT_WATCHED_TABLES),
+    )
+    app.extensions['slow_query_log'] = slow_query_log
+    return slow_query_log
+
+
+def register_slow_query_routes(bp):
+    # 最近的慢查询，?full_scans=1 只显示有全表扫描的记录
+    @bp.route('/admin/slow_queries')
+    def admin_slow_queries():
+        slow_query_log = current_app.extensions.get('slow_query_log')
+        entries = slow_query_log.recent() if slow_query_log is not None else []
+        full_scans_only = request.args.get('full_scans') in ('1', 'true')
+        if full_scans_only:
+            entries = [entry for entry in entries if entry.get('full_scans')]
+        return render_template('admin_slow_queries.html', entries=entries, enabled=slow_query_log is not None,
+                               threshold_ms=slow_query_log.threshold * 1000 if slow_query_log else 0,
+                               watched_tables=slow_query_log.watched_tables if slow_query_log else (),
+                               full_scans_only=full_scans_only)
+
+    return bp
@@ -0,0 +1,204 @@
+import os
+import threading
+import time
+from flask import current_app, g, has_app_context
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from sqlalchemy.sql.elements import TextClause
+
+# 跨进程文件锁（Windows上没有fcntl，只在进程内串行化写操作）
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# 每个连接建立时设置的PRAGMA，可通过 app.config['SQLITE_PRAGMAS'] 覆盖
+DEFAULT_SQLITE_PRAGMAS = {
+    'auto_vacuum': 'INCREMENTAL',  # 只对还没有数据表的新数据库生效，已有的数据库由维护任务转换
+    'journal_mode': 'WAL',        # 读写互不阻塞
+    'synchronous': 'NORMAL',      # WAL模式下安全且比FULL快得多
+    'busy_timeout': 5000,         # 数据库被锁时最多等待5秒，而不是立即报错
+    'mmap_size': 268435456,       # 256MB内存映射读
+    'cache_size': -20000,         # 约20MB页缓存（负数表示KB）
+    'temp_store': 'MEMORY',
+}
+
+# 写队列最长等待时间（秒），可通过 app.config['SQLITE_WRITE_QUEUE_TIMEOUT'] 覆盖
+DEFAULT_WRITE_QUEUE_TIMEOUT = 10
+
+# 以这些关键字开头的文本SQL视为写操作
+_WRITE_KEYWORDS = ('INSERT', 'UPDATE', 'DELETE', 'REPLACE', 'CREATE', 'DROP', 'ALTER')
+
+
+class WriteQueueTimeout(Exception):
+    """
+    等待写队列超时
+    """
+
+
+class WriteQueue:
+    """
+    串行化的写队列
+    同一时间只有一个事务可以写数据库：进程内使用线程锁，进程间使用文件锁，
+    等待超过 timeout 秒抛出 WriteQueueTimeout，而不是让请求无限期挂起
+    """
+
+    def __init__(self, lock_path=None, timeout=DEFAULT_WRITE_QUEUE_TIMEOUT):
+        self.lock_path = lock_path
+        self.timeout = timeout
+        # 可重入：同一线程中嵌套的会话不会等待自己
+        self._thread_lock = threading.RLock()
+        self._depth = 0
+        self._lock_file = None
+        self._lock_file_pid = None
+
+    def _get_lock_file(self):
+        # fork之后的子进程需要重新打开锁文件，否则会与父进程共用同一把锁
+        if self._lock_file is None or self._lock_file_pid != os.getpid():
+            self._lock_file = open(self.lock_path, 'a+')
+            self._lock_file_pid = os.getpid()
+        return self._lock_file
+
+    def acquire(self, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        if not self._thread_lock.acquire(timeout=timeout):
+            raise WriteQueueTimeout(f'等待写入超过{timeout}秒，请稍后重试')
+
+        self._depth += 1
+        if self._depth > 1 or fcntl is None or not self.lock_path:
+            return
+        lock_file = self._get_lock_file()
+        delay = 0.001
+        while True:
+            try:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return
+            except BlockingIOError:
+                if time.monotonic() >= deadline:
+                    self._depth -= 1
+                    self._thread_lock.release()
+                    raise WriteQueueTimeout(f'等待写入超过{timeout}秒，请稍后重试')
+                time.sleep(delay)
+                delay = min(delay * 2, 0.05)
+
+    def release(self):
+        self._depth -= 1
+        if self._depth == 0 and fcntl is not None and self.lock_path:
+            fcntl.flock(self._get_lock_file().fileno(), fcntl.LOCK_UN)
+        self._thread_lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+def _set_sqlite_pragmas(pragmas):
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for name, value in pragmas.items():
+                # 值为None表示不设置该PRAGMA
+                if value is None:
+                    continue
+                cursor.execute(f'PRAGMA {name} = {value}')
+        finally:
+            cursor.close()
+    return on_connect
+
+
+def _is_write_statement(state):
+    if state.is_insert or state.is_update or state.is_delete:
+        return True
+    if isinstance(state.statement, TextClause):
+        return state.statement.text.lstrip().upper().startswith(_WRITE_KEYWORDS)
+    return False
+
+
+# 写队列事件只注册一次，写操作时按当前应用查找写队列
+_write_queue_events_registered = False
+
+
+def _register_write_queue_events():
+    """
+    会话第一次写数据库（flush或执行写语句）前进入当前应用的写队列，事务结束时离开
+    """
+    global _write_queue_events_registered
+    if _write_queue_events_registered:
+        return
+    _write_queue_events_registered = True
+
+    def enter_write_queue(session):
+        if session.info.get('write_queue') is not None or not has_app_context():
+            return
+        write_queue = get_write_queue()
+        if write_queue is not None:
+            write_queue.acquire()
+            session.info['write_queue'] = write_queue
+
+    @event.listens_for(Session, 'before_flush')
+    def before_flush(session, flush_context, instances):
+        if session.new or session.dirty or session.deleted:
+            enter_write_queue(session)
+
+    @event.listens_for(Session, 'do_orm_execute')
+    def do_orm_execute(state):
+        if _is_write_statement(state):
+            enter_write_queue(state.session)
+
+    @event.listens_for(Session, 'after_transaction_end')
+    def after_transaction_end(session, transaction):
+        if transaction.parent is None:
+            write_queue = session.info.pop('write_queue', None)
+            if write_queue is not None:
+                write_queue.release()
+
+
+def get_write_queue():
+    """
+    当前数据库的写队列（需在应用上下文中调用）：切换到租户后为租户数据库的写队列
+    """
+    tenant = g.get('tenant')
+    if tenant is not None:
+        return tenant.write_queue
+    return current_app.extensions.get('sqlite_write_queue')
+
+
+def configure_sqlite_engine(app, engine):
+    """
+    为SQLite引擎设置PRAGMA，并创建该数据库文件的写队列
+    :param app: Flask应用实例
+    :param engine: SQLite引擎
+    :return: 写队列，未启用写队列时返回None
+    """
+    pragmas = dict(DEFAULT_SQLITE_PRAGMAS)
+    pragmas.update(app.config.get('SQLITE_PRAGMAS', {}))
+    event.listen(engine, 'connect', _set_sqlite_pragmas(pragmas))
+
+    database = engine.url.database
+    lock_path = f'{database}.writelock' if database and database != ':memory:' else None
+    if not app.config.get('SQLITE_WRITE_QUEUE', True):
+        return None
+    _register_write_queue_events()
+    return WriteQueue(lock_path, app.config.get('SQLITE_WRITE_QUEUE_TIMEOUT', DEFAULT_WRITE_QUEUE_TIMEOUT))
+
+
+def init_sqlite_engine(app, db):
+    """
+    为SQLite数据库设置PRAGMA并启用写队列，需在 db.init_app(app) 之后、第一次连接数据库之前调用
+    :param app: Flask应用实例
+    :param db: SQLAlchemy实例
+    :return: 写队列，非SQLite数据库或未启用写队列时返回None
+    """
+    with app.app_context():
+        engine = db.engine
+    if engine.dialect.name != 'sqlite':
+        return None
+
+    write_queue = configure_sqlite_engine(app, engine)
+    if write_queue is not None:
+        app.extensions['sqlite_write_queue'] = write_queue
+    return write_queue
@@ -0,0 +1,208 @@
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+from flask import request, send_from_directory
+
+# 静态资源预压缩和文件名指纹
+# 构建: python static_assets.py（部署时执行一次，静态文件更新后重新执行）
+# 1. 把 static 下的文件（上传目录除外）复制到 static/dist，文件名中加入内容哈希，如 css/bootstrap.min.3f2a9c1b7e4d.css
+# 2. 可压缩的文件额外生成 .gz 和 .br（需要安装 Brotli）版本
+# 3. 生成 manifest.json 记录原文件名到指纹文件名的对应关系
+# 运行时 url_for('static', filename='css/bootstrap.min.css') 自动换成指纹文件名，
+# 指纹文件按 Accept-Encoding 返回预压缩版本，并设置一年的不可变缓存
+
+# Brotli是可选依赖，没有安装时只生成gzip版本
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# 构建输出目录（相对于static目录）和清单文件名
+DIST_DIR = 'dist'
+MANIFEST_NAME = 'manifest.json'
+
+# 不参与构建的目录（用户上传的文件和构建输出本身）
+EXCLUDED_DIRS = ('uploads', DIST_DIR)
+
+# 需要生成压缩版本的文件类型（woff2、图片等本身已压缩）
+COMPRESSIBLE_EXTENSIONS = ('.css', '.js', '.svg', '.ttf', '.eot', '.otf', '.json', '.txt', '.map')
+
+# 指纹文件的缓存时间（一年）
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+# CSS中的相对路径引用，如 url(../webfonts/fa-solid-900.woff2)
+_CSS_URL_PATTERN = re.compile(r'url\(\s*([\'"]?)([^\'")]+)\1\s*\)')
+
+
+def _content_hash(content):
+    return hashlib.sha256(content).hexdigest()[:12]
+
+
+def _fingerprinted_name(path, content):
+    base, ext = os.path.splitext(path)
+    return f'{base}.{_content_hash(content)}{ext}'
+
+
+def _rewrite_css_urls(content, css_path, manifest):
+    """
+    把CSS中引用的相对路径换成指纹文件名（引用的文件不存在时保持不变）
+    """
+    css_dir = os.path.dirname(css_path)
+
+    def replace(match):
+        quote, url = match.groups()
+        if url.startswith(('data:', 'http:', 'https:', '//', '/', '#')):
+            return match.group(0)
+        path, _, suffix = url.partition('?')
+        path, _, fragment = path.partition('#')
+        target = os.path.normpath(os.path.join(css_dir, path)).replace(os.sep, '/')
+        if target not in manifest:
+            return match.group(0)
+        # 构建后的CSS位于dist目录中，相对路径按dist中的位置计算
+        new_url = os.path.relpath(manifest[target], os.path.join(DIST_DIR, css_dir)).replace(os.sep, '/')
+        if suffix:
+            new_url += '?' + suffix
+        if fragment:
+            new_url += '#' + fragment
+        return f'url({quote}{new_url}{quote})'
+
+    return _CSS_URL_PATTERN.sub(replace, content.decode('utf-8')).encode('utf-8')
+
+
+def _write_variants(dist_path, content):
+    with open(dist_path, 'wb') as f:
+        f.write(content)
+    if dist_path.endswith(COMPRESSIBLE_EXTENSIONS):
+        # mtime=0 让相同内容的构建结果完全相同
+        with open(dist_path + '.gz', 'wb') as f:
+            f.write(gzip.compress(content, compresslevel=9, mtime=0))
+        if brotli is not None:
+            with open(dist_path + '.br', 'wb') as f:
+                f.write(brotli.compress(content, quality=11))
+
+
+def build_static_assets(static_folder, clean=False):
+    """
+    构建指纹文件和预压缩版本
+    :param static_folder: static目录
+    :param clean: 是否删除不在新清单中的旧构建文件（仍在运行的旧进程可能还在引用它们）
+    :return: 清单 {原文件名: 指纹文件名}，路径均相对于static目录
+    """
+    dist_folder = os.path.join(static_folder, DIST_DIR)
+    sources = []
+    for root, dirs, files in os.walk(static_folder):
+        if root == static_folder:
+            dirs[:] = [name for name in dirs if name not in EXCLUDED_DIRS]
+        for name in files:
+            path = os.path.relpath(os.path.join(root, name), static_folder).replace(os.sep, '/')
+            sources.append(path)
+
+    # 先处理CSS以外的文件，CSS中引用的字体等文件名需要先确定
+    sources.sort(key=lambda path: (path.endswith('.css'), path))
+    manifest = {}
+    for path in sources:
+        with open(os.path.join(static_folder, path), 'rb') as f:
+            content = f.read()
+        if path.endswith('.css'):
+            content = _rewrite_css_urls(content, path, manifest)
+        dist_name = _fingerprinted_name(path, content)
+        manifest[path] = f'{DIST_DIR}/{dist_name}'
+
+        dist_path = os.path.join(dist_folder, dist_name)
+        os.makedirs(os.path.dirname(dist_path), exist_ok=True)
+        if not os.path.exists(dist_path):
+            _write_variants(dist_path, content)
+
+    if clean and os.path.isdir(dist_folder):
+        keep = {os.path.join(static_folder, name) for name in manifest.values()}
+        for root, dirs, files in os.walk(dist_folder):
+            for name in files:
+                path = os.path.join(root, name)
+                original = re.sub(r'\.(gz|br)$', '', path)
+                if name != MANIFEST_NAME and original not in keep:
+                    os.remove(path)
+
+    # 最后写清单，写入过程中运行的进程仍读到旧清单
+    manifest_path = os.path.join(dist_folder, MANIFEST_NAME)
+    with open(manifest_path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=4, sort_keys=True)
+    os.replace(manifest_path + '.tmp', manifest_path)
+    return manifest
+
+
+def load_manifest(static_folder):
+    """
+    读取构建清单，未构建时返回空字典（使用原文件）
+    """
+    try:
+        with open(os.path.join(static_folder, DIST_DIR, MANIFEST_NAME), encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _choose_encoding(path):
+    """
+    按 Accept-Encoding 选择存在的预压缩文件，优先brotli
+    :return: (编码, 文件路径后缀)，没有可用的压缩版本时返回 (None, '')
+    """
+    for encoding, suffix in (('br', '.br'), ('gzip', '.gz')):
+        if request.accept_encodings[encoding] and os.path.exists(path + suffix):
+            return encoding, suffix
+    return None, ''
+
+
+def init_static_assets(app):
+    """
+    启用指纹文件名和预压缩静态文件
+    :param app: Flask应用实例
+    :return: 清单字典
+    """
+    static_folder = app.static_folder
+    manifest = load_manifest(static_folder)
+    app.extensions['static_manifest'] = manifest
+    default_static_view = app.view_functions['static']
+
+    # url_for('static', filename=...) 使用指纹文件名
+    @app.url_defaults
+    def fingerprint_static_url(endpoint, values):
+        if endpoint == 'static' and manifest:
+            filename = values.get('filename')
+            if filename in manifest:
+                values['filename'] = manifest[filename]
+
+    # 指纹文件：返回预压缩版本并设置不可变缓存；其他文件（如上传的图片）使用默认处理
+    def static(filename):
+        if not filename.startswith(DIST_DIR + '/'):
+            return default_static_view(filename=filename)
+
+        path = os.path.join(static_folder, filename)
+        encoding, suffix = _choose_encoding(path)
+        mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        response = send_from_directory(static_folder, filename + suffix, mimetype=mimetype, max_age=31536000)
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        response.headers['Vary'] = 'Accept-Encoding'
+        response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+        return response
+
+    app.view_functions['static'] = static
+    return manifest
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='构建指纹文件名和预压缩的静态资源')
+    parser.add_argument('--clean', action='store_true', help='删除旧的构建文件')
+    args = parser.parse_args()
+
+    static_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+    manifest = build_static_assets(static_folder, clean=args.clean)
+    for source, target in sorted(manifest.items()):
+        print(f'{source} -> {target}')
+    if brotli is None:
+        print('未安装Brotli，只生成了gzip版本')
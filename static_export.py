@@ -0,0 +1,397 @@
+import datetime
+import hashlib
+import json
+import os
+import shutil
+from types import SimpleNamespace
+from flask import Blueprint, current_app, g, jsonify, render_template, request
+from data_versions import get_request_data_versions
+from jobs import enqueue_job
+from markdown_render import MARKDOWN_VERSION
+from pack_storage import get_pack_folder, iter_packed_attachments, open_packed_attachment
+from tenants import current_tenant, resolve_upload_path
+from serializers import parse_image_paths
+
+# 静态网站导出
+# 把前台页面（首页、点滴瞬间）渲染成HTML文件，连同关于页面和 static 目录一起写入导出目录，由nginx直接提供，不经过Python：
+#     导出: python static_export.py --output /srv/loveblog（或设置 LOVEBLOG_STATIC_EXPORT_DIR）
+#     nginx: root /srv/loveblog; location / { try_files $uri $uri.html $uri/index.html =404; }
+#            （可开启 gzip_static / brotli_static 使用 static/dist 中预压缩的文件）
+#
+# 导出是增量的：导出目录中的 .export_state.json 记录每个页面的签名（所依赖数据的版本号、静态资源清单等），
+# 签名不变的页面不重新渲染，内容不变的文件不重写；static 目录按文件大小和修改时间同步。
+# 上传的附件按附件ID增量同步：.export_uploads.json 记录已导出的附件，每次只复制ID更大的新附件（附件ID不复用），
+# 删除已删除附件的导出文件，不再遍历上传目录；首次导出或 full 时才完整同步整个 static 目录。
+# 设置了导出目录时，后台每次修改数据后提交一个 static_export 任务，只重新导出受影响的页面。
+#
+# 点滴瞬间按从旧到新的顺序分页（/moments/page/1 是最早的一页），已有的分页内容保持稳定：
+# 新增点滴瞬间只影响最后一页，删除时只影响它所在的页及之后的页。/moments 与最后一页内容相同。
+# 页面中的图片直接引用原图（/static/uploads/...），随 static 目录一起同步；已打包的附件写成原路径下的单独文件。
+# 多租户模式下不导出（上传目录在各租户目录中，导出目录也需要按租户区分）。
+
+# 创建静态导出蓝图
+static_export_bp = Blueprint('static_export', __name__)
+
+# 每页的点滴瞬间数量
+MOMENTS_PER_PAGE = 20
+
+# 导出状态文件名（位于导出目录中）
+STATE_FILENAME = '.export_state.json'
+# 已导出的附件 {附件ID: 相对于 static 的路径}
+UPLOADS_STATE_FILENAME = '.export_uploads.json'
+
+# 上传目录（相对于 static 目录），增量导出时按附件表同步
+UPLOADS_DIR = 'uploads'
+
+# 导出格式版本，修改页面的组织方式后递增，已有的导出目录会全部重新导出
+EXPORT_FORMAT = 1
+
+# 页面依赖的数据，对应数据的版本号变化后重新导出
+HOME_DEPENDENCIES = ('anniversary', 'user_info', 'moment')
+
+
+def _signature(*parts):
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode('utf-8')).hexdigest()[:16]
+
+
+def moments_page_path(page):
+    return f'moments/page/{page}.html'
+
+
+def _load_state(output_dir):
+    try:
+        with open(os.path.join(output_dir, STATE_FILENAME), encoding='utf-8') as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return {'pages': {}}
+    if state.get('format') != EXPORT_FORMAT:
+        return {'pages': {}}
+    return state
+
+
+def _load_exported_uploads(output_dir):
+    """
+    :return: 已导出的附件 {附件ID: 相对路径}，没有记录时返回None（需要完整同步）
+    """
+    try:
+        with open(os.path.join(output_dir, UPLOADS_STATE_FILENAME), encoding='utf-8') as f:
+            return {int(attachment_id): path for attachment_id, path in json.load(f).items()}
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def _write_file(output_dir, path, content):
+    """
+    写入导出文件（先写临时文件再替换，nginx不会读到写了一半的文件）；内容与已有文件相同时不写入
+    :return: 是否写入
+    """
+    target = os.path.join(output_dir, path)
+    data = content.encode('utf-8')
+    try:
+        with open(target, 'rb') as f:
+            if f.read() == data:
+                return False
+    except OSError:
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+    temp_path = target + '.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+    os.replace(temp_path, target)
+    return True
+
+
+def sync_static_folder(static_folder, target_folder, exclude=(), keep=()):
+    """
+    把 static 目录同步到导出目录：只复制大小或修改时间不同的文件，删除源目录中已不存在的文件
+    :param exclude: 不同步的子目录（相对于 static 目录）
+    :param keep: 源目录中没有但需要保留的文件（相对路径）
+    :return: (复制的文件数, 删除的文件数)
+    """
+    copied = removed = 0
+    expected = set(keep)
+    exclude = {os.path.normpath(path) for path in exclude}
+    for root, dirs, files in os.walk(static_folder):
+        relative_root = os.path.relpath(root, static_folder)
+        dirs[:] = [name for name in dirs if os.path.normpath(os.path.join(relative_root, name)) not in exclude]
+        for filename in files:
+            relative_path = os.path.normpath(os.path.join(relative_root, filename))
+            expected.add(relative_path)
+            source = os.path.join(static_folder, relative_path)
+            target = os.path.join(target_folder, relative_path)
+            source_stat = os.stat(source)
+            try:
+                target_stat = os.stat(target)
+                if target_stat.st_size == source_stat.st_size and target_stat.st_mtime_ns == source_stat.st_mtime_ns:
+                    continue
+            except OSError:
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+            shutil.copy2(source, target)
+            copied += 1
+
+    for root, dirs, files in os.walk(target_folder):
+        relative_root = os.path.relpath(root, target_folder)
+        dirs[:] = [name for name in dirs if os.path.normpath(os.path.join(relative_root, name)) not in exclude]
+        for filename in files:
+            relative_path = os.path.normpath(os.path.join(relative_root, filename))
+            if relative_path not in expected:
+                os.remove(os.path.join(target_folder, relative_path))
+                removed += 1
+    return copied, removed
+
+
+def sync_uploads(app, db, Attachment, target_folder, exported):
+    """
+    按附件表增量同步上传的附件：复制ID大于上次导出的新附件，删除已删除附件的导出文件
+    :param exported: 上次导出的附件 {附件ID: 相对路径}，会被更新
+    :return: (复制的文件数, 删除的文件数)
+    """
+    current_ids = set(db.session.execute(db.select(Attachment.id)).scalars())
+    deleted = {attachment_id: exported.pop(attachment_id) for attachment_id in list(exported)
+               if attachment_id not in current_ids}
+    # 多条附件记录可能指向同一个文件，仍被引用的文件不删除
+    remaining = set(exported.values())
+    removed = 0
+    for relative_path in set(deleted.values()) - remaining:
+        try:
+            os.remove(os.path.join(target_folder, relative_path))
+            removed += 1
+        except FileNotFoundError:
+            pass
+
+    copied = 0
+    packed = []
+    for attachment_id, filepath, pack_file, offset, length in db.session.execute(
+        db.select(Attachment.id, Attachment.filepath, Attachment.pack_file, Attachment.pack_offset,
+                  Attachment.pack_length)
+        .where(Attachment.id > max(exported, default=0))
+        .order_by(Attachment.id)
+    ):
+        relative_path = os.path.normpath(filepath.removeprefix('/static/'))
+        exported[attachment_id] = relative_path
+        if pack_file is not None:
+            packed.append((relative_path, pack_file, offset, length))
+            continue
+        source = resolve_upload_path(app, filepath)
+        target = os.path.join(target_folder, relative_path)
+        try:
+            source_stat = os.stat(source)
+        except OSError:
+            continue
+        try:
+            target_stat = os.stat(target)
+            if target_stat.st_size == source_stat.st_size and target_stat.st_mtime_ns == source_stat.st_mtime_ns:
+                continue
+        except OSError:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+        shutil.copy2(source, target)
+        copied += 1
+    copied += _export_packed_attachments(app, packed, target_folder)
+    return copied, removed
+
+
+def _export_packed_attachments(app, packed, target_folder):
+    """
+    把已打包的附件写成单独的文件（nginx 无法直接读取打包文件），大小相同的已有文件不重写
+    :param packed: [(相对路径, 打包文件, 偏移, 长度)]
+    :return: 写入的文件数
+    """
+    written = 0
+    for relative_path, pack_file, offset, length in packed:
+        target = os.path.join(target_folder, relative_path)
+        try:
+            if os.path.getsize(target) == length:
+                continue
+        except OSError:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open_packed_attachment(app, pack_file, offset, length) as source, open(target + '.tmp', 'wb') as f:
+            shutil.copyfileobj(source, f)
+        os.replace(target + '.tmp', target)
+        written += 1
+    return written
+
+
+def _moment_pages(db, Moment):
+    """
+    按从旧到新的顺序给点滴瞬间分页
+    :return: [(页码, [(ID, 更新时间)])]
+    """
+    rows = db.session.execute(
+        db.select(Moment.id, Moment.updated_at).order_by(Moment.created_at, Moment.id)
+    ).all()
+    pages = [rows[start:start + MOMENTS_PER_PAGE] for start in range(0, len(rows), MOMENTS_PER_PAGE)]
+    return list(enumerate(pages or [[]], 1))
+
+
+def _render_moments_page(db, Moment, page, page_count, rows):
+    ids = [moment_id for moment_id, _ in rows]
+    moments = [
+        SimpleNamespace(id=moment_id, content=content, content_html=content_html,
+                        images=parse_image_paths(image_paths), formatted_date=created_at.strftime('%Y-%m-%d %H:%M'))
+        for moment_id, content, content_html, created_at, image_paths in db.session.execute(
+            db.select(Moment.id, Moment.content, Moment.content_html, Moment.created_at, Moment.image_paths)
+            .where(Moment.id.in_(ids))
+            .order_by(Moment.created_at.desc(), Moment.id.desc())
+        )
+    ]
+    pagination = {
+        'page': page,
+        'pages': page_count,
+        'older_url': f'/moments/page/{page - 1}' if page > 1 else None,
+        'newer_url': f'/moments/page/{page + 1}' if page < page_count else None,
+    }
+    return render_template('moments.html', moments=moments, pagination=pagination)
+
+
+def export_static_site(app, db, Moment, Attachment, output_dir, full=False, context=None):
+    """
+    导出静态网站（需在应用上下文中调用）
+    :param output_dir: 导出目录
+    :param full: 是否忽略已有的导出状态，重新渲染所有页面
+    :param context: 后台任务上下文（可选），用于报告进度和检查取消
+    :return: 包含结果消息的字典
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    state = {'pages': {}} if full else _load_state(output_dir)
+    old_pages = state['pages']
+    manifest_signature = _signature(app.extensions.get('static_manifest') or {})
+    versions = get_request_data_versions(db)
+    today = datetime.date.today()
+    with open(os.path.join(app.root_path, app.template_folder, 'about.html'), encoding='utf-8') as f:
+        about_html = f.read()
+
+    # 页面路径 -> (签名, 渲染函数)
+    pages = {
+        # 首页的纪念日天数和"那年今日"与日期有关，每天需要重新导出一次
+        'index.html': (
+            _signature(manifest_signature, [versions[name] for name in HOME_DEPENDENCIES], today),
+            lambda: app.view_functions['home'](),
+        ),
+        # about.html 是纯HTML（没有对应的路由，也不是有效的Jinja模板），原样导出
+        'about.html': (_signature(about_html), lambda: about_html),
+    }
+    moment_pages = _moment_pages(db, Moment)
+    page_count = len(moment_pages)
+    for page, rows in moment_pages:
+        # 重新渲染Markdown不修改 updated_at，渲染器版本变化后所有分页重新导出
+        signature = _signature(manifest_signature, rows, page == page_count, MARKDOWN_VERSION)
+        render = lambda page=page, rows=rows: _render_moments_page(db, Moment, page, page_count, rows)
+        pages[moments_page_path(page)] = (signature, render)
+        if page == page_count:
+            pages['moments.html'] = (signature, render)
+
+    if context:
+        context.report(0, '正在同步静态文件')
+    static_target = os.path.join(output_dir, 'static')
+    exported = None if full else _load_exported_uploads(output_dir)
+    if exported is None:
+        # 完整同步：遍历整个 static 目录；打包文件本身不导出，其中的附件写成原来路径下的单独文件
+        packed = [(os.path.normpath(filepath.removeprefix('/static/')), pack_file, offset, length)
+                  for filepath, pack_file, offset, length in iter_packed_attachments(db, Attachment)]
+        copied, removed = sync_static_folder(
+            app.static_folder, static_target,
+            exclude=[os.path.relpath(get_pack_folder(app), app.static_folder)],
+            keep=[relative_path for relative_path, *_ in packed],
+        )
+        copied += _export_packed_attachments(app, packed, static_target)
+        exported = {attachment_id: os.path.normpath(filepath.removeprefix('/static/'))
+                    for attachment_id, filepath in db.session.execute(db.select(Attachment.id, Attachment.filepath))}
+    else:
+        # 增量同步：static 目录中除上传目录外的文件（样式、脚本等）按大小和修改时间同步，上传的附件按附件表同步
+        copied, removed = sync_static_folder(app.static_folder, static_target, exclude=[UPLOADS_DIR])
+        uploads_copied, uploads_removed = sync_uploads(app, db, Attachment, static_target, exported)
+        copied += uploads_copied
+        removed += uploads_removed
+    _write_file(output_dir, UPLOADS_STATE_FILENAME, json.dumps(exported, sort_keys=True))
+
+    # 只渲染签名变化的页面
+    stale = [path for path, (signature, _) in pages.items() if old_pages.get(path) != signature]
+    rendered = written = 0
+    for index, path in enumerate(stale):
+        if context:
+            context.check_cancelled()
+            context.report(index * 100 // len(stale), f'正在导出页面（{index}/{len(stale)}）')
+        signature, render = pages[path]
+        with app.test_request_context('/' + path.removesuffix('.html').removesuffix('index')):
+            content = render()
+        rendered += 1
+        written += _write_file(output_dir, path, content)
+        old_pages[path] = signature
+
+    # 删除已不存在的分页（删除点滴瞬间后页数可能减少）
+    deleted_pages = [path for path in old_pages if path not in pages]
+    for path in deleted_pages:
+        del old_pages[path]
+        try:
+            os.remove(os.path.join(output_dir, path))
+        except FileNotFoundError:
+            pass
+
+    _write_file(output_dir, STATE_FILENAME,
+                json.dumps({'format': EXPORT_FORMAT, 'pages': old_pages}, ensure_ascii=False, sort_keys=True, indent=1))
+    return {
+        'message': f'已导出 {rendered} 个页面（{written} 个有变化），删除 {len(deleted_pages)} 个页面，'
+                   f'同步静态文件 {copied} 个，删除 {removed} 个',
+        'rendered': rendered,
+        'written': written,
+    }
+
+
+def run_static_export_job(app, db, Moment, Attachment, context):
+    """
+    后台导出任务，导出到 STATIC_EXPORT_DIR；参数 full 为真时重新渲染所有页面
+    """
+    output_dir = app.config.get('STATIC_EXPORT_DIR')
+    if not output_dir:
+        return {'message': '未配置静态导出目录（LOVEBLOG_STATIC_EXPORT_DIR）'}
+    if current_tenant() is not None:
+        return {'message': '多租户模式下不支持静态导出'}
+    return export_static_site(app, db, Moment, Attachment, output_dir, full=bool(context.params.get('full')),
+                              context=context)
+
+
+def init_static_export(app):
+    """
+    设置了导出目录时，修改数据的请求结束后提交增量导出任务（排队中的导出任务会被复用，连续修改只导出一次）
+    """
+    @app.after_request
+    def export_after_write(response):
+        if (app.config.get('STATIC_EXPORT_DIR') and current_tenant() is None
+                and g.get('changed_data_versions') and response.status_code < 400):
+            try:
+                enqueue_job('static_export')
+            except Exception:
+                app.logger.exception('提交静态导出任务失败')
+        return response
+
+
+def register_static_export_routes(bp):
+    # 提交静态导出任务，?full=1 重新渲染所有页面
+    @bp.route('/admin/static_export', methods=['POST'])
+    def start_static_export():
+        if not current_app.config.get('STATIC_EXPORT_DIR'):
+            return jsonify({'success': False, 'message': '未配置静态导出目录（LOVEBLOG_STATIC_EXPORT_DIR）'})
+        try:
+            full = request.values.get('full') in ('1', 'true')
+            job = enqueue_job('static_export', {'full': True} if full else None)
+            return jsonify({'success': True, 'message': '已开始导出静态网站', 'job_id': job.id})
+        except Exception as e:
+            return jsonify({'success': False, 'message': str(e)})
+
+    return bp
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='导出静态网站')
+    parser.add_argument('--output', help='导出目录（默认使用 LOVEBLOG_STATIC_EXPORT_DIR）')
+    parser.add_argument('--full', action='store_true', help='忽略已有的导出状态，重新渲染所有页面')
+    args = parser.parse_args()
+
+    from app import app, db, Moment, Attachment
+
+    output_dir = args.output or app.config.get('STATIC_EXPORT_DIR')
+    if not output_dir:
+        parser.error('请通过 --output 或 LOVEBLOG_STATIC_EXPORT_DIR 指定导出目录')
+    with app.app_context():
+        print(export_static_site(app, db, Moment, Attachment, output_dir, full=args.full)['message'])
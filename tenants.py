@@ -0,0 +1,360 @@
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from flask import abort, current_app, g, has_app_context, request, send_from_directory
+from flask_sqlalchemy.session import Session
+from sqlalchemy import create_engine
+from metrics import watch_engine
+from migrations import run_migrations
+from sqlite_engine import configure_sqlite_engine
+
+# 多租户：一个部署托管多对情侣，每对情侣（租户）一个SQLite数据库和一个上传目录
+# 通过 TENANT_MODE 开启（未设置时为单租户，数据库和上传目录与之前完全相同）：
+# - 'host'：按域名区分，alice.example.com -> 租户alice（设置 TENANT_DOMAIN=example.com 时只接受该域名的子域名）
+# - 'path'：按路径前缀区分，/alice/moments -> 租户alice的 /moments。前缀移到 SCRIPT_NAME 中，
+#   url_for 生成的链接会自动带上前缀，但模板中写死的绝对链接（如 /moments、/admin/...）不会，完整使用建议按域名区分
+#
+# 每个租户一个目录 TENANTS_DIR/<租户名>/：
+#   anniversaries.db  数据库
+#   static/uploads/   上传的文件（数据库中保存的路径仍是 /static/uploads/...，读写文件时解析到租户目录）
+#   backups/          后台备份生成的文件
+# 租户需要先创建（python tenants.py create alice），请求不存在的租户返回404
+#
+# 后台任务表只保存在主数据库中，所有租户共用一组工作线程：任务记录提交时的租户，执行时切换到该租户
+# 每个进程按最近使用顺序最多保留 TENANT_MAX_ENGINES 个租户的数据库引擎，空闲超过 TENANT_IDLE_SECONDS 秒的引擎被关闭，
+# 该租户的进程内缓存（数据版本缓存、相似图片索引等）一起丢弃
+
+# 租户数据库文件名
+DATABASE_FILENAME = 'anniversaries.db'
+
+# 只保存在主数据库中、所有租户共用的表
+SHARED_TABLES = ('job',)
+
+# 以下参数均可通过 app.config 中的同名配置项覆盖
+DEFAULT_TENANT_MAX_ENGINES = 64     # 每个进程最多同时打开的租户数据库引擎数
+DEFAULT_TENANT_IDLE_SECONDS = 300   # 租户数据库引擎空闲多少秒后关闭
+
+# 租户名：小写字母、数字和连字符（同时用作子域名和目录名）
+TENANT_NAME_PATTERN = re.compile(r'^[a-z0-9](?:[a-z0-9-]{0,61}[a-z0-9])?$')
+
+# 路径前缀模式下，中间件把租户名保存在WSGI环境变量中
+TENANT_ENVIRON_KEY = 'loveblog.tenant'
+
+
+def is_valid_tenant_name(name):
+    return bool(name) and TENANT_NAME_PATTERN.match(name) is not None
+
+
+class Tenant:
+    """
+    已打开的租户：数据库引擎、写队列、文件目录和进程内缓存
+    """
+
+    def __init__(self, name, root, engine, write_queue):
+        self.name = name
+        self.root = root
+        self.engine = engine
+        self.write_queue = write_queue
+        self.database_path = os.path.join(root, DATABASE_FILENAME)
+        self.upload_folder = os.path.join(root, 'static', 'uploads')
+        self.backup_folder = os.path.join(root, 'backups')
+        # 代替 app.extensions 保存该租户的进程内缓存
+        self.extensions = {}
+        # 本进程是否已创建数据表并执行迁移
+        self.prepared = False
+        self.last_used = time.monotonic()
+
+
+class TenantPool:
+    """
+    按最近使用顺序保留的租户引擎池（每个进程一份，fork出的子进程重新打开）
+    """
+
+    def __init__(self, app, db):
+        self.app = app
+        self.db = db
+        self.tenants_dir = app.config['TENANTS_DIR']
+        self.max_engines = app.config.get('TENANT_MAX_ENGINES', DEFAULT_TENANT_MAX_ENGINES)
+        self.idle_seconds = app.config.get('TENANT_IDLE_SECONDS', DEFAULT_TENANT_IDLE_SECONDS)
+        self._lock = threading.Lock()
+        self._tenants = OrderedDict()
+        self._pid = os.getpid()
+
+    def __len__(self):
+        return len(self._tenants)
+
+    def tenant_root(self, name):
+        return os.path.join(self.tenants_dir, name)
+
+    def exists(self, name):
+        return is_valid_tenant_name(name) and os.path.isdir(self.tenant_root(name))
+
+    def names(self):
+        if not os.path.isdir(self.tenants_dir):
+            return []
+        return sorted(name for name in os.listdir(self.tenants_dir) if self.exists(name))
+
+    def get(self, name):
+        """
+        获取已打开的租户，必要时打开其数据库
+        :return: Tenant实例，租户不存在时返回None
+        """
+        with self._lock:
+            if self._pid != os.getpid():
+                # 父进程的连接不能在子进程中使用，直接丢弃（不关闭，以免影响父进程）
+                self._tenants = OrderedDict()
+                self._pid = os.getpid()
+            tenant = self._tenants.get(name)
+            if tenant is None:
+                if not self.exists(name):
+                    return None
+                tenant = self._tenants[name] = self._open(name)
+            now = time.monotonic()
+            tenant.last_used = now
+            self._tenants.move_to_end(name)
+            evicted = self._evict(now)
+        for old_tenant in evicted:
+            # 正在使用的连接归还时才会关闭，不影响进行中的请求
+            old_tenant.engine.dispose()
+        return tenant
+
+    def _evict(self, now):
+        """
+        移出超过数量上限或空闲过久的租户（从最久未使用的开始）
+        """
+        evicted = []
+        while self._tenants:
+            name, oldest = next(iter(self._tenants.items()))
+            if len(self._tenants) <= self.max_engines and now - oldest.last_used <= self.idle_seconds:
+                break
+            evicted.append(self._tenants.pop(name))
+        return evicted
+
+    def _open(self, name):
+        root = self.tenant_root(name)
+        engine = create_engine(f'sqlite:///{os.path.join(root, DATABASE_FILENAME)}',
+                               **self.app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {}))
+        write_queue = configure_sqlite_engine(self.app, engine)
+        watch_engine(engine)
+        return Tenant(name, root, engine, write_queue)
+
+
+def _statement_tables(mapper, clause):
+    if mapper is not None:
+        yield getattr(mapper, 'local_table', None)
+    if clause is not None:
+        table = getattr(clause, 'table', None)
+        if table is not None:
+            yield table
+        elif hasattr(clause, 'get_final_froms'):
+            yield from clause.get_final_froms()
+
+
+class TenantSession(Session):
+    """
+    当前应用上下文切换到租户后，共用表以外的查询都使用租户的数据库
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and has_app_context():
+            tenant = g.get('tenant')
+            if tenant is not None and not any(getattr(table, 'name', None) in SHARED_TABLES
+                                              for table in _statement_tables(mapper, clause)):
+                return tenant.engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+def current_tenant():
+    """
+    当前应用上下文的租户，单租户模式或未切换时返回None
+    """
+    return g.get('tenant') if has_app_context() else None
+
+
+def current_tenant_name():
+    """
+    当前租户名，单租户模式时为空字符串（后台任务表中的租户列使用）
+    """
+    tenant = current_tenant()
+    return tenant.name if tenant is not None else ''
+
+
+def tenant_extensions():
+    """
+    保存进程内缓存的字典：多租户时每个租户一份，否则为 app.extensions
+    """
+    tenant = current_tenant()
+    return tenant.extensions if tenant is not None else current_app.extensions
+
+
+def get_upload_folder(app):
+    """
+    当前租户的上传目录（单租户时为 UPLOAD_FOLDER）
+    """
+    tenant = current_tenant()
+    return tenant.upload_folder if tenant is not None else app.config['UPLOAD_FOLDER']
+
+
+def resolve_upload_path(app, filepath):
+    """
+    把数据库中保存的 /static/uploads/... 路径转换为当前租户的文件路径
+    """
+    tenant = current_tenant()
+    root = tenant.root if tenant is not None else app.root_path
+    return os.path.join(root, filepath.lstrip('/'))
+
+
+def get_database_path(db):
+    """
+    当前租户的数据库文件路径（单租户时为应用连接的数据库文件）
+    Flask-SQLAlchemy 会把相对路径解析到instance目录，默认即 instance/anniversaries.db
+    """
+    tenant = current_tenant()
+    if tenant is not None:
+        return tenant.database_path
+    return os.path.abspath(db.engine.url.database)
+
+
+def create_tables(db):
+    """
+    创建当前数据库中缺少的数据表（租户数据库中不创建共用表）
+    """
+    tenant = current_tenant()
+    if tenant is None:
+        db.create_all()
+        return
+    db.metadata.create_all(tenant.engine, tables=[table for table in db.metadata.sorted_tables
+                                                  if table.name not in SHARED_TABLES])
+
+
+def activate_tenant(tenant):
+    """
+    在当前应用上下文中切换到已打开的租户，本进程第一次使用时创建数据表并执行迁移
+    """
+    g.tenant = tenant
+    if not tenant.prepared:
+        db = current_app.extensions['tenant_pool'].db
+        create_tables(db)
+        run_migrations(db, current_app.logger)
+        tenant.prepared = True
+
+
+def use_tenant(name):
+    """
+    在当前应用上下文中切换到租户（需在应用上下文中调用）
+    :return: Tenant实例
+    :raises LookupError: 租户不存在
+    """
+    tenant = current_app.extensions['tenant_pool'].get(name)
+    if tenant is None:
+        raise LookupError(f'租户不存在: {name}')
+    activate_tenant(tenant)
+    return tenant
+
+
+def resolve_tenant_name(app):
+    """
+    从当前请求中取出租户名，无法确定时返回None
+    """
+    mode = app.config.get('TENANT_MODE')
+    if mode == 'path':
+        return request.environ.get(TENANT_ENVIRON_KEY)
+    host = request.host.rsplit(':', 1)[0].lower()
+    domain = app.config.get('TENANT_DOMAIN')
+    if domain:
+        suffix = '.' + domain.lower()
+        return host[:-len(suffix)] if host.endswith(suffix) else None
+    return host.split('.', 1)[0]
+
+
+class TenantPathMiddleware:
+    """
+    路径前缀模式：/alice/moments -> SCRIPT_NAME=/alice，PATH_INFO=/moments
+    """
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        name, _, rest = environ.get('PATH_INFO', '').lstrip('/').partition('/')
+        if name:
+            environ[TENANT_ENVIRON_KEY] = name
+            environ['SCRIPT_NAME'] = environ.get('SCRIPT_NAME', '') + '/' + name
+            environ['PATH_INFO'] = '/' + rest
+        return self.wsgi_app(environ, start_response)
+
+
+def create_tenant(app, name, upload_subfolders=()):
+    """
+    创建租户目录和数据库（需在应用上下文中调用）
+    :raises ValueError: 租户名不合法
+    """
+    if not is_valid_tenant_name(name):
+        raise ValueError(f'租户名只能包含小写字母、数字和连字符: {name}')
+    pool = app.extensions['tenant_pool']
+    root = pool.tenant_root(name)
+    for subfolder in upload_subfolders:
+        os.makedirs(os.path.join(root, 'static', 'uploads', subfolder), exist_ok=True)
+    os.makedirs(os.path.join(root, 'backups'), exist_ok=True)
+    return use_tenant(name)
+
+
+def init_tenants(app, db):
+    """
+    启用多租户（设置了 TENANT_MODE 时），需在注册蓝图之前调用，使租户在其他请求钩子之前确定
+    :return: TenantPool实例，单租户时返回None
+    """
+    mode = app.config.get('TENANT_MODE')
+    if not mode:
+        return None
+    if mode not in ('host', 'path'):
+        raise ValueError(f'TENANT_MODE 只能是 host 或 path: {mode}')
+
+    pool = TenantPool(app, db)
+    app.extensions['tenant_pool'] = pool
+    if mode == 'path':
+        app.wsgi_app = TenantPathMiddleware(app.wsgi_app)
+
+    @app.before_request
+    def activate_request_tenant():
+        name = resolve_tenant_name(app)
+        if not pool.exists(name):
+            abort(404)
+        use_tenant(name)
+
+    # 上传的文件从租户目录读取，其他静态文件不变
+    static_view = app.view_functions['static']
+
+    def static(filename):
+        tenant = current_tenant()
+        if tenant is not None and filename.startswith('uploads/'):
+            return send_from_directory(os.path.join(tenant.root, 'static'), filename)
+        return static_view(filename=filename)
+
+    app.view_functions['static'] = static
+    return pool
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='管理租户（需设置 LOVEBLOG_TENANT_MODE）')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    create_parser = subparsers.add_parser('create', help='创建租户')
+    create_parser.add_argument('name')
+    subparsers.add_parser('list', help='列出所有租户')
+    args = parser.parse_args()
+
+    from app import app, UPLOAD_SUBFOLDERS
+
+    if 'tenant_pool' not in app.extensions:
+        parser.error('未启用多租户，请设置 LOVEBLOG_TENANT_MODE=host 或 path')
+    with app.app_context():
+        if args.command == 'create':
+            tenant = create_tenant(app, args.name, UPLOAD_SUBFOLDERS)
+            print(f'已创建租户 {tenant.name}: {tenant.root}')
+        else:
+            for name in app.extensions['tenant_pool'].names():
+                print(name)
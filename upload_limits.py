@@ -0,0 +1,219 @@
+import os
+import threading
+import time
+from flask import g, jsonify, request
+
+# 跨进程文件锁（Windows上没有fcntl，只限制当前进程内的上传）
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# 上传准入控制
+# 大文件上传会占满gunicorn工作进程并写满临时目录，首页等公开页面随之卡住。
+# 上传接口在读取请求体之前先申请名额：
+# - 每个接口有单独的请求体大小上限，超过时直接返回413（请求体还没有被读取和缓存到临时文件）
+# - 同时处理的上传数和上传中的总字节数（按 Content-Length 计算）有上限，所有工作进程共用，
+#   名额通过 UPLOAD_LOCK_DIR 中的槽位文件锁实现，进程退出时自动释放
+# - 没有名额时最多 UPLOAD_QUEUE_SIZE 个请求排队等待 UPLOAD_QUEUE_TIMEOUT 秒，
+#   排队已满或等待超时立即返回503和 Retry-After（排队时仍占用工作进程，排队数和等待时间都应较小）
+# 单个请求超过总字节数上限时（如较大的备份文件），只在没有其他上传时处理
+
+# 需要准入控制的端点及其请求体大小上限（字节），可通过 app.config['UPLOAD_ROUTE_LIMITS'] 覆盖
+DEFAULT_UPLOAD_ROUTE_LIMITS = {
+    'attachments.upload_attachment': 50 * 1024 * 1024,
+    'moments.add_moment': 100 * 1024 * 1024,
+    'basic_info.update_basic_info': 30 * 1024 * 1024,
+    'backup.restore': 2 * 1024 * 1024 * 1024,
+    'moment_import.start_import': 2 * 1024 * 1024 * 1024,
+}
+
+# 默认同时处理的上传数、上传中的总字节数、排队数和排队等待时间（秒）
+DEFAULT_UPLOAD_MAX_CONCURRENT = 1
+DEFAULT_UPLOAD_MAX_BYTES_IN_FLIGHT = 512 * 1024 * 1024
+DEFAULT_UPLOAD_QUEUE_SIZE = 2
+DEFAULT_UPLOAD_QUEUE_TIMEOUT = 5
+
+
+class UploadRejected(Exception):
+    """
+    上传名额已满
+    """
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class UploadAdmission:
+    """
+    上传名额
+    lock_dir 为空或没有fcntl时只在进程内计数；否则每个名额对应一个槽位文件，
+    持有名额时对文件加锁并写入请求体大小，申请名额时在全局锁内统计已加锁的槽位
+    """
+
+    def __init__(self, lock_dir=None, max_concurrent=DEFAULT_UPLOAD_MAX_CONCURRENT,
+                 max_bytes=DEFAULT_UPLOAD_MAX_BYTES_IN_FLIGHT, queue_size=DEFAULT_UPLOAD_QUEUE_SIZE,
+                 timeout=DEFAULT_UPLOAD_QUEUE_TIMEOUT):
+        self.lock_dir = lock_dir if fcntl is not None else None
+        self.max_concurrent = max_concurrent
+        self.max_bytes = max_bytes
+        self.queue_size = queue_size
+        self.timeout = timeout
+        # 进程内计数
+        self._condition = threading.Condition()
+        self._active = 0
+        self._bytes = 0
+        self._waiting = 0
+
+    @property
+    def retry_after(self):
+        return max(1, int(self.timeout + 0.5))
+
+    def _admissible(self, active, in_flight, size):
+        return active < self.max_concurrent and (in_flight == 0 or in_flight + size <= self.max_bytes)
+
+    def acquire(self, size):
+        """
+        申请一个上传名额，没有名额时排队等待
+        :param size: 请求体大小（字节）
+        :return: 传给 release() 的凭据
+        """
+        if self.lock_dir:
+            return self._acquire_slot(size)
+
+        with self._condition:
+            if not self._admissible(self._active, self._bytes, size):
+                if self._waiting >= self.queue_size:
+                    raise UploadRejected('上传人数过多，请稍后重试', self.retry_after)
+                self._waiting += 1
+                try:
+                    admitted = self._condition.wait_for(
+                        lambda: self._admissible(self._active, self._bytes, size), self.timeout)
+                finally:
+                    self._waiting -= 1
+                if not admitted:
+                    raise UploadRejected(f'等待上传超过{self.timeout}秒，请稍后重试', self.retry_after)
+            self._active += 1
+            self._bytes += size
+            return size
+
+    def release(self, ticket):
+        if self.lock_dir:
+            fcntl.flock(ticket.fileno(), fcntl.LOCK_UN)
+            ticket.close()
+            return
+        with self._condition:
+            self._active -= 1
+            self._bytes -= ticket
+            self._condition.notify_all()
+
+    def _try_lock(self, path):
+        lock_file = open(path, 'a+')
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return lock_file
+        except BlockingIOError:
+            lock_file.close()
+            return None
+
+    def _try_admit(self, size):
+        # 全局锁只在统计和占用槽位时短暂持有
+        with open(os.path.join(self.lock_dir, 'admission.lock'), 'a+') as guard:
+            fcntl.flock(guard.fileno(), fcntl.LOCK_EX)
+            free = None
+            active = in_flight = 0
+            for index in range(self.max_concurrent):
+                path = os.path.join(self.lock_dir, f'slot-{index}.lock')
+                lock_file = self._try_lock(path)
+                if lock_file is None:
+                    active += 1
+                    with open(path) as f:
+                        in_flight += int(f.read() or 0)
+                elif free is None:
+                    free = lock_file
+                else:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+                    lock_file.close()
+            if free is not None and not self._admissible(active, in_flight, size):
+                fcntl.flock(free.fileno(), fcntl.LOCK_UN)
+                free.close()
+                free = None
+            if free is not None:
+                free.truncate(0)
+                free.write(str(size))
+                free.flush()
+            return free
+
+    def _acquire_slot(self, size):
+        os.makedirs(self.lock_dir, exist_ok=True)
+        slot = self._try_admit(size)
+        if slot is not None:
+            return slot
+
+        # 占用一个排队位置后等待，排队位置也是文件锁
+        waiting = None
+        for index in range(self.queue_size):
+            waiting = self._try_lock(os.path.join(self.lock_dir, f'wait-{index}.lock'))
+            if waiting is not None:
+                break
+        if waiting is None:
+            raise UploadRejected('上传人数过多，请稍后重试', self.retry_after)
+        try:
+            deadline = time.monotonic() + self.timeout
+            delay = 0.01
+            while time.monotonic() < deadline:
+                time.sleep(delay)
+                delay = min(delay * 2, 0.2)
+                slot = self._try_admit(size)
+                if slot is not None:
+                    return slot
+        finally:
+            fcntl.flock(waiting.fileno(), fcntl.LOCK_UN)
+            waiting.close()
+        raise UploadRejected(f'等待上传超过{self.timeout}秒，请稍后重试', self.retry_after)
+
+
+def _format_size(size):
+    if size >= 1024 * 1024:
+        return f'{size / 1024 / 1024:.0f} MB'
+    return f'{size / 1024:.0f} KB'
+
+
+def init_upload_limits(app):
+    """
+    上传接口在读取请求体之前检查大小并申请名额，请求结束后释放
+    """
+    admission = UploadAdmission(
+        app.config.get('UPLOAD_LOCK_DIR'),
+        max_concurrent=app.config.get('UPLOAD_MAX_CONCURRENT', DEFAULT_UPLOAD_MAX_CONCURRENT),
+        max_bytes=app.config.get('UPLOAD_MAX_BYTES_IN_FLIGHT', DEFAULT_UPLOAD_MAX_BYTES_IN_FLIGHT),
+        queue_size=app.config.get('UPLOAD_QUEUE_SIZE', DEFAULT_UPLOAD_QUEUE_SIZE),
+        timeout=app.config.get('UPLOAD_QUEUE_TIMEOUT', DEFAULT_UPLOAD_QUEUE_TIMEOUT),
+    )
+    app.extensions['upload_admission'] = admission
+    route_limits = app.config.get('UPLOAD_ROUTE_LIMITS', DEFAULT_UPLOAD_ROUTE_LIMITS)
+
+    @app.before_request
+    def admit_upload():
+        limit = route_limits.get(request.endpoint)
+        if limit is None or request.method != 'POST':
+            return None
+        size = request.content_length
+        if size is None:
+            return jsonify({'success': False, 'message': '上传请求缺少 Content-Length'}), 411
+        if size > limit:
+            return jsonify({'success': False, 'message': f'上传内容过大，最大 {_format_size(limit)}'}), 413
+        try:
+            g.upload_ticket = admission.acquire(size)
+        except UploadRejected as e:
+            return jsonify({'success': False, 'message': str(e)}), 503, {'Retry-After': str(e.retry_after)}
+        return None
+
+    @app.teardown_request
+    def release_upload(exc=None):
+        ticket = g.pop('upload_ticket', None)
+        if ticket is not None:
+            admission.release(ticket)
+
+    return admission